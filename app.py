@@ -1,20 +1,176 @@
+import base64
+import csv
+import io
 import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import uuid
+import click
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from urllib.parse import urlencode
 from flask_restful import Resource, Api
-from flask import Flask, Response, request
+from flask import (Flask, Response, current_app, g, has_app_context, has_request_context,
+    request, stream_with_context)
+from flask.cli import with_appcontext
+from werkzeug.urls import url_quote, url_unquote
+from werkzeug.utils import import_string
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.engine import Engine
-from sqlalchemy import event
-from jsonschema import validate, ValidationError
-from datetime import datetime
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy import and_, event, func, inspect, select, tuple_
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from jsonschema import Draft7Validator, ValidationError
+from jsonschema.exceptions import best_match
+from datetime import datetime, timedelta
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+
+#Pragmas set on every new SQLite connection. SQLITE_PRAGMA_PROFILE in the app
+#config picks one of the profiles and SQLITE_PRAGMAS can override single
+#pragmas of it. The default profile lets readers run next to a writer (WAL),
+#waits for locks instead of failing and reads through a memory map. The bulk
+#profile is only for loading generated data into a database nobody else is
+#using, it gives up durability and foreign key checks for speed.
+PRAGMA_PROFILES = {
+    "default": {
+        "busy_timeout": 5000,
+        "foreign_keys": "ON",
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -20000,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+    },
+    "compat": {
+        "foreign_keys": "ON",
+    },
+    "bulk": {
+        "foreign_keys": "OFF",
+        "journal_mode": "MEMORY",
+        "synchronous": "OFF",
+        "locking_mode": "EXCLUSIVE",
+        "cache_size": -262144,
+        "temp_store": "MEMORY",
+    },
+}
+
+class TrackerSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy extension that sets the pragma profile from the config of
+    the app on every connection its SQLite engine opens.
+    """
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super(TrackerSQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername == "sqlite":
+            options["sqlite_pragmas"] = get_pragmas(app.config)
+        options["instrument_sql"] = app.config.get("INSTRUMENTATION", False)
+        options["query_limit"] = app.config.get("MAX_QUERIES_PER_REQUEST")
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop("sqlite_pragmas", None)
+        instrument = engine_opts.pop("instrument_sql", False)
+        query_limit = engine_opts.pop("query_limit", None)
+        engine = super(TrackerSQLAlchemy, self).create_engine(sa_url, engine_opts)
+        if pragmas:
+            event.listen(engine, "connect", pragma_listener(pragmas))
+        #The limit is checked first, statements it stops are not timed
+        if query_limit is not None:
+            event.listen(engine, "before_cursor_execute", query_limit_listener(query_limit))
+        if instrument:
+            event.listen(engine, "before_cursor_execute", start_sql_timing)
+            event.listen(engine, "after_cursor_execute", finish_sql_timing)
+            event.listen(engine, "handle_error", failed_sql_timing)
+        return engine
+
+def get_pragmas(config):
+    """
+    Builds the pragmas of an app from its SQLITE_PRAGMA_PROFILE and
+    SQLITE_PRAGMAS settings. Raises ValueError for an unknown profile or a
+    pragma that does not look like one.
 
+    : param dict config: the app config
+    """
+
+    profile = config.get("SQLITE_PRAGMA_PROFILE", "default")
+    if profile not in PRAGMA_PROFILES:
+        raise ValueError("Unknown SQLite pragma profile '{}'".format(profile))
+    pragmas = dict(PRAGMA_PROFILES[profile])
+    pragmas.update(config.get("SQLITE_PRAGMAS") or {})
+    for name, value in pragmas.items():
+        if not re.match(r"^\w+$", name) or not re.match(r"^-?\w+$", str(value)):
+            raise ValueError("Invalid SQLite pragma {}={}".format(name, value))
+    return pragmas
+
+def pragma_listener(pragmas):
+    """
+    Makes a connect event listener that sets the given pragmas in order.
 
+    : param dict pragmas: pragma names mapped to their values
+    """
 
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///tracker.db"
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-db = SQLAlchemy(app)
-api = Api(app)
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA {}={}".format(name, value))
+        cursor.close()
+    return set_sqlite_pragma
+
+#Settings of the app. create_app starts from these, then reads the file named
+#by the BUDTRACK_SETTINGS environment variable and BUDTRACK_<setting>
+#environment variables, e.g. BUDTRACK_DB_POOL_SIZE=20
+DEFAULT_CONFIG = {
+    "SQLALCHEMY_DATABASE_URI": "sqlite:///tracker.db",
+    "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+    "SQLITE_PRAGMA_PROFILE": "default",
+    "SQLITE_PRAGMAS": {},
+    #Keep SQLite connections open in a pool and reuse them between requests
+    #instead of opening a new one for every request
+    "SQLITE_POOL": True,
+    #Pool settings, None leaves the SQLAlchemy default
+    "DB_POOL_SIZE": None,
+    "DB_MAX_OVERFLOW": None,
+    "DB_POOL_TIMEOUT": None,
+    "DB_POOL_RECYCLE": None,
+    "DB_POOL_PRE_PING": False,
+    #Extra create_engine arguments, these win over everything above
+    "DB_ENGINE_OPTIONS": {},
+    #Cache GET responses in the process. Off by default since every process
+    #has its own cache, other processes see changes only after the TTL
+    "RESPONSE_CACHE": False,
+    "RESPONSE_CACHE_SIZE": 1024,
+    "RESPONSE_CACHE_TTL": 60,
+    #Factory or import name of another cache backend, called with the config
+    "RESPONSE_CACHE_BACKEND": None,
+    #Encoder of the responses, "json", "orjson", "auto" for orjson if it is
+    #installed or the import name of a serializer class. orjson is faster but
+    #writes compact JSON with unescaped non-ASCII characters, so it is opt-in
+    "JSON_SERIALIZER": "json",
+    #Send the items of budget and expense listings as they are encoded
+    #instead of building the whole body first. Streamed responses are not
+    #cached
+    "JSON_STREAM_ITEMS": False,
+    #Time every request, its SQL statements, validation and serialization,
+    #send the times in a Server-Timing header and count them in /metrics
+    "INSTRUMENTATION": False,
+    #Fail requests that issue more SQL statements than this, to catch N+1
+    #queries in tests. None turns the check off
+    "MAX_QUERIES_PER_REQUEST": None,
+}
+
+db = TrackerSQLAlchemy()
+api = Api()
 
 MASON = "application/vnd.mason+json"
 LINK_RELATIONS_URL = "/budtrack/link-relations/"
@@ -22,12 +178,43 @@ USER_PROFILE = "/profiles/user/"
 BUDGET_PROFILE = "/profiles/budget/"
 EXPENSE_PROFILE = "/profiles/expense/" 
 ERROR_PROFILE = "/profiles/error/"
-
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
-    cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA foreign_keys=ON")
-    cursor.close()
+SUMMARY_PROFILE = "/profiles/summary/"
+REPORT_PROFILE = "/profiles/report/"
+NDJSON = "application/x-ndjson"
+CSV = "text/csv"
+
+#Paging of the user collection
+USER_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+#URI template of the expense filters, added to the URL of a budget
+EXPENSE_FILTERS_TEMPLATE = "{?from,to,min_amount,max_amount,sort,limit}"
+#Paging of the expense collection, budgets embed a preview of the first
+#expenses
+EXPENSE_PAGE_SIZE = 100
+EXPENSE_PREVIEW_SIZE = 10
+#Values of the controls query parameter and the controls kept with
+#controls=minimal, the ones needed to navigate
+CONTROL_LEVELS = ("none", "minimal", "full")
+MINIMAL_CONTROLS = ("self", "up", "next", "prev")
+#Rows fetched from the cursor at a time while streaming
+FETCH_SIZE = 100
+#Expense names that are paths of other resources under a budget, an expense
+#with one of them could not be read at its own URL
+RESERVED_EXPENSE_NAMES = ("summary", "expenses")
+#SQL expressions of the periods spending can be grouped by, made from a date
+#column. Weeks start on Monday and are named by its date
+BUCKET_PERIODS = {
+    "day": lambda column: func.strftime("%Y-%m-%d", column),
+    "week": lambda column: func.date(column, "-6 days", "weekday 1"),
+    "month": lambda column: func.strftime("%Y-%m", column),
+}
+#URI template of the spending report parameters, added to its URL
+REPORT_TEMPLATE = "{?from,to,bucket}"
+#Names looked up per query when checking a batch for existing expenses,
+#kept below the SQLite limit of bound parameters
+BATCH_LOOKUP_SIZE = 500
+#Streamed bodies are written out in chunks of roughly this many characters
+STREAM_CHUNK_SIZE = 8192
 
 
 '''
@@ -35,20 +222,67 @@ MODELS
 '''
 #Creating Schema of tables
 
+def new_version(current=None):
+    """
+    Makes a new random row version. Every row gets a new one whenever it or
+    anything shown in its representation changes. Versions are the ETags of
+    the resources and the ORM checks them in UPDATE and DELETE statements,
+    so a row changed by a concurrent request raises StaleDataError.
+    """
+
+    return uuid.uuid4().hex
+
+def loaded_repr(obj, name, parent=None, parent_name=None, parent_key=None):
+    """
+    Describes a model object for __repr__ with the attributes it has loaded
+    only, so printing or logging an object never issues SQL, not even for an
+    expired one. The parent is named if it is loaded, otherwise its key is
+    shown.
+
+    : param obj: the model object
+    : param str name: attribute with the name of the object
+    : param str parent: relationship to the parent, optional
+    : param str parent_name: attribute with the name of the parent
+    : param str parent_key: foreign key column of the parent
+    """
+
+    values = obj.__dict__
+    text = "{} <{}>".format(values.get(name, "?"), values.get("id", "?"))
+    if parent is None:
+        return text
+    loaded = values.get(parent)
+    if loaded is not None and parent_name in loaded.__dict__:
+        return "{} in {}".format(text, loaded.__dict__[parent_name])
+    return "{} in {} <{}>".format(text, parent, values.get(parent_key, "?"))
+
+#The collections (User.budgets, Budget.expenses) never load on access, a
+#query that needs them picks selectinload or joinedload for its path. The
+#parents are loaded on access, but resolve_path reads them in the same row as
+#their children, so they come from the identity map without SQL
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_name = db.Column(db.String(20), nullable=False, unique=True)
     user_email = db.Column(db.String(20), nullable=False, unique=True)
     password = db.Column(db.String(40), nullable=False)
+    #Also changes when budgets of the user are added, changed or deleted
+    version = db.Column(db.String(32), nullable=False)
+
+    budgets = db.relationship("Budget", back_populates="user", passive_deletes=True,
+        lazy="raise_on_sql")
 
-    budgets = db.relationship("Budget", back_populates="user", passive_deletes=True)
+    __mapper_args__ = {"version_id_col": version, "version_id_generator": new_version}
 
     def __repr__(self):
-        return "{} <{}>".format(self.user_name, self.id)
+        return loaded_repr(self, "user_name")
 
 class Budget(db.Model):
     #Each user can have one budget with same name
-    __table_args__ = (db.UniqueConstraint("budget_name", "user_id", name="_user_budget_uc"), )
+    #Budgets are listed per user and filtered by their dates
+    __table_args__ = (
+        db.UniqueConstraint("budget_name", "user_id", name="_user_budget_uc"),
+        db.Index("ix_budget_user_dates", "user_id", "start_date", "end_date"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     budget_name = db.Column(db.String(20), nullable=False)
@@ -57,31 +291,561 @@ class Budget(db.Model):
     start_date = db.Column(db.DateTime, nullable=False)
     end_date = db.Column(db.DateTime, nullable=False)
     currency_type = db.Column(db.String(20), nullable=True)
+    #Running totals of the expenses, kept up to date by the expense events
+    spent_amount = db.Column(db.Float, nullable=False, default=0)
+    expense_count = db.Column(db.Integer, nullable=False, default=0)
+    last_expense_date = db.Column(db.DateTime, nullable=True)
+    #Also changes when expenses of the budget are added, changed or deleted
+    version = db.Column(db.String(32), nullable=False)
     #Relationship with user table
     user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"))
-    user = db.relationship("User", back_populates="budgets")
+    user = db.relationship("User", back_populates="budgets", lazy="select")
     #Relationship with expense table
-    expenses = db.relationship("Expense", back_populates="budget", passive_deletes=True)
+    expenses = db.relationship("Expense", back_populates="budget", passive_deletes=True,
+        lazy="raise_on_sql")
+
+    __mapper_args__ = {"version_id_col": version, "version_id_generator": new_version}
 
     def __repr__(self):
-        return "{} <{}> in {}".format(self.budget_name, self.id, self.user.user_name)
+        return loaded_repr(self, "budget_name", "user", "user_name", "user_id")
 
 
 class Expense(db.Model):
      #Each budget can have one expense with same name
-    __table_args__ = (db.UniqueConstraint("expense_name", "budget_id", name="_budget_expense_uc"), )
+    #Expenses are listed, ranged and summed per budget by date, the amount
+    #makes the index covering for the sums
+    __table_args__ = (
+        db.UniqueConstraint("expense_name", "budget_id", name="_budget_expense_uc"),
+        db.Index("ix_expense_budget_date", "budget_id", "expense_date", "expense_amount"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     expense_name = db.Column(db.String(20), nullable=False)
     expense_description = db.Column(db.String(40), nullable=True)
     expense_amount = db.Column(db.Float, nullable=False)
     expense_date = db.Column(db.DateTime, nullable=False)
+    version = db.Column(db.String(32), nullable=False)
     #Relationship with Budget table
     budget_id = db.Column(db.Integer, db.ForeignKey("budget.id", ondelete="CASCADE"))
-    budget = db.relationship("Budget", back_populates="expenses")
+    budget = db.relationship("Budget", back_populates="expenses", lazy="select")
+
+    __mapper_args__ = {"version_id_col": version, "version_id_generator": new_version}
 
     def __repr__(self):
-        return "{} <{}> in {}".format(self.expense_name, self.id, self.budget.budget_name)
+        return loaded_repr(self, "expense_name", "budget", "budget_name", "budget_id")
+
+
+#Keep the running totals and versions of the budgets in step with their
+#expenses, and the versions of the users in step with their budgets. The
+#parents are updated on the connection of the flush, so the changes are
+#committed or rolled back together with the change of the child
+
+def adjust_budget_totals(connection, budget_id, amount, count):
+    """
+    Adds amount and count to the running totals of a budget, refreshes its
+    last expense date and gives it a new version.
+
+    : param connection: connection of the current transaction
+    : param int budget_id: id of the budget
+    : param float amount: change of the spent amount
+    : param int count: change of the number of expenses
+    """
+
+    budget = Budget.__table__
+    expense = Expense.__table__
+    connection.execute(budget.update().where(budget.c.id == budget_id).values(
+        spent_amount=budget.c.spent_amount + amount,
+        expense_count=budget.c.expense_count + count,
+        last_expense_date=select([func.max(expense.c.expense_date)])
+            .where(expense.c.budget_id == budget_id).as_scalar(),
+        version=new_version()
+    ))
+
+@event.listens_for(Expense, "after_insert")
+def add_to_budget_totals(mapper, connection, target):
+    if target.budget_id is not None:
+        adjust_budget_totals(connection, target.budget_id, target.expense_amount, 1)
+
+@event.listens_for(Expense, "after_update")
+def update_budget_totals(mapper, connection, target):
+    state = inspect(target)
+    amount = state.attrs.expense_amount.history
+    budget_id = state.attrs.budget_id.history
+    old_amount = amount.deleted[0] if amount.deleted else target.expense_amount
+    old_budget_id = budget_id.deleted[0] if budget_id.deleted else target.budget_id
+
+    if old_budget_id != target.budget_id:
+        if old_budget_id is not None:
+            adjust_budget_totals(connection, old_budget_id, -old_amount, -1)
+        if target.budget_id is not None:
+            adjust_budget_totals(connection, target.budget_id, target.expense_amount, 1)
+    elif target.budget_id is not None:
+        #The budget shows its expenses, so its version changes even if the
+        #totals stay the same
+        adjust_budget_totals(connection, target.budget_id,
+            target.expense_amount - old_amount, 0)
+
+@event.listens_for(Expense, "after_delete")
+def remove_from_budget_totals(mapper, connection, target):
+    if target.budget_id is not None:
+        adjust_budget_totals(connection, target.budget_id, -target.expense_amount, -1)
+
+@event.listens_for(Budget, "after_insert")
+@event.listens_for(Budget, "after_update")
+@event.listens_for(Budget, "after_delete")
+def touch_budget_user(mapper, connection, target):
+    if target.user_id is not None:
+        user = User.__table__
+        connection.execute(user.update().where(user.c.id == target.user_id).values(
+            version=new_version()
+        ))
+
+#Columns read by the GET handlers. They are read as plain rows instead of
+#ORM objects, which only the handlers that change something need. The ids
+#and versions are labeled so that the columns of a user, one of its budgets
+#and one of its expenses can be read into one row
+USER_COLUMNS = (
+    User.id.label("user_id"),
+    User.user_name,
+    User.user_email,
+    User.password,
+    User.version.label("user_version"),
+)
+BUDGET_COLUMNS = (
+    Budget.id.label("budget_id"),
+    Budget.budget_name,
+    Budget.budget_description,
+    Budget.budget_amount,
+    Budget.start_date,
+    Budget.end_date,
+    Budget.currency_type,
+    Budget.spent_amount,
+    Budget.expense_count,
+    Budget.last_expense_date,
+    Budget.version.label("budget_version"),
+)
+EXPENSE_COLUMNS = (
+    Expense.id.label("expense_id"),
+    Expense.expense_name,
+    Expense.expense_description,
+    Expense.expense_amount,
+    Expense.expense_date,
+    Expense.version.label("expense_version"),
+)
+#Columns expense listings can be sorted by, a "-" in front of the name of
+#the sort query parameter sorts in descending order
+EXPENSE_SORTS = {
+    "expense_date": Expense.expense_date,
+    "expense_amount": Expense.expense_amount,
+    "expense_name": Expense.expense_name,
+}
+
+
+'''
+RESPONSE CACHE
+'''
+
+class ResponseCache(object):
+    """
+    In-process LRU cache of GET responses. Entries are keyed by the path and
+    query of the request and expire after ttl seconds, so instances of the app
+    in other processes see each other's changes at least that often. Holds at
+    most max_entries responses, the least recently used ones are evicted first.
+
+    Every invalidation gets a generation number. A response read from the
+    database is only stored if no invalidation of its path happened after the
+    generation it was read at, so a GET that overlaps a write can not cache
+    the old state after the write has dropped it.
+
+    Another backend can be used with RESPONSE_CACHE_BACKEND, it needs the same
+    generation, get, set, invalidate and stats methods.
+    """
+
+    #Invalidations remembered for checking generations, a response read
+    #before older ones is not stored
+    INVALIDATION_LOG_SIZE = 1024
+
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._invalidation_log = deque(maxlen=self.INVALIDATION_LOG_SIZE)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def generation(self):
+        """
+        Returns the number of the latest invalidation, to be given to set with
+        a value that is read after this call.
+        """
+
+        with self._lock:
+            return self._generation
+
+    def _invalidated_since(self, key, generation):
+        #Invalidations older than the log may have matched, assume they did
+        if generation < self._generation - len(self._invalidation_log):
+            return True
+        return any(key.startswith(prefixes)
+            for number, prefixes in self._invalidation_log if number > generation)
+
+    def get(self, key):
+        """
+        Returns the value stored under key or None if there is none or it has
+        expired.
+
+        : param str key: path and query of the request
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, generation=None):
+        """
+        Stores a value under key, evicting the least recently used entries if
+        the cache is full. If generation is given, the value is not stored
+        when the key has been invalidated since then. Returns whether the
+        value was stored.
+
+        : param str key: path and query of the request
+        : param value: the cached response
+        : param int generation: from generation, before the value was read
+        """
+
+        with self._lock:
+            if generation is not None and self._invalidated_since(key, generation):
+                return False
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, path, subtree=False):
+        """
+        Removes the entries of a resource path with any query, and with
+        subtree also the entries of every path below it.
+
+        : param str path: path of the resource
+        : param bool subtree: also remove the resources below the path
+        """
+
+        prefixes = (path + "?", path.rstrip("/") + "/") if subtree else (path + "?", )
+        with self._lock:
+            self._generation += 1
+            self._invalidation_log.append((self._generation, prefixes))
+            for key in [key for key in self._entries if key.startswith(prefixes)]:
+                del self._entries[key]
+                self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+def make_response_cache(config):
+    """
+    Makes the response cache of an app from its RESPONSE_CACHE settings.
+    Returns None if the cache is disabled. RESPONSE_CACHE_BACKEND can be a
+    factory, or the import name of one, that is called with the config.
+
+    : param dict config: the app config
+    """
+
+    if not config.get("RESPONSE_CACHE"):
+        return None
+    factory = config.get("RESPONSE_CACHE_BACKEND")
+    if factory is None:
+        return ResponseCache(config["RESPONSE_CACHE_SIZE"], config["RESPONSE_CACHE_TTL"])
+    if isinstance(factory, str):
+        factory = import_string(factory)
+    return factory(config)
+
+def cached_response(method):
+    """
+    Decorator for the GET methods of resources. Serves the response from the
+    response cache of the app when there is one, otherwise calls the method
+    and caches its response if it is a 200. The X-Cache header tells whether
+    the response came from the cache.
+    """
+
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        cache = current_app.extensions.get("response_cache")
+        if cache is None:
+            return method(*args, **kwargs)
+        key = request.path + "?" + request.query_string.decode("latin-1")
+
+        entry = cache.get(key)
+        if entry is not None:
+            data, status, headers = entry
+            etag = dict(headers).get("ETag")
+            resp = not_modified(etag.strip('"')) if etag else None
+            if resp is None:
+                resp = Response(data, status, headers=headers)
+            resp.headers["X-Cache"] = "HIT"
+            return resp
+
+        #Taken before the database is read, a write that commits and
+        #invalidates the key meanwhile makes set skip this response
+        generation = cache.generation()
+        resp = method(*args, **kwargs)
+        if resp.status_code == 200 and not resp.is_streamed:
+            cache.set(key, (resp.get_data(), resp.status_code, list(resp.headers)), generation)
+        resp.headers["X-Cache"] = "MISS"
+        return resp
+    return wrapper
+
+def invalidate_cache(resource, subtree=False, **values):
+    """
+    Removes the cached responses of a resource after it has been changed.
+
+    : param resource: the resource class
+    : param bool subtree: also remove the resources below it
+    : param values: the URL variables of the resource
+    """
+
+    cache = current_app.extensions.get("response_cache")
+    if cache is not None:
+        cache.invalidate(url_unquote(resource_url(resource, **values)), subtree)
+
+
+'''
+INSTRUMENTATION
+'''
+
+#Upper bounds in seconds of the buckets of the request duration histogram
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+#Parts of a request that are timed, with their Server-Timing names
+TIMED_PARTS = (("sql", "db"), ("validate", "validate"), ("serialize", "serialize"))
+
+class RequestMetrics(object):
+    """
+    Totals of the timed requests of a process, per endpoint: the number of
+    requests by method and status, a histogram of their durations and the
+    number of SQL statements and the time spent in SQL, validation and
+    serialization. Rendered in the Prometheus text format for /metrics.
+    """
+
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._durations = {}
+        self._parts = {}
+
+    def record(self, endpoint, method, status, duration, timings):
+        """
+        Adds a finished request to the totals.
+
+        : param str endpoint: endpoint of the request
+        : param str method: HTTP method
+        : param int status: status code of the response
+        : param float duration: seconds the request took
+        : param dict timings: seconds per timed part and the SQL statement count
+        """
+
+        with self._lock:
+            key = (endpoint, method, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            histogram = self._durations.get(endpoint)
+            if histogram is None:
+                histogram = self._durations[endpoint] = [[0] * len(self.buckets), 0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += 1
+            histogram[2] += duration
+            parts = self._parts.setdefault(endpoint, dict.fromkeys(timings, 0))
+            for name, value in timings.items():
+                parts[name] += value
+
+    def render(self):
+        """
+        Returns the totals in the Prometheus text exposition format.
+        """
+
+        def labels(**values):
+            return "{" + ",".join('{}="{}"'.format(name, str(value).replace('"', '\\"'))
+                for name, value in sorted(values.items())) + "}"
+
+        lines = []
+        with self._lock:
+            lines.append("# HELP budtrack_requests_total Requests handled.")
+            lines.append("# TYPE budtrack_requests_total counter")
+            for (endpoint, method, status), count in sorted(self._requests.items()):
+                lines.append("budtrack_requests_total{} {}".format(
+                    labels(endpoint=endpoint, method=method, status=status), count))
+            lines.append("# HELP budtrack_request_duration_seconds Time to handle a request.")
+            lines.append("# TYPE budtrack_request_duration_seconds histogram")
+            for endpoint, (counts, count, total) in sorted(self._durations.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append("budtrack_request_duration_seconds_bucket{} {}".format(
+                        labels(endpoint=endpoint, le=bound), bucket_count))
+                lines.append("budtrack_request_duration_seconds_bucket{} {}".format(
+                    labels(endpoint=endpoint, le="+Inf"), count))
+                lines.append("budtrack_request_duration_seconds_sum{} {}".format(
+                    labels(endpoint=endpoint), total))
+                lines.append("budtrack_request_duration_seconds_count{} {}".format(
+                    labels(endpoint=endpoint), count))
+            lines.append("# HELP budtrack_sql_statements_total SQL statements executed.")
+            lines.append("# TYPE budtrack_sql_statements_total counter")
+            for endpoint, parts in sorted(self._parts.items()):
+                lines.append("budtrack_sql_statements_total{} {}".format(
+                    labels(endpoint=endpoint), parts["sql_count"]))
+            for part, _ in TIMED_PARTS:
+                lines.append("# HELP budtrack_{0}_seconds_total Time spent in {0}.".format(part))
+                lines.append("# TYPE budtrack_{}_seconds_total counter".format(part))
+                for endpoint, parts in sorted(self._parts.items()):
+                    lines.append("budtrack_{}_seconds_total{} {}".format(
+                        part, labels(endpoint=endpoint), parts[part]))
+        return "\n".join(lines) + "\n"
+
+def start_request_timing():
+    g.request_started = time.perf_counter()
+    g.timings = {"sql": 0.0, "sql_count": 0, "validate": 0.0, "serialize": 0.0}
+
+def finish_request_timing(resp):
+    """
+    Adds the Server-Timing header to a response and keeps its status for
+    record_request_timing. The times of streamed responses only cover the
+    time until the body starts.
+    """
+
+    timings = g.get("timings")
+    if timings is None:
+        return resp
+    duration = time.perf_counter() - g.request_started
+    metrics = [
+        "app;dur={:.2f}".format(duration * 1000),
+        'db;dur={:.2f};desc="{} queries"'.format(timings["sql"] * 1000, timings["sql_count"]),
+    ]
+    metrics.extend("{};dur={:.2f}".format(header, timings[part] * 1000)
+        for part, header in TIMED_PARTS[1:])
+    resp.headers["Server-Timing"] = ", ".join(metrics)
+    g.response_status = resp.status_code
+    return resp
+
+def record_request_timing(exc):
+    """
+    Records a finished request in the metrics of the app. Runs on teardown,
+    which unlike after_request also happens for requests that raised, those
+    are recorded as 500s.
+
+    : param exc: the unhandled exception of the request, or None
+    """
+
+    timings = g.get("timings")
+    if timings is None:
+        return
+    status = 500 if exc is not None else g.get("response_status", 500)
+    current_app.extensions["metrics"].record(request.endpoint or "none", request.method,
+        status, time.perf_counter() - g.request_started, timings)
+
+@contextmanager
+def timed(part):
+    """
+    Adds the time spent in the block to a timed part of the current request,
+    if it is being timed.
+
+    : param str part: "validate" or "serialize"
+    """
+
+    timings = g.get("timings") if has_app_context() else None
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[part] += time.perf_counter() - started
+
+def start_sql_timing(conn, cursor, statement, parameters, context, executemany):
+    #The start is kept on the execution context of the statement, it goes
+    #away with the statement whether it succeeds or fails
+    if context is not None:
+        context.query_started = time.perf_counter()
+
+def finish_sql_timing(conn, cursor, statement, parameters, context, executemany):
+    add_sql_timing(context)
+
+def failed_sql_timing(exception_context):
+    #after_cursor_execute is not called for statements that raise
+    add_sql_timing(exception_context.execution_context)
+
+def add_sql_timing(context):
+    """
+    Adds the time of a finished or failed SQL statement to the timings of
+    the current request, if it is being timed.
+
+    : param context: execution context of the statement, or None
+    """
+
+    started = getattr(context, "query_started", None)
+    timings = g.get("timings") if has_app_context() else None
+    if started is not None and timings is not None:
+        timings["sql"] += time.perf_counter() - started
+        timings["sql_count"] += 1
+
+class QueryLimitExceeded(Exception):
+    """
+    Raised when a request issues more SQL statements than
+    MAX_QUERIES_PER_REQUEST allows.
+    """
+
+def reset_query_count():
+    g.query_count = 0
+
+def query_limit_listener(limit):
+    """
+    Makes a before_cursor_execute listener that counts the SQL statements of
+    the current request and raises QueryLimitExceeded instead of running the
+    one that goes over the limit. Statements outside requests are not
+    counted.
+
+    : param int limit: statements allowed per request
+    """
+
+    def check_query_count(conn, cursor, statement, parameters, context, executemany):
+        if not has_request_context():
+            return
+        g.query_count = g.get("query_count", 0) + 1
+        if g.query_count > limit:
+            raise QueryLimitExceeded("{} {} issued more than {} SQL statements, the next one was: {}"
+                .format(request.method, request.full_path, limit, " ".join(statement.split())))
+    return check_query_count
+
+def metrics():
+    #Totals of the timed requests for Prometheus
+    body = current_app.extensions["metrics"].render()
+    return Response(body, 200, mimetype="text/plain; version=0.0.4")
 
 
 '''
@@ -97,25 +861,60 @@ POST: Allow us to add a new user to database
 class UserCollection(Resource):
 
     def get(self):
-        #Get all the users and add them in items list
-        #also add controls for every user
-        body = UserBuilder(items=[])
-        for user in User.query.all():
-            item = UserBuilder(
-                user_name=user.user_name,
-                user_email=user.user_email,
-                password=user.password
-            )
-            item.add_control("self", api.url_for(UserCollection)+user.user_name+'/')
-            item.add_control("profile", USER_PROFILE)
-            body["items"].append(item)
-        
+        #Get one page of users and stream them in the items list
+        #also add controls for every user. Pages are keyset paginated on
+        #the user id, "after" and "before" are the cursors of the page
+        try:
+            after, before, limit = parse_page_args(USER_PAGE_SIZE)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        query = db.session.query(*USER_COLUMNS).order_by(User.id)
+        if before is not None:
+            #Find where the previous page starts so that it can still be
+            #streamed in ascending order
+            start = db.session.query(User.id).filter(User.id < before) \
+                .order_by(User.id.desc()).offset(limit - 1).limit(1).scalar()
+            if start is not None:
+                query = query.filter(User.id >= start)
+        elif after is not None:
+            query = query.filter(User.id > after)
+
+        collection_url = resource_url(UserCollection)
+        body = UserBuilder()
         body.add_namespace("budtrack", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(UserCollection))
+        body.add_control("self", collection_url)
         body.add_control_add_user()
 
-        resp = Response(json.dumps(body), status=200, mimetype=MASON)
-        resp.headers['Location'] = api.url_for(UserCollection)
+        def items():
+            #Fetch one row more than the page size to know if there is a
+            #next page, only FETCH_SIZE rows are held in memory at a time
+            first = last = None
+            for index, user in enumerate(query.limit(limit + 1).yield_per(FETCH_SIZE)):
+                if index == limit:
+                    body.add_control("next", page_url(collection_url,
+                        after=last, before=None, limit=limit))
+                    break
+                if first is None:
+                    first = user.user_id
+                last = user.user_id
+                item = UserBuilder(
+                    user_name=user.user_name,
+                    user_email=user.user_email,
+                    password=user.password
+                )
+                item.add_control("self", collection_url+user.user_name+'/')
+                item.add_control("profile", USER_PROFILE)
+                yield item
+
+            if first is not None and db.session.query(User.id) \
+                    .filter(User.id < first).first() is not None:
+                body.add_control("prev", page_url(collection_url,
+                    after=None, before=first, limit=limit))
+
+        resp = Response(stream_with_context(stream_collection(body, items())),
+            status=200, mimetype=MASON)
+        resp.headers['Location'] = collection_url
         return resp
 
     def post(self):
@@ -126,7 +925,7 @@ class UserCollection(Resource):
                 )
         #Validate againsta the schema
         try:
-            validate(request.json, UserBuilder.user_schema())
+            schemas.validate("user", request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
         
@@ -147,7 +946,7 @@ class UserCollection(Resource):
             )
         
         return Response(status=201, headers={
-            "Location": api.url_for(UserCollection) + request.json["user_name"]+'/'})
+            "Location": resource_url(UserCollection) + request.json["user_name"]+'/'})
 
 
 '''
@@ -160,32 +959,38 @@ DELETE: Allow us to delete the user
 
 class UserItem(Resource):
     
+    @cached_response
     def get(self, user):
-        #Filter the user with the user_name from database
-        db_user = User.query.filter_by(user_name=user).first()
-        if db_user is None:
-            return create_error_response(404, "Not found", 
-                "No user was found with the username {}".format(user)
-            )
+        #Read the columns of the user from database
+        row, error = read_path(user)
+        if error is not None:
+            return error
+        #Nothing to send if the client has the current version
+        resp = not_modified(row.user_version)
+        if resp is not None:
+            return resp
         
         body = UserBuilder(
-            user_name=db_user.user_name,
-            user_email=db_user.user_email,
-            password=db_user.password
+            user_name=row.user_name,
+            user_email=row.user_email,
+            password=row.password
         )
 
         #Add the hyper media controls
         body.add_namespace("budtrack", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(UserItem, user=user))
+        body.add_control("self", resource_url(UserItem, user=user))
         body.add_control("profile", USER_PROFILE)
         body.add_collection_all_users()
         body.add_control_edit_user(user)
         body.add_control_delete_user(user)
         body.add_control("budtrack:budget-by",
-            api.url_for(BudgetCollection, user=user)
+            resource_url(BudgetCollection, user=user)
         )
+        body.add_control_spending_report(user)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        resp = Response(dump_json(body), 200, mimetype=MASON)
+        resp.set_etag(row.user_version)
+        return resp
     
     def put(self, user):
         #check if valid json
@@ -193,15 +998,17 @@ class UserItem(Resource):
             return create_error_response(415, "Unsupported media type",
                 "Requests must be JSON"
                 )
-        #get the user from database
-        db_user = User.query.filter_by(user_name=user).first()
-        if db_user is None:
-            return create_error_response(404, "Not found", 
-                "No user was found with the user_name {}".format(user)
-            )
+        #Filter the user with the user_name from database
+        db_user, _, _, error = resolve_path(user)
+        if error is not None:
+            return error
+        #The client may only change the version it has
+        error = precondition_failed(db_user.version)
+        if error is not None:
+            return error
         #validate schema from request body
         try:
-            validate(request.json, UserBuilder.user_schema())
+            schemas.validate("user", request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
         
@@ -212,23 +1019,39 @@ class UserItem(Resource):
 
         try:
             db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return create_error_response(412, "Precondition failed",
+                "The resource was changed by another request."
+            )
         except IntegrityError:
             return create_error_response(409, "Already exists", 
                 "User with handle '{}' already exists.".format(request.json["user_name"])
             )
 
+        invalidate_cache(UserItem, subtree=True, user=user)
         return Response(status=204, mimetype=MASON)
     
     def delete(self, user):
-        db_user = User.query.filter_by(user_name=user).first()
-        if db_user is None:
-            return create_error_response(404, "Not found", 
-                "No user was found with the user_name {}".format(user)
-            )
+        #Filter the user with the user_name from database
+        db_user, _, _, error = resolve_path(user)
+        if error is not None:
+            return error
+        #The client may only change the version it has
+        error = precondition_failed(db_user.version)
+        if error is not None:
+            return error
         
-        User.query.filter_by(user_name=user).delete()
-        db.session.commit()
+        try:
+            db.session.delete(db_user)
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return create_error_response(412, "Precondition failed",
+                "The resource was changed by another request."
+            )
 
+        invalidate_cache(UserItem, subtree=True, user=user)
         return Response(status=204, mimetype=MASON)
 
 
@@ -240,48 +1063,52 @@ POST: Allow us to add a new budget to database
 '''
 class BudgetCollection(Resource):
 
+    @cached_response
     def get(self, user):
         #Get all the budgets for this user and add them in items list
         #also add controls for every budget
 
-        #Filter the user with the user_name from database
-        db_user = User.query.filter_by(user_name=user).first()
-        if db_user is None:
-            return create_error_response(404, "Not found", 
-                "No user was found with the username {}".format(user)
-            )
+        #Read the columns of the user from database
+        row, error = read_path(user)
+        if error is not None:
+            return error
+        #Nothing to send if the client has the current version
+        resp = not_modified(row.user_version)
+        if resp is not None:
+            return resp
         #Get user budgtes
-        db_budgets = Budget.query.filter_by(user=db_user)
+        db_budgets = db.session.query(*BUDGET_COLUMNS).filter(Budget.user_id == row.user_id)
         body = BudgetBuilder(items=[])
-        for budget in db_budgets:
-            item = BudgetBuilder(
-                budget_name=budget.budget_name,
-                budget_amount=budget.budget_amount,
-                budget_description =budget.budget_description,
-                currency_type=budget.currency_type,
-                start_date=str(budget.start_date),
-                end_date=str(budget.end_date)
-            )
-            item.add_control("self", api.url_for(BudgetItem, user=user, budget=budget.budget_name))
-            item.add_control("profile", BUDGET_PROFILE)
-            body["items"].append(item)
+
+        def items():
+            for budget in db_budgets.yield_per(FETCH_SIZE):
+                item = BudgetBuilder(
+                    budget_name=budget.budget_name,
+                    budget_amount=budget.budget_amount,
+                    budget_description =budget.budget_description,
+                    currency_type=budget.currency_type,
+                    start_date=str(budget.start_date),
+                    end_date=str(budget.end_date)
+                )
+                item.add_control("self", resource_url(BudgetItem, user=user, budget=budget.budget_name))
+                item.add_control("profile", BUDGET_PROFILE)
+                yield item
         
         body.add_namespace("budtrack", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(BudgetCollection, user=user))
+        body.add_control("self", resource_url(BudgetCollection, user=user))
         body.add_control_add_budget(user)
 
-        resp = Response(json.dumps(body), status=200, mimetype=MASON)
-        resp.headers['Location'] = api.url_for(BudgetCollection, user=user)
+        resp = items_response(body, items())
+        resp.headers['Location'] = resource_url(BudgetCollection, user=user)
+        resp.set_etag(row.user_version)
         return resp
 
     def post(self, user):
 
         #Filter the user with the user_name from database
-        db_user = User.query.filter_by(user_name=user).first()
-        if db_user is None:
-            return create_error_response(404, "Not found", 
-                "No user was found with the username {}".format(user)
-            )
+        db_user, _, _, error = resolve_path(user)
+        if error is not None:
+            return error
 
         #Check valid json
         if not request.json:
@@ -290,7 +1117,7 @@ class BudgetCollection(Resource):
                 )
         #Validate againsta the schema
         try:
-            validate(request.json, BudgetBuilder.budget_schema())
+            schemas.validate("budget", request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
         
@@ -314,8 +1141,10 @@ class BudgetCollection(Resource):
                 "Budget with name '{}' already exists.".format(request.json["budget_name"])
             )
 
+        invalidate_cache(UserItem, user=user)
+        invalidate_cache(BudgetCollection, user=user)
         return Response(status=201, headers={
-            "Location": api.url_for(BudgetItem, user=user, budget=request.json["budget_name"])})
+            "Location": resource_url(BudgetItem, user=user, budget=request.json["budget_name"])})
 
 
 '''
@@ -329,59 +1158,68 @@ POST: Allow us to add an expense to the budget
 
 class BudgetItem(Resource):
     
+    @cached_response
     def get(self, user, budget):
-        #Filter the user with the user_name from database
-        db_user = User.query.filter_by(user_name=user).first()
-        if db_user is None:
-            return create_error_response(404, "Not found", 
-                "No user was found with the username {}".format(user)
-            )
-        
-        #Filter the budget with user and budget name
-        db_budget = Budget.query.filter_by(user=db_user,budget_name=budget).first()
-        if db_budget is None:
-            return create_error_response(404, "Not found", 
-                "No Budget was found with the name {}".format(budget)
-            )
+        #Read the filters of the expenses, they become the WHERE, ORDER BY
+        #and LIMIT of the expense query. Only a preview page of the expenses
+        #is embedded, the rest are in the expense collection
+        try:
+            filters = parse_expense_filters()
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+        filters.setdefault("sort", "expense_date")
+        filters["limit"] = min(filters.get("limit", EXPENSE_PREVIEW_SIZE), EXPENSE_PREVIEW_SIZE)
+
+        #Read the columns of the user and budget with one joined query
+        row, error = read_path(user, budget)
+        if error is not None:
+            return error
+        #Nothing to send if the client has the current version
+        resp = not_modified(row.budget_version)
+        if resp is not None:
+            return resp
         
         body = BudgetBuilder(
-                budget_name=db_budget.budget_name,
-                budget_amount=db_budget.budget_amount,
-                budget_description =db_budget.budget_description,
-                currency_type=db_budget.currency_type,
-                start_date=str(db_budget.start_date),
-                end_date=str(db_budget.end_date),
+                budget_name=row.budget_name,
+                budget_amount=row.budget_amount,
+                budget_description =row.budget_description,
+                currency_type=row.currency_type,
+                start_date=str(row.start_date),
+                end_date=str(row.end_date),
                 items=[]
         )
 
-        #Get all the expenses assosiated with this budget
-        db_expenses = Expense.query.filter_by(budget=db_budget).all()
-        if db_expenses:
+        #Get the first expenses assosiated with this budget
+        db_expenses = filter_expenses(db.session.query(*EXPENSE_COLUMNS)
+            .filter(Expense.budget_id == row.budget_id), filters)
+
+        def items():
             for expense in db_expenses:
-                item = ExpenseBuilder(
-                    expense_name=expense.expense_name,
-                    expense_description=expense.expense_description,
-                    expense_amount=expense.expense_amount,
-                    expense_date=str(expense.expense_date),
-                )
-                item.add_control("self", api.url_for(ExpenseItem, user=user, budget=budget, expense=expense.expense_name))
-                item.add_control("profile", EXPENSE_PROFILE)
-                body["items"].append(item)
+                yield expense_item(expense, user, budget)
 
         #Add the hyper media controls
         body.add_namespace("budtrack", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(BudgetItem, user=user, budget=budget))
+        body.add_control("self", resource_url(BudgetItem, user=user, budget=budget))
         body.add_control("profile", BUDGET_PROFILE)
-        body.add_control("author",api.url_for(UserItem, user=user))
-        body.add_control("user-all",api.url_for(UserCollection))
+        body.add_control("author",resource_url(UserItem, user=user))
+        body.add_control("user-all",resource_url(UserCollection))
         body.add_control_edit_budget(user,budget)
         body.add_control_delete_budget(user,budget)
         body.add_control("budtrack:budget-by",
-            api.url_for(BudgetCollection, user=user)
+            resource_url(BudgetCollection, user=user)
         )
         body.add_control_add_budget_expense(user,budget)
+        body.add_control_add_budget_expenses(user,budget)
+        body.add_control("budtrack:expenses",
+            resource_url(ExpenseCollection, user=user, budget=budget)
+        )
+        body.add_control("budtrack:summary",
+            resource_url(BudgetSummary, user=user, budget=budget)
+        )
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        resp = items_response(body, items())
+        resp.set_etag(row.budget_version)
+        return resp
     
     #This post method will add the expense in this budget
     def post(self, user, budget):
@@ -391,23 +1229,14 @@ class BudgetItem(Resource):
                 "Requests must be JSON"
                 )
 
-        #Filter the user with the user_name from database
-        db_user = User.query.filter_by(user_name=user).first()
-        if db_user is None:
-            return create_error_response(404, "Not found", 
-                "No user was found with the username {}".format(user)
-            )
-        
-        #Filter the budget with user and budget name
-        db_budget = Budget.query.filter_by(user=db_user, budget_name=budget).first()
-        if db_budget is None:
-            return create_error_response(404, "Not found", 
-                "No Budget was found with the name {}".format(budget)
-            )
+        #Load the user and budget with one joined query
+        db_user, db_budget, _, error = resolve_path(user, budget)
+        if error is not None:
+            return error
 
         #Validate againsta the expense schema
         try:
-            validate(request.json, ExpenseBuilder.expense_schema())
+            schemas.validate("expense", request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
         
@@ -429,8 +1258,9 @@ class BudgetItem(Resource):
                 "Expense with name '{}' already exists.".format(request.json["expense_name"])
             )
 
+        invalidate_cache(BudgetItem, subtree=True, user=user, budget=budget)
         return Response(status=201, headers={
-            "Location": api.url_for(BudgetItem, user=user, budget=budget) + request.json["expense_name"]+'/'})
+            "Location": resource_url(BudgetItem, user=user, budget=budget) + request.json["expense_name"]+'/'})
 
     
     def put(self, user, budget):
@@ -440,23 +1270,18 @@ class BudgetItem(Resource):
                 "Requests must be JSON"
                 )
         
-        #Filter the user with the user_name from database
-        db_user = User.query.filter_by(user_name=user).first()
-        if db_user is None:
-            return create_error_response(404, "Not found", 
-                "No user was found with the username {}".format(user)
-            )
-        
-        #Filter the budget with user and budget name
-        db_budget = Budget.query.filter_by(user=db_user, budget_name=budget).first()
-        if db_budget is None:
-            return create_error_response(404, "Not found", 
-                "No Budget was found with the name {}".format(budget)
-            )
+        #Load the user and budget with one joined query
+        db_user, db_budget, _, error = resolve_path(user, budget)
+        if error is not None:
+            return error
+        #The client may only change the version it has
+        error = precondition_failed(db_budget.version)
+        if error is not None:
+            return error
 
         #validate schema from request body
         try:
-            validate(request.json, BudgetBuilder.budget_schema())
+            schemas.validate("budget", request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
         
@@ -471,34 +1296,257 @@ class BudgetItem(Resource):
 
         try:
             db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return create_error_response(412, "Precondition failed",
+                "The resource was changed by another request."
+            )
         except IntegrityError:
             return create_error_response(409, "Already exists", 
                 "Budget with name '{}' already exists.".format(request.json["budget_name"])
             )
 
+        invalidate_cache(UserItem, user=user)
+        invalidate_cache(BudgetCollection, user=user)
+        invalidate_cache(BudgetItem, subtree=True, user=user, budget=budget)
         return Response(status=204, mimetype=MASON)
     
     def delete(self, user, budget):
 
-         #Filter the user with the user_name from database
-        db_user = User.query.filter_by(user_name=user).first()
-        if db_user is None:
-            return create_error_response(404, "Not found", 
-                "No user was found with the username {}".format(user)
-            )
+        #Load the user and budget with one joined query
+        db_user, db_budget, _, error = resolve_path(user, budget)
+        if error is not None:
+            return error
+        #The client may only change the version it has
+        error = precondition_failed(db_budget.version)
+        if error is not None:
+            return error
         
-        #Filter the budget with user and budget name
-        db_budget = Budget.query.filter_by(user=db_user, budget_name=budget).first()
-        if db_budget is None:
-            return create_error_response(404, "Not found", 
-                "No Budget was found with the name {}".format(budget)
+        try:
+            db.session.delete(db_budget)
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return create_error_response(412, "Precondition failed",
+                "The resource was changed by another request."
             )
-        
-        Budget.query.filter_by(user=db_user, budget_name=budget).delete()
-        db.session.commit()
 
+        invalidate_cache(UserItem, user=user)
+        invalidate_cache(BudgetCollection, user=user)
+        invalidate_cache(BudgetItem, subtree=True, user=user, budget=budget)
         return Response(status=204, mimetype=MASON)
 
+'''
+Budget summary
+It has one method
+GET: Give us the spending of the budget, the totals and the spending per day
+and per month. The totals are the running totals of the budget and the
+breakdowns are aggregated by the database.
+'''
+
+class BudgetSummary(Resource):
+
+    @cached_response
+    def get(self, user, budget):
+        #Read the columns of the user and budget with one joined query
+        row, error = read_path(user, budget)
+        if error is not None:
+            return error
+        #Nothing to send if the client has the current version
+        resp = not_modified(row.budget_version)
+        if resp is not None:
+            return resp
+
+        #The totals are kept on the budget row, only the breakdowns
+        #need to be aggregated
+        body = BudgetBuilder(
+            budget_name=row.budget_name,
+            budget_amount=row.budget_amount,
+            currency_type=row.currency_type,
+            spent_amount=row.spent_amount,
+            remaining_amount=row.budget_amount - row.spent_amount,
+            expense_count=row.expense_count,
+            last_expense_date=str(row.last_expense_date) if row.last_expense_date else None,
+            daily=spending_by_period(row.budget_id, "day"),
+            monthly=spending_by_period(row.budget_id, "month")
+        )
+
+        #Add the hyper media controls
+        body.add_namespace("budtrack", LINK_RELATIONS_URL)
+        body.add_control("self", resource_url(BudgetSummary, user=user, budget=budget))
+        body.add_control("profile", SUMMARY_PROFILE)
+        body.add_control("up", resource_url(BudgetItem, user=user, budget=budget))
+
+        resp = Response(dump_json(body), 200, mimetype=MASON)
+        resp.set_etag(row.budget_version)
+        return resp
+
+'''
+Expense collection
+It has one method
+GET: Give us one page of the expenses of the budget, filtered and sorted like
+the expenses of the budget item
+'''
+
+class ExpenseCollection(Resource):
+
+    @cached_response
+    def get(self, user, budget):
+        #Get one page of the expenses. Pages are keyset paginated on the
+        #sort column and the expense id, "after" is an opaque cursor to the
+        #last expense of the previous page
+        try:
+            filters = parse_expense_filters()
+            filters.setdefault("sort", "expense_date")
+            limit = filters.pop("limit", EXPENSE_PAGE_SIZE)
+            after = request.args.get("after")
+            if after is not None:
+                after = decode_cursor(after, filters["sort"])
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        #Read the columns of the user and budget with one joined query
+        row, error = read_path(user, budget)
+        if error is not None:
+            return error
+        #Nothing to send if the client has the current version
+        resp = not_modified(row.budget_version)
+        if resp is not None:
+            return resp
+
+        query = filter_expenses(db.session.query(*EXPENSE_COLUMNS)
+            .filter(Expense.budget_id == row.budget_id), filters)
+        if after is not None:
+            query = query.filter(after_cursor(filters["sort"], *after))
+
+        collection_url = resource_url(ExpenseCollection, user=user, budget=budget)
+        body = ExpenseBuilder(items=[])
+        body.add_namespace("budtrack", LINK_RELATIONS_URL)
+        body.add_control("self", collection_url)
+        body.add_control("up", resource_url(BudgetItem, user=user, budget=budget))
+        body.add_control_filter_expenses(user, budget)
+
+        def items():
+            #Fetch one row more than the page size to know if there is a
+            #next page
+            sort_name = filters["sort"].lstrip("-")
+            last = None
+            for index, expense in enumerate(query.limit(limit + 1).yield_per(FETCH_SIZE)):
+                if index == limit:
+                    body.add_control("next", page_url(collection_url,
+                        after=encode_cursor(filters["sort"], getattr(last, sort_name), last.expense_id)))
+                    break
+                last = expense
+                yield expense_item(expense, user, budget)
+
+        resp = items_response(body, items())
+        resp.set_etag(row.budget_version)
+        return resp
+
+'''
+Expense batch
+It has one method
+POST: Allow us to add many expenses to the budget at once, the body is either
+a JSON array of expenses or an NDJSON stream with one expense per line
+'''
+
+class ExpenseBatch(Resource):
+
+    def post(self, user, budget):
+        #Load the user and budget with one joined query
+        db_user, db_budget, _, error = resolve_path(user, budget)
+        if error is not None:
+            return error
+
+        #Read the expenses from a JSON array or an NDJSON stream
+        if request.mimetype == NDJSON:
+            documents = read_ndjson(request.stream)
+        elif request.is_json and isinstance(request.json, list):
+            documents = request.json
+        elif request.is_json:
+            return create_error_response(400, "Invalid JSON document",
+                "Batch must be an array of expenses"
+                )
+        else:
+            return create_error_response(415, "Unsupported media type",
+                "Requests must be JSON or NDJSON"
+                )
+
+        #Validate everything in one pass, every document gets a result
+        #and only the valid ones are turned into rows
+        results = []
+        rows = {}
+        for index, document in enumerate(documents):
+            result = ExpenseBuilder(index=index)
+            results.append(result)
+            try:
+                if isinstance(document, ValueError):
+                    raise document
+                schemas.validate("expense", document)
+                result["expense_name"] = document["expense_name"]
+                expense_date = ConverToDatetime(document["expense_date"])
+            except (ValidationError, ValueError) as e:
+                result.add_error("Invalid JSON document", str(e))
+                result["status"] = 400
+                continue
+
+            if document["expense_name"] in rows:
+                result.add_error("Already exists", 
+                    "Expense with name '{}' is repeated in the batch.".format(document["expense_name"])
+                )
+                result["status"] = 409
+                continue
+            rows[document["expense_name"]] = (result, {
+                "expense_name": document["expense_name"],
+                "expense_description": document["expense_description"],
+                "expense_amount": document["expense_amount"],
+                "expense_date": expense_date,
+                "version": new_version(),
+                "budget_id": db_budget.id
+            })
+
+        #Expenses that already exist in the budget are conflicts
+        names = list(rows)
+        for start in range(0, len(names), BATCH_LOOKUP_SIZE):
+            existing = db.session.query(Expense.expense_name).filter(
+                Expense.budget_id == db_budget.id,
+                Expense.expense_name.in_(names[start:start + BATCH_LOOKUP_SIZE])
+            )
+            for (name, ) in existing:
+                result, row = rows.pop(name)
+                result.add_error("Already exists", 
+                    "Expense with name '{}' already exists.".format(name)
+                )
+                result["status"] = 409
+
+        #Insert the rest with a single executemany in one transaction
+        try:
+            if rows:
+                db.session.execute(Expense.__table__.insert(),
+                    [row for result, row in rows.values()])
+                #Bulk inserts skip the ORM events, update the totals here
+                adjust_budget_totals(db.session.connection(), db_budget.id,
+                    sum(row["expense_amount"] for result, row in rows.values()),
+                    len(rows))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return create_error_response(409, "Already exists", 
+                "The budget was changed while the batch was added, nothing was added."
+            )
+
+        if rows:
+            invalidate_cache(BudgetItem, subtree=True, user=user, budget=budget)
+        for name, (result, row) in rows.items():
+            result["status"] = 201
+            result.add_control("self", resource_url(ExpenseItem, user=user, budget=budget, expense=name))
+        
+        body = ExpenseBuilder(items=results)
+        body.add_namespace("budtrack", LINK_RELATIONS_URL)
+        body.add_control("self", resource_url(ExpenseBatch, user=user, budget=budget))
+        body.add_control("up", resource_url(BudgetItem, user=user, budget=budget))
+        return Response(dump_json(body), 200, mimetype=MASON)
+
 '''
 Expense item 
 It has three methods 
@@ -509,48 +1557,39 @@ DELETE: Allow us to delete the expense
 
 class ExpenseItem(Resource):
     
+    @cached_response
     def get(self, user, budget, expense):
-        #Filter the user with the user_name from database
-        db_user = User.query.filter_by(user_name=user).first()
-        if db_user is None:
-            return create_error_response(404, "Not found", 
-                "No user was found with the username {}".format(user)
-            )
-        
-        #Filter the budget with user and budget name
-        db_budget = Budget.query.filter_by(user=db_user, budget_name=budget).first()
-        if db_budget is None:
-            return create_error_response(404, "Not found", 
-                "No Budget was found with the name {}".format(budget)
-            )
-        
-        #Filter the expense budget and expense name
-        db_expense = Expense.query.filter_by(budget=db_budget, expense_name=expense).first()
-        if db_expense is None:
-            return create_error_response(404, "Not found", 
-                "No Expense was found with the name {}".format(expense)
-            )
+        #Read the columns of the user, budget and expense with one joined query
+        row, error = read_path(user, budget, expense)
+        if error is not None:
+            return error
+        #Nothing to send if the client has the current version
+        resp = not_modified(row.expense_version)
+        if resp is not None:
+            return resp
         
         body = ExpenseBuilder(
-            expense_name=db_expense.expense_name,
-            expense_description=db_expense.expense_description,
-            expense_amount=db_expense.expense_amount,
-            expense_date=str(db_expense.expense_date),
+            expense_name=row.expense_name,
+            expense_description=row.expense_description,
+            expense_amount=row.expense_amount,
+            expense_date=str(row.expense_date),
         )
         
         #Add the hyper media controls
         body.add_namespace("budtrack", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(ExpenseItem, user=user, budget=budget, expense=expense))
+        body.add_control("self", resource_url(ExpenseItem, user=user, budget=budget, expense=expense))
         body.add_control("profile", EXPENSE_PROFILE)
-        body.add_control("author",api.url_for(UserItem, user=user))
-        body.add_control("up",api.url_for(BudgetItem, user=user, budget=budget))
+        body.add_control("author",resource_url(UserItem, user=user))
+        body.add_control("up",resource_url(BudgetItem, user=user, budget=budget))
         body.add_control_edit_expense(user,budget,expense)
         body.add_control_delete_expense(user,budget,expense)
         body.add_control("budtrack:budget-by",
-            api.url_for(BudgetCollection, user=user)
+            resource_url(BudgetCollection, user=user)
         )
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        resp = Response(dump_json(body), 200, mimetype=MASON)
+        resp.set_etag(row.expense_version)
+        return resp
     
     def put(self, user, budget, expense):
         #check if valid json
@@ -559,30 +1598,18 @@ class ExpenseItem(Resource):
                 "Requests must be JSON"
                 )
         
-        #Filter the user with the user_name from database
-        db_user = User.query.filter_by(user_name=user).first()
-        if db_user is None:
-            return create_error_response(404, "Not found", 
-                "No user was found with the username {}".format(user)
-            )
-        
-        #Filter the budget with user and budget name
-        db_budget = Budget.query.filter_by(user=db_user, budget_name=budget).first()
-        if db_budget is None:
-            return create_error_response(404, "Not found", 
-                "No Budget was found with the name {}".format(budget)
-            )
-        
-        #Filter the expense budget and expense name
-        db_expense = Expense.query.filter_by(budget=db_budget, expense_name=expense).first()
-        if db_expense is None:
-            return create_error_response(404, "Not found", 
-                "No Expense was found with the name {}".format(expense)
-            )
+        #Load the user, budget and expense with one joined query
+        db_user, db_budget, db_expense, error = resolve_path(user, budget, expense)
+        if error is not None:
+            return error
+        #The client may only change the version it has
+        error = precondition_failed(db_expense.version)
+        if error is not None:
+            return error
 
         #validate schema from request body
         try:
-            validate(request.json, ExpenseBuilder.expense_schema())
+            schemas.validate("expense", request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
         
@@ -595,65 +1622,1083 @@ class ExpenseItem(Resource):
 
         try:
             db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return create_error_response(412, "Precondition failed",
+                "The resource was changed by another request."
+            )
         except IntegrityError:
             return create_error_response(409, "Already exists", 
                 "Expense with name '{}' already exists.".format(request.json["expense_name"])
             )
 
+        invalidate_cache(BudgetItem, subtree=True, user=user, budget=budget)
         return Response(status=204, mimetype=MASON)
     
     def delete(self, user, budget, expense):
 
-         #Filter the user with the user_name from database
-        db_user = User.query.filter_by(user_name=user).first()
-        if db_user is None:
-            return create_error_response(404, "Not found", 
-                "No user was found with the username {}".format(user)
-            )
-        
-        #Filter the budget with user and budget name
-        db_budget = Budget.query.filter_by(user=db_user, budget_name=budget).first()
-        if db_budget is None:
-            return create_error_response(404, "Not found", 
-                "No Budget was found with the name {}".format(budget)
-            )
+        #Load the user, budget and expense with one joined query
+        db_user, db_budget, db_expense, error = resolve_path(user, budget, expense)
+        if error is not None:
+            return error
+        #The client may only change the version it has
+        error = precondition_failed(db_expense.version)
+        if error is not None:
+            return error
         
-        #Filter the expense budget and expense name
-        db_expense = Expense.query.filter_by(budget=db_budget, expense_name=expense).first()
-        if db_expense is None:
-            return create_error_response(404, "Not found", 
-                "No Expense was found with the name {}".format(expense)
+        try:
+            db.session.delete(db_expense)
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return create_error_response(412, "Precondition failed",
+                "The resource was changed by another request."
             )
-        
-        Expense.query.filter_by(budget=db_budget, expense_name=expense).delete()
-        db.session.commit()
 
+        invalidate_cache(BudgetItem, subtree=True, user=user, budget=budget)
         return Response(status=204, mimetype=MASON)
 
 
 
+'''
+Spending report
+It has one method
+GET: Give us the spending of a user across all of its budgets per day, week or
+month, one row per period and currency. The sums are aggregated by the
+database with one grouped query. Clients that accept NDJSON or CSV get the
+rows streamed in that format instead of a Mason document.
+'''
+
+class SpendingReport(Resource):
+
+    def get(self, user):
+        try:
+            filters, bucket = parse_report_filters()
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        #Read the columns of the user from database
+        row, error = read_path(user)
+        if error is not None:
+            return error
+
+        #The rows are fetched from the cursor while they are sent
+        rows = spending_report(row.user_id, filters, bucket).yield_per(FETCH_SIZE)
+        columns = (bucket, "currency_type", "spent_amount", "expense_count")
+        #The format depends on the Accept header, caches have to know that
+        mimetype = request.accept_mimetypes.best_match((MASON, NDJSON, CSV), MASON)
+        if mimetype == NDJSON:
+            items = (dict(zip(columns, row)) for row in rows)
+            return Response(stream_with_context(stream_ndjson(items)), 200,
+                mimetype=NDJSON, headers={"Vary": "Accept"})
+        if mimetype == CSV:
+            return Response(stream_with_context(stream_csv(columns, rows)), 200,
+                mimetype=CSV, headers={"Vary": "Accept"})
+
+        body = MasonBuilder(user_name=row.user_name, bucket=bucket, items=[])
+        for name in ("from", "to"):
+            if name in filters:
+                body[name] = request.args[name]
+        body.add_namespace("budtrack", LINK_RELATIONS_URL)
+        body.add_control("self", page_url(resource_url(SpendingReport, user=user)))
+        body.add_control("profile", REPORT_PROFILE)
+        body.add_control("up", resource_url(UserItem, user=user))
+        resp = items_response(body, (dict(zip(columns, row)) for row in rows))
+        resp.vary.add("Accept")
+        return resp
+
+def resolve_path(user, budget=None, expense=None):
+    """
+    Loads a user and, when their names are given, one of its budgets and one
+    of that budget's expenses with a single joined SELECT. Missing levels are
+    outer joined so that the right 404 can still be returned for the first
+    level that does not exist.
+
+    Returns a tuple (user, budget, expense, error). The levels that were not
+    asked for are None, and error is a ready 404 response or None if
+    everything was found.
+
+    : param str user: user_name of the user
+    : param str budget: budget_name of the budget, optional
+    : param str expense: expense_name of the expense, optional
+    """
+
+    query = db.session.query(User)
+    if budget is not None:
+        query = query.add_entity(Budget).outerjoin(Budget, and_(
+            Budget.user_id == User.id, Budget.budget_name == budget))
+        if expense is not None:
+            query = query.add_entity(Expense).outerjoin(Expense, and_(
+                Expense.budget_id == Budget.id, Expense.expense_name == expense))
+    row = query.filter(User.user_name == user).first()
+
+    if row is None:
+        return None, None, None, path_not_found(user)
+    if budget is None:
+        return row, None, None, None
+
+    db_user, db_budget = row[0], row[1]
+    if db_budget is None:
+        return db_user, None, None, path_not_found(user, budget)
+    if expense is None:
+        return db_user, db_budget, None, None
+
+    db_expense = row[2]
+    if db_expense is None:
+        return db_user, db_budget, None, path_not_found(user, budget, expense)
+    return db_user, db_budget, db_expense, None
+
+def read_path(user, budget=None, expense=None):
+    """
+    Read-only version of resolve_path for the GET handlers. Reads the columns
+    of the user and, when their names are given, of the budget and the
+    expense into one row with the same joined SELECT, without making ORM
+    objects of them.
+
+    Returns a tuple (row, error). The row has the columns of USER_COLUMNS,
+    BUDGET_COLUMNS and EXPENSE_COLUMNS for the levels that were asked for, and
+    error is a ready 404 response or None if everything was found.
+
+    : param str user: user_name of the user
+    : param str budget: budget_name of the budget, optional
+    : param str expense: expense_name of the expense, optional
+    """
+
+    query = db.session.query(*USER_COLUMNS)
+    if budget is not None:
+        query = query.add_columns(*BUDGET_COLUMNS).outerjoin(Budget, and_(
+            Budget.user_id == User.id, Budget.budget_name == budget))
+        if expense is not None:
+            query = query.add_columns(*EXPENSE_COLUMNS).outerjoin(Expense, and_(
+                Expense.budget_id == Budget.id, Expense.expense_name == expense))
+    row = query.filter(User.user_name == user).first()
+
+    if row is None:
+        return None, path_not_found(user)
+    if budget is not None and row.budget_id is None:
+        return None, path_not_found(user, budget)
+    if expense is not None and row.expense_id is None:
+        return None, path_not_found(user, budget, expense)
+    return row, None
+
+def path_not_found(user, budget=None, expense=None):
+    """
+    Makes the 404 response for a resource path whose last given level does
+    not exist.
+
+    : param str user: user_name of the user
+    : param str budget: budget_name of the budget, optional
+    : param str expense: expense_name of the expense, optional
+    """
+
+    if expense is not None:
+        message = "No Expense was found with the name {}".format(expense)
+    elif budget is not None:
+        message = "No Budget was found with the name {}".format(budget)
+    else:
+        message = "No user was found with the username {}".format(user)
+    return create_error_response(404, "Not found", message)
+
+def expense_item(row, user, budget):
+    """
+    Makes the item of an expense listing from a row of EXPENSE_COLUMNS.
+
+    : param row: the columns of the expense
+    : param str user: user_name of the user
+    : param str budget: budget_name of the budget
+    """
+
+    item = ExpenseBuilder(
+        expense_name=row.expense_name,
+        expense_description=row.expense_description,
+        expense_amount=row.expense_amount,
+        expense_date=str(row.expense_date),
+    )
+    item.add_control("self", resource_url(ExpenseItem, user=user, budget=budget, expense=row.expense_name))
+    item.add_control("profile", EXPENSE_PROFILE)
+    return item
+
+def spending_by_period(budget_id, bucket):
+    """
+    Sums the expenses of a budget per period with a GROUP BY in the database.
+    Returns a list of dicts with the period, the amount spent and the number of
+    expenses, ordered by period.
+
+    : param int budget_id: id of the budget
+    : param str bucket: name of the period, one of BUCKET_PERIODS
+    """
+
+    period = BUCKET_PERIODS[bucket](Expense.expense_date)
+    rows = db.session.query(
+        period,
+        func.sum(Expense.expense_amount),
+        func.count(Expense.id)
+    ).filter(Expense.budget_id == budget_id).group_by(period).order_by(period)
+    return [
+        {bucket: key, "spent_amount": spent, "expense_count": count}
+        for key, spent, count in rows
+    ]
+
+def spending_report(user_id, filters, bucket):
+    """
+    Sums the expenses of every budget of a user per period and currency with
+    one GROUP BY query joining the budgets and their expenses. Returns the
+    query, ordered by period and currency, so its rows can be fetched while
+    they are sent.
+
+    : param int user_id: id of the user
+    : param dict filters: "from" and "to" dates from parse_report_filters
+    : param str bucket: name of the period, one of BUCKET_PERIODS
+    """
+
+    period = BUCKET_PERIODS[bucket](Expense.expense_date)
+    query = db.session.query(
+        period,
+        Budget.currency_type,
+        func.sum(Expense.expense_amount),
+        func.count(Expense.id)
+    ).select_from(Expense).join(Budget, Budget.id == Expense.budget_id) \
+        .filter(Budget.user_id == user_id)
+    return filter_expenses(query, filters) \
+        .group_by(period, Budget.currency_type).order_by(period, Budget.currency_type)
+
+def not_modified(version):
+    """
+    Returns an empty 304 response if the If-None-Match header of the request
+    matches the version of the resource, None otherwise.
+
+    : param str version: current version of the resource, used as its ETag
+    """
+
+    if request.if_none_match.contains_weak(version):
+        resp = Response(status=304)
+        resp.set_etag(version)
+        return resp
+    return None
+
+def precondition_failed(version):
+    """
+    Returns a 412 error response if the request has an If-Match header that
+    does not match the version of the resource, None otherwise.
+
+    : param str version: current version of the resource, used as its ETag
+    """
+
+    if request.if_match and not request.if_match.contains(version):
+        return create_error_response(412, "Precondition failed",
+            "The resource has changed since it was fetched."
+        )
+    return None
+
 def create_error_response(status_code, title, message=None):
     resource_url = request.path
     body = MasonBuilder(resource_url=resource_url)
     body.add_error(title, message)
     body.add_control("profile", href=ERROR_PROFILE)
-    return Response(json.dumps(body), status_code, mimetype=MASON)
+    return Response(dump_json(body), status_code, mimetype=MASON)
+
+@click.command("rebuild-totals")
+@click.option("--verify", is_flag=True,
+    help="Only report the budgets whose totals have drifted.")
+@with_appcontext
+def rebuild_totals_command(verify):
+    """
+    Recomputes the running totals of every budget from its expenses and
+    repairs the ones that have drifted. With --verify nothing is changed and
+    the command fails if any budget has drifted.
+    """
+
+    totals = db.session.query(
+        Expense.budget_id.label("budget_id"),
+        func.sum(Expense.expense_amount).label("spent_amount"),
+        func.count(Expense.id).label("expense_count"),
+        func.max(Expense.expense_date).label("last_expense_date")
+    ).group_by(Expense.budget_id).subquery()
+    rows = db.session.query(
+        Budget.id, Budget.budget_name,
+        Budget.spent_amount, Budget.expense_count, Budget.last_expense_date,
+        func.coalesce(totals.c.spent_amount, 0),
+        func.coalesce(totals.c.expense_count, 0),
+        totals.c.last_expense_date
+    ).outerjoin(totals, totals.c.budget_id == Budget.id).all()
+
+    drifted = 0
+    budget = Budget.__table__
+    for (budget_id, name, spent, count, last_date,
+            real_spent, real_count, real_last_date) in rows:
+        if (abs(spent - real_spent) < 1e-6 and count == real_count
+                and last_date == real_last_date):
+            continue
+        drifted += 1
+        click.echo("Budget {} <{}>: spent {} != {}, count {} != {}, last expense {} != {}".format(
+            name, budget_id, spent, real_spent, count, real_count, last_date, real_last_date))
+        if not verify:
+            db.session.execute(budget.update().where(budget.c.id == budget_id).values(
+                spent_amount=real_spent,
+                expense_count=real_count,
+                last_expense_date=real_last_date,
+                version=new_version()
+            ))
+    db.session.commit()
+
+    click.echo("{} of {} budgets {}".format(drifted, len(rows),
+        "have drifted" if verify else "were repaired"))
+    if verify and drifted:
+        raise SystemExit(1)
+
+#Distributions of the number of budgets per user and expenses per budget made
+#by generate-data. Each is a function of a random generator and the mean.
+#pareto is heavy tailed, most parents get a few children and some get
+#hundreds of times the mean
+DISTRIBUTIONS = {
+    "fixed": lambda rng, mean: int(mean),
+    "uniform": lambda rng, mean: rng.randint(0, int(2 * mean)),
+    "pareto": lambda rng, mean: min(int(mean * rng.paretovariate(1.5) / 3), int(mean * 1000)),
+}
+#Rows sent to the database by one executemany, and rows written by one
+#transaction of generate-data
+GENERATE_CHUNK = 10000
+GENERATE_TRANSACTION_ROWS = 1000000
+#Columns written by generate-data, in the order of the tables
+GENERATE_COLUMNS = (
+    ("id", "user_name", "user_email", "password", "version"),
+    ("id", "budget_name", "budget_description", "budget_amount", "start_date", "end_date",
+        "currency_type", "spent_amount", "expense_count", "last_expense_date", "version",
+        "user_id"),
+    ("id", "expense_name", "expense_description", "expense_amount", "expense_date",
+        "version", "budget_id"),
+)
+
+def generate_data(connection, users, budgets_per_user, expenses_per_budget,
+        budget_distribution="uniform", expense_distribution="pareto",
+        start=datetime(2020, 1, 1), days=365, budget_days=30, seed=0,
+        chunk=GENERATE_CHUNK, transaction_rows=GENERATE_TRANSACTION_ROWS):
+    """
+    Generates users with budgets and expenses and inserts them into a SQLite
+    database after any rows already in it, in large transactions. The insert
+    statements are compiled once and the rows are passed to executemany of
+    the driver as tuples, with the dates already in the format SQLAlchemy
+    stores them in. The ORM events are skipped, so the running totals of the
+    budgets are computed here, and the versions come from the seeded random
+    generator. Budgets start on a random day of the days after start and
+    last budget_days, their expenses are spread evenly over that time.
+    Returns the numbers of users, budgets and expenses inserted.
+
+    : param connection: connection to insert with
+    : param int users: number of users
+    : param float budgets_per_user: mean number of budgets of a user
+    : param float expenses_per_budget: mean number of expenses of a budget
+    : param str budget_distribution: name of the distribution of the budgets
+    : param str expense_distribution: name of the distribution of the expenses
+    : param datetime start: first possible start date of a budget
+    : param int days: days over which the start dates are spread
+    : param int budget_days: length of a budget in days
+    : param int seed: seed of the random generator
+    : param int chunk: rows per executemany
+    : param int transaction_rows: rows per transaction
+    """
+
+    rng = random.Random(seed)
+    budget_count = DISTRIBUTIONS[budget_distribution]
+    expense_count = DISTRIBUTIONS[expense_distribution]
+    days = max(days, 1)
+    budget_days = max(budget_days, 1)
+    tables = (User.__table__, Budget.__table__, Expense.__table__)
+    statements = []
+    for table, columns in zip(tables, GENERATE_COLUMNS):
+        compiled = table.insert().compile(dialect=connection.dialect, column_keys=columns)
+        if tuple(compiled.positiontup) != columns:
+            raise ValueError("Unexpected insert statement {}".format(compiled))
+        statements.append(compiled.string)
+    next_ids = [connection.execute(select([func.coalesce(func.max(table.c.id), 0)])).scalar() + 1
+        for table in tables]
+    #Dates by days from start, as stored by the DateTime columns
+    dates = [(start + timedelta(days=day)).isoformat(" ", "microseconds")
+        for day in range(days + budget_days)]
+    pending = ([], [], [])
+    inserted = [0, 0, 0]
+    cursor = connection.connection.cursor()
+
+    def flush():
+        #Parents first, so the rows of a chunk never reference missing ones
+        for statement, rows in zip(statements, pending):
+            if rows:
+                cursor.executemany(statement, rows)
+                del rows[:]
+
+    def version():
+        return "%032x" % rng.getrandbits(128)
+
+    transaction = connection.begin()
+    written = 0
+    for _ in range(users):
+        user_id = next_ids[0]
+        next_ids[0] += 1
+        pending[0].append((user_id, "user-{}".format(user_id),
+            "user-{}@example.com".format(user_id), "generated", version()))
+        for budget_number in range(1, budget_count(rng, budgets_per_user) + 1):
+            budget_id = next_ids[1]
+            next_ids[1] += 1
+            first_day = rng.randrange(days)
+            count = expense_count(rng, expenses_per_budget)
+            spent, last = 0, -1
+            for expense_number in range(1, count + 1):
+                amount = round(rng.lognormvariate(3, 1), 2)
+                day = first_day + rng.randrange(budget_days)
+                spent += amount
+                last = max(last, day)
+                pending[2].append((next_ids[2], "expense-{}".format(expense_number),
+                    "generated", amount, dates[day], version(), budget_id))
+                next_ids[2] += 1
+            pending[1].append((budget_id, "budget-{}".format(budget_number), "generated",
+                round(rng.uniform(0.5, 1.5) * 20 * expenses_per_budget, -1),
+                dates[first_day], dates[first_day + budget_days - 1], "euro",
+                spent, count, dates[last] if count else None, version(), user_id))
+            inserted[1] += 1
+            inserted[2] += count
+            written += count + 1
+            if len(pending[2]) >= chunk or len(pending[1]) >= chunk:
+                flush()
+        inserted[0] += 1
+        written += 1
+        if len(pending[0]) >= chunk:
+            flush()
+        if written >= transaction_rows:
+            flush()
+            transaction.commit()
+            transaction = connection.begin()
+            written = 0
+    flush()
+    transaction.commit()
+    cursor.close()
+    return tuple(inserted)
+
+def load_generated_data(app, *args, **kwargs):
+    """
+    Runs generate_data on one connection of a separate instance of the app
+    that uses the bulk pragma profile, creating the tables first if needed.
+    The connections of the app are closed first, since the journal mode can
+    only be changed by the only connection to the database, and the load
+    locks the database until it is done. Arguments after app are passed on
+    to generate_data.
+
+    : param Flask app: the app whose database is loaded
+    """
+
+    #The session is per thread, so it is started over for the other instance
+    db.session.remove()
+    db.get_engine(app).dispose()
+    bulk_app = create_app(dict(app.config, SQLITE_PRAGMA_PROFILE="bulk"))
+    with bulk_app.app_context():
+        engine = db.engine
+        try:
+            with engine.connect() as connection:
+                db.metadata.create_all(connection)
+                return generate_data(connection, *args, **kwargs)
+        finally:
+            db.session.remove()
+            engine.dispose()
+
+@click.command("generate-data")
+@click.option("--users", default=1000, show_default=True, help="Number of users.")
+@click.option("--budgets-per-user", default=10.0, show_default=True,
+    help="Mean number of budgets of a user.")
+@click.option("--expenses-per-budget", default=100.0, show_default=True,
+    help="Mean number of expenses of a budget.")
+@click.option("--budget-distribution", type=click.Choice(sorted(DISTRIBUTIONS)),
+    default="uniform", show_default=True, help="Distribution of the budgets per user.")
+@click.option("--expense-distribution", type=click.Choice(sorted(DISTRIBUTIONS)),
+    default="pareto", show_default=True, help="Distribution of the expenses per budget.")
+@click.option("--start", default="2020-01-01", show_default=True,
+    help="First start date of a budget, yyyy-mm-dd.")
+@click.option("--days", default=365, show_default=True,
+    help="Days over which the start dates of the budgets are spread.")
+@click.option("--budget-days", default=30, show_default=True, help="Length of a budget in days.")
+@click.option("--seed", default=0, show_default=True, help="Seed of the random generator.")
+@with_appcontext
+def generate_data_command(users, budgets_per_user, expenses_per_budget, budget_distribution,
+        expense_distribution, start, days, budget_days, seed):
+    """
+    Adds generated users, budgets and expenses to the database, for
+    benchmarks and capacity planning. Nothing else should use the database
+    while they are loaded.
+    """
+
+    started = time.perf_counter()
+    counts = load_generated_data(current_app._get_current_object(), users, budgets_per_user,
+        expenses_per_budget, budget_distribution, expense_distribution,
+        ConverToDatetime(start), days, budget_days, seed)
+    click.echo("Added {} users, {} budgets and {} expenses in {:.1f} s".format(
+        *counts, time.perf_counter() - started))
+
+#Requests made by audit-queries, together they use every method of every
+#resource. They run in this order against the database from _populate_audit_db
+AUDIT_REQUESTS = [
+    ("GET", "/api/", None),
+    ("GET", "/api/users/", None),
+    ("GET", "/api/users/?after=1&limit=1", None),
+    ("GET", "/api/users/?before=2&limit=1", None),
+    ("POST", "/api/users/", {"user_name": "audit-2", "user_email": "audit@2", "password": "abc"}),
+    ("GET", "/api/users/audit-1/", None),
+    ("PUT", "/api/users/audit-2/", {"user_name": "audit-2", "user_email": "audit@3", "password": "abc"}),
+    ("GET", "/api/users/audit-1/budgets", None),
+    ("POST", "/api/users/audit-1/budgets", {"budget_name": "budget-2", "budget_description": "audit",
+        "budget_amount": 100, "currency_type": "euro", "start_date": "2020-01-01", "end_date": "2020-01-31"}),
+    ("GET", "/api/users/audit-1/budgets/budget-1", None),
+    ("GET", "/api/users/audit-1/budgets/budget-1?from=2020-01-01&to=2020-01-31&min_amount=5"
+        "&max_amount=50&sort=-expense_amount&limit=10", None),
+    ("PUT", "/api/users/audit-1/budgets/budget-2", {"budget_name": "budget-2", "budget_description": "audit",
+        "budget_amount": 200, "currency_type": "euro", "start_date": "2020-01-01", "end_date": "2020-01-31"}),
+    ("POST", "/api/users/audit-1/budgets/budget-1", {"expense_name": "expense-2",
+        "expense_description": "audit", "expense_amount": 10, "expense_date": "2020-01-02"}),
+    ("POST", "/api/users/audit-1/budgets/budget-1/expenses:batch", [{"expense_name": "expense-3",
+        "expense_description": "audit", "expense_amount": 10, "expense_date": "2020-01-03"}]),
+    ("GET", "/api/users/audit-1/budgets/budget-1/summary", None),
+    ("GET", "/api/users/audit-1/budgets/budget-1/expenses/?limit=1", None),
+    #The cursor is the one of expense-1 in the default sort order
+    ("GET", "/api/users/audit-1/budgets/budget-1/expenses/?limit=1"
+        "&after=WyJleHBlbnNlX2RhdGUiLCAiMjAyMC0wMS0wMVQwMDowMDowMCIsIDFd", None),
+    ("GET", "/api/users/audit-1/budgets/budget-1/expense-1", None),
+    ("GET", "/api/users/audit-1/reports/spending?from=2020-01-01&to=2020-01-31&bucket=week", None),
+    ("PUT", "/api/users/audit-1/budgets/budget-1/expense-2", {"expense_name": "expense-2",
+        "expense_description": "audit", "expense_amount": 20, "expense_date": "2020-01-04"}),
+    ("DELETE", "/api/users/audit-1/budgets/budget-1/expense-2", None),
+    ("DELETE", "/api/users/audit-1/budgets/budget-2", None),
+    ("DELETE", "/api/users/audit-2/", None),
+]
+
+def _populate_audit_db():
+    user = User(user_name="audit-1", user_email="audit@1", password="abc")
+    budget = Budget(
+        budget_name="budget-1",
+        budget_description="audit",
+        budget_amount=100,
+        currency_type="euro",
+        start_date=datetime(2020, 1, 1),
+        end_date=datetime(2020, 1, 31),
+        user=user
+    )
+    expense = Expense(
+        expense_name="expense-1",
+        expense_description="audit",
+        expense_amount=10,
+        expense_date=datetime(2020, 1, 1),
+        budget=budget
+    )
+    db.session.add(expense)
+    db.session.commit()
+
+def is_full_scan(detail, statement):
+    """
+    Tells if a line of EXPLAIN QUERY PLAN output is a scan of a whole table
+    without an index. Reading a table in key order to fill a page (no WHERE
+    clause but a LIMIT) is not counted since it stops after the page.
+
+    : param str detail: the detail column of the query plan row
+    : param str statement: the SQL statement that was explained
+    """
+
+    if not re.match(r"^SCAN (TABLE )?[^\s(]+( AS \S+)?$", detail):
+        return False
+    return " WHERE " in statement or " LIMIT " not in statement
+
+@click.command("audit-queries")
+@with_appcontext
+def audit_queries_command():
+    """
+    Runs every resource of the API against a small temporary database,
+    explains the query plan of every SQL statement issued and reports the
+    ones that scan a whole table. Fails if any are found.
+    """
+
+    statements = {}
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and not statement.lstrip().upper().startswith("PRAGMA"):
+            statements.setdefault(statement, parameters)
+
+    #Run a separate instance of the app on its own temporary database. The
+    #session is per thread, so it is started over for the other instance
+    db_fd, db_fname = tempfile.mkstemp()
+    audit_app = create_app(dict(current_app.config,
+        SQLALCHEMY_DATABASE_URI="sqlite:///" + db_fname))
+    db.session.remove()
+    try:
+        with audit_app.app_context():
+            engine = db.engine
+            db.create_all()
+            _populate_audit_db()
+
+            event.listen(engine, "before_cursor_execute", record_statement)
+            client = audit_app.test_client()
+            for method, url, body in AUDIT_REQUESTS:
+                resp = client.open(url, method=method, json=body, buffered=True)
+                if resp.status_code >= 400:
+                    click.echo("{} {} failed with {}".format(method, url, resp.status_code))
+            event.remove(engine, "before_cursor_execute", record_statement)
+
+            flagged = 0
+            connection = engine.raw_connection()
+            try:
+                cursor = connection.cursor()
+                for statement, parameters in statements.items():
+                    cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+                    scans = [row[-1] for row in cursor.fetchall() if is_full_scan(row[-1], statement)]
+                    if scans:
+                        flagged += 1
+                        click.echo("{}\n    -> {}\n".format(" ".join(statement.split()), ", ".join(scans)))
+            finally:
+                connection.close()
+            db.session.remove()
+            engine.dispose()
+    finally:
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+    click.echo("{} of {} statements scan a whole table".format(flagged, len(statements)))
+    if flagged:
+        raise SystemExit(1)
 
-@app.route("/api/", methods=["GET"])
 def entry_point():
     body = UserBuilder()
     body.add_namespace("budtrack", LINK_RELATIONS_URL)
     body.add_control_all_users()
-    return Response(json.dumps(body), 200, mimetype=MASON)
+    return Response(dump_json(body), 200, mimetype=MASON)
+
+def cache_stats():
+    #Counters of the response cache, for sizing it
+    stats = current_app.extensions["response_cache"].stats()
+    return Response(json.dumps(stats), 200, mimetype="application/json")
 
-@app.route("/budtrack/link-relations/")
 def redirect_to_apiary_link_rels():
     return "", 200
 
-@app.route("/profiles/<resource>/")
 def send_profile_html(resource):
     return "", 200
 
+def read_ndjson(stream):
+    """
+    Parses a newline delimited JSON stream one line at a time. Blank lines are
+    skipped and a line that is not valid JSON is returned as a ValueError in
+    place of the document, so the caller can report it with the line's
+    position.
+
+    : param stream: file-like object to read the lines from
+    """
+
+    documents = []
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            documents.append(json.loads(line))
+        except ValueError as e:
+            documents.append(ValueError("Invalid JSON: {}".format(e)))
+    return documents
+
+def parse_page_args(default_limit):
+    """
+    Reads the keyset paging arguments "after", "before" and "limit" from the
+    query string. Raises ValueError if any of them is not a valid integer or
+    if both cursors are given.
+    """
+
+    args = {}
+    for name in ("after", "before", "limit"):
+        value = request.args.get(name)
+        if value is None:
+            args[name] = None
+            continue
+        try:
+            args[name] = int(value)
+        except ValueError:
+            raise ValueError("'{}' must be an integer".format(name))
+
+    if args["after"] is not None and args["before"] is not None:
+        raise ValueError("'after' and 'before' can not be used together")
+    limit = args["limit"]
+    if limit is None:
+        limit = default_limit
+    elif not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError("'limit' must be between 1 and {}".format(MAX_PAGE_SIZE))
+    return args["after"], args["before"], limit
+
+def parse_expense_filters():
+    """
+    Reads the filters of an expense listing from the query string: "from"
+    and "to" dates (both included), "min_amount" and "max_amount", "sort"
+    (a name from EXPENSE_SORTS, "-" in front for descending) and "limit".
+    Returns a dict with the filters that were given. Raises ValueError if any
+    of them is invalid.
+    """
+
+    filters = parse_date_filters()
+    for name in ("min_amount", "max_amount"):
+        value = request.args.get(name)
+        if value is not None:
+            try:
+                filters[name] = float(value)
+            except ValueError:
+                raise ValueError("'{}' must be a number".format(name))
+
+    sort = request.args.get("sort")
+    if sort is not None:
+        if sort.lstrip("-") not in EXPENSE_SORTS:
+            raise ValueError("'sort' must be one of {}, optionally with a '-' in front".format(
+                ", ".join(EXPENSE_SORTS)))
+        filters["sort"] = sort
+    limit = request.args.get("limit")
+    if limit is not None:
+        try:
+            filters["limit"] = int(limit)
+        except ValueError:
+            raise ValueError("'limit' must be an integer")
+        if not 0 < filters["limit"] <= MAX_PAGE_SIZE:
+            raise ValueError("'limit' must be between 1 and {}".format(MAX_PAGE_SIZE))
+    return filters
+
+def parse_date_filters():
+    """
+    Reads the "from" and "to" dates of a listing from the query string.
+    Returns a dict with the ones that were given. Raises ValueError if any of
+    them is not a date.
+    """
+
+    filters = {}
+    for name in ("from", "to"):
+        value = request.args.get(name)
+        if value is not None:
+            try:
+                filters[name] = ConverToDatetime(value)
+            except ValueError:
+                raise ValueError("'{}' must be a date like 2020-01-31".format(name))
+    return filters
+
+def parse_report_filters():
+    """
+    Reads the parameters of a spending report from the query string: "from"
+    and "to" dates (both included) and the "bucket" to sum the spending by,
+    a name from BUCKET_PERIODS, month by default. Returns the date filters
+    and the bucket. Raises ValueError if any of them is invalid.
+    """
+
+    bucket = request.args.get("bucket", "month")
+    if bucket not in BUCKET_PERIODS:
+        raise ValueError("'bucket' must be one of {}".format(", ".join(BUCKET_PERIODS)))
+    return parse_date_filters(), bucket
+
+def filter_expenses(query, filters):
+    """
+    Adds the filters from parse_expense_filters to a query of expenses. The
+    date and amount filters use the (budget_id, expense_date, expense_amount)
+    index when the query is for one budget. Sorted results are ordered by id
+    after the sort column so that their order is stable.
+
+    : param query: query of expenses or of their columns
+    : param dict filters: the filters
+    """
+
+    if "from" in filters:
+        query = query.filter(Expense.expense_date >= filters["from"])
+    if "to" in filters:
+        query = query.filter(Expense.expense_date < filters["to"] + timedelta(days=1))
+    if "min_amount" in filters:
+        query = query.filter(Expense.expense_amount >= filters["min_amount"])
+    if "max_amount" in filters:
+        query = query.filter(Expense.expense_amount <= filters["max_amount"])
+    if "sort" in filters:
+        column = EXPENSE_SORTS[filters["sort"].lstrip("-")]
+        if filters["sort"].startswith("-"):
+            query = query.order_by(column.desc(), Expense.id.desc())
+        else:
+            query = query.order_by(column, Expense.id)
+    if "limit" in filters:
+        query = query.limit(filters["limit"])
+    return query
+
+def page_url(url, **args):
+    """
+    Makes the URL of another page of a collection. The query parameters of
+    the request, like filters, fields and controls, are kept and the given
+    ones are replaced, None removes one.
+
+    : param str url: URL of the collection
+    : param args: the query parameters to replace
+    """
+
+    query = request.args.copy()
+    for name, value in args.items():
+        query.pop(name, None)
+        if value is not None:
+            query[name] = value
+    return url + "?" + urlencode(list(query.items(multi=True)))
+
+def encode_cursor(sort, value, expense_id):
+    """
+    Makes the opaque cursor of an expense page. It holds the sort order and
+    the sort value and id of the last expense of the page.
+
+    : param str sort: the sort query parameter
+    : param value: value of the sort column of the expense
+    : param int expense_id: id of the expense
+    """
+
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    cursor = json.dumps([sort, value, expense_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(cursor).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor, sort):
+    """
+    Reads the sort value and the expense id from a cursor made by
+    encode_cursor. Raises ValueError if the cursor is not valid or was made
+    for another sort order.
+
+    : param str cursor: the after query parameter
+    : param str sort: the sort query parameter
+    """
+
+    try:
+        cursor = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, value, expense_id = json.loads(cursor.decode("utf-8"))
+        if cursor_sort != sort or not isinstance(expense_id, int) or isinstance(expense_id, bool):
+            raise ValueError
+        #The value is bound in a comparison with the column, it must have its type
+        column = sort.lstrip("-")
+        if column == "expense_date":
+            value = datetime.fromisoformat(value)
+        elif column == "expense_amount":
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError
+        elif not isinstance(value, str):
+            raise ValueError
+    except (ValueError, TypeError):
+        raise ValueError("'after' is not a valid cursor for this sort order")
+    return value, expense_id
+
+def after_cursor(sort, value, expense_id):
+    """
+    Makes the condition for the expenses that come after a cursor in the
+    given sort order.
+
+    : param str sort: the sort query parameter
+    : param value: sort value of the cursor
+    : param int expense_id: expense id of the cursor
+    """
+
+    column = EXPENSE_SORTS[sort.lstrip("-")]
+    if sort.startswith("-"):
+        return tuple_(column, Expense.id) < tuple_(value, expense_id)
+    return tuple_(column, Expense.id) > tuple_(value, expense_id)
+
+def stream_collection(body, items):
+    """
+    Encodes a Mason collection incrementally. The "items" array is written
+    first, one element at a time as the items iterable produces them, and the
+    rest of the body after it. Because of this the items iterable can still add
+    controls (like next and prev) to the body while it runs. The output is the
+    same as the JSON serializer of the app gives for the body with the items
+    in front.
+
+    : param MasonBuilder body: the collection without its items
+    : param iterable items: MasonBuilder objects to put in the items array
+    """
+
+    serializer = current_app.extensions["json_serializer"]
+    dumps = serializer.dumps
+    item_separator = serializer.item_separator
+    key_separator = serializer.key_separator
+    #Trimmed to the fields and controls asked for, like dump_json does
+    shape = g.get("response_shape")
+
+    chunk = [b"{", dumps("items"), key_separator, b"["]
+    size = 0
+    for index, item in enumerate(items):
+        if shape is not None:
+            item = shape_body(item, *shape)
+        encoded = dumps(item)
+        if index:
+            chunk.append(item_separator)
+        chunk.append(encoded)
+        size += len(encoded)
+        if size >= STREAM_CHUNK_SIZE:
+            yield b"".join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(b"]")
+    if shape is not None:
+        body = shape_body(body, *shape)
+    for key, value in body.items():
+        chunk.extend((item_separator, dumps(key), key_separator, dumps(value)))
+    chunk.append(b"}")
+    yield b"".join(chunk)
+
+def stream_ndjson(items):
+    """
+    Encodes items as NDJSON, one JSON document per line, with the JSON
+    serializer of the app. Lines are sent in chunks of STREAM_CHUNK_SIZE.
+
+    : param iterable items: the items
+    """
+
+    dumps = current_app.extensions["json_serializer"].dumps
+    chunk = []
+    size = 0
+    for item in items:
+        encoded = dumps(item) + b"\n"
+        chunk.append(encoded)
+        size += len(encoded)
+        if size >= STREAM_CHUNK_SIZE:
+            yield b"".join(chunk)
+            chunk = []
+            size = 0
+    yield b"".join(chunk)
+
+def stream_csv(header, rows):
+    """
+    Encodes rows as CSV with a header row. Rows are sent in chunks of
+    STREAM_CHUNK_SIZE.
+
+    : param list header: names of the columns
+    : param iterable rows: the rows, sequences in the order of the header
+    """
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if out.tell() >= STREAM_CHUNK_SIZE:
+            yield out.getvalue().encode("utf-8")
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue().encode("utf-8")
+
+def items_response(body, items):
+    """
+    Makes the 200 response of a body with an items list. The items are put in
+    the body and the body is encoded at once, or with JSON_STREAM_ITEMS they
+    are encoded and sent one at a time as the items iterable produces them,
+    with the items list in front of the rest of the body.
+
+    : param MasonBuilder body: the body, its items are replaced
+    : param iterable items: MasonBuilder objects to put in the items list
+    """
+
+    if current_app.config["JSON_STREAM_ITEMS"]:
+        body.pop("items", None)
+        return Response(stream_with_context(stream_collection(body, items)),
+            200, mimetype=MASON)
+    body["items"] = list(items)
+    return Response(dump_json(body), 200, mimetype=MASON)
+
+def dump_json(obj):
+    """
+    Encodes a response body with the JSON serializer of the app, trimmed to
+    the fields and controls asked for in the request.
+
+    : param obj: the body, usually a MasonBuilder
+    """
+
+    with timed("serialize"):
+        shape = g.get("response_shape")
+        if shape is not None:
+            obj = shape_body(obj, *shape)
+        return current_app.extensions["json_serializer"].dumps(obj)
+
+def read_response_shape():
+    #Read the fields and controls query parameters before the request is
+    #handled, the bodies are trimmed to them when they are encoded
+    controls = request.args.get("controls", "full")
+    if controls not in CONTROL_LEVELS:
+        return create_error_response(400, "Invalid query parameter",
+            "'controls' must be one of {}".format(", ".join(CONTROL_LEVELS)))
+    fields = request.args.get("fields")
+    if fields is not None:
+        fields = frozenset(field for field in fields.split(",") if field)
+    if fields is not None or controls != "full":
+        g.response_shape = (fields, controls)
+
+def shape_body(body, fields, controls):
+    """
+    Returns a copy of a Mason object, and of the objects in its items, with
+    only some of its fields and controls. Mason properties like @error are
+    always kept.
+
+    : param dict body: the Mason object
+    : param fields: names of the fields to keep, None keeps all of them
+    : param str controls: one of CONTROL_LEVELS. "none" drops the controls and
+        namespaces, "minimal" keeps only the controls in MINIMAL_CONTROLS
+    """
+
+    shaped = {}
+    for key, value in body.items():
+        if key == "items":
+            shaped[key] = [shape_body(item, fields, controls) for item in value]
+        elif key == "@controls":
+            if controls == "minimal":
+                value = {name: control for name, control in value.items()
+                    if name in MINIMAL_CONTROLS}
+            if controls != "none" and value:
+                shaped[key] = value
+        elif key == "@namespaces":
+            if controls == "full":
+                shaped[key] = value
+        elif fields is None or key in fields or key.startswith("@"):
+            shaped[key] = value
+    return shaped
+
+class JSONSerializer(object):
+    """
+    Encodes response bodies with the json module of the standard library.
+    Serializers return bytes and tell the separators they use, so that
+    stream_collection can write the same format around the items.
+    """
+
+    item_separator = b", "
+    key_separator = b": "
+
+    def dumps(self, obj):
+        return json.dumps(obj).encode("utf-8")
+
+class OrjsonSerializer(JSONSerializer):
+    """
+    Encodes response bodies with orjson, several times faster than the json
+    module for large collections. Its output has no spaces and non-ASCII
+    characters are not escaped.
+    """
+
+    item_separator = b","
+    key_separator = b":"
+
+    def __init__(self):
+        if orjson is None:
+            raise ValueError("JSON serializer 'orjson' is not installed")
+
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+SERIALIZERS = {
+    "json": JSONSerializer,
+    "orjson": OrjsonSerializer,
+}
+
+def make_serializer(config):
+    """
+    Makes the JSON serializer of an app from its JSON_SERIALIZER setting. It
+    is the name of one of SERIALIZERS, "auto" for the fastest one that is
+    installed, or the import name of a serializer class.
+
+    : param dict config: the app config
+    """
+
+    name = config.get("JSON_SERIALIZER", "json")
+    if name == "auto":
+        name = "json" if orjson is None else "orjson"
+    if name in SERIALIZERS:
+        return SERIALIZERS[name]()
+    return import_string(name)()
+
 def ConverToDatetime(dateStr):
     return datetime.strptime(dateStr, '%Y-%m-%d')
 
@@ -721,6 +2766,23 @@ class MasonBuilder(dict):
         self["@controls"][ctrl_name] = kwargs
         self["@controls"][ctrl_name]["href"] = href
 
+    def add_control_template(self, ctrl_name, template, href):
+        """
+        Adds a control from a template that has every property of the control
+        but its href. The template is copied, the result is the same as
+        add_control with the properties of the template as kwargs.
+
+        : param str ctrl_name: name of the control (including namespace if any)
+        : param dict template: the properties of the control
+        : param str href: target URI for the control
+        """
+
+        if "@controls" not in self:
+            self["@controls"] = {}
+
+        control = self["@controls"][ctrl_name] = dict(template)
+        control["href"] = href
+
 class UserBuilder(MasonBuilder):
     
     @staticmethod
@@ -745,48 +2807,28 @@ class UserBuilder(MasonBuilder):
         return schema
 
     def add_control_all_users(self):
-        self.add_control(
-            "budtrack:users-all",
-            href=api.url_for(UserCollection),
-            method="GET",
-            title="List of all users"
-        )
+        self.add_control_template("budtrack:users-all", CONTROL_TEMPLATES["all-users"],
+            resource_url(UserCollection))
     
     def add_collection_all_users(self):
-        self.add_control(
-            "collection",
-            href=api.url_for(UserCollection),
-            method="GET",
-            title="List of all users"
-        )
+        self.add_control_template("collection", CONTROL_TEMPLATES["collection-all-users"],
+            resource_url(UserCollection))
 
     def add_control_delete_user(self, user_name):
-        self.add_control(
-            "budtrack:delete",
-            href=api.url_for(UserCollection) + user_name+'/',
-            method="DELETE",
-            title="Delete this User"
-        )
+        self.add_control_template("budtrack:delete", CONTROL_TEMPLATES["delete-user"],
+            resource_url(UserCollection) + user_name+'/')
     
     def add_control_add_user(self):
-        self.add_control(
-            "budtrack:add-user",
-            href=api.url_for(UserCollection),
-            method="POST",
-            encoding="json",
-            title="Add this user",
-            schema=self.user_schema()
-        )
+        self.add_control_template("budtrack:add-user", CONTROL_TEMPLATES["add-user"],
+            resource_url(UserCollection))
 
     def add_control_edit_user(self, user_name):
-        self.add_control(
-            "edit",
-            href=api.url_for(UserCollection)+ user_name+'/',
-            method="PUT",
-            encoding="json",
-            title="Edit this user",
-            schema=self.user_schema()
-        )
+        self.add_control_template("edit", CONTROL_TEMPLATES["edit-user"],
+            resource_url(UserCollection)+ user_name+'/')
+
+    def add_control_spending_report(self, user_name):
+        self.add_control_template("budtrack:spending-report", CONTROL_TEMPLATES["spending-report"],
+            resource_url(SpendingReport, user=user_name) + REPORT_TEMPLATE)
 
 class BudgetBuilder(MasonBuilder):
    
@@ -826,52 +2868,30 @@ class BudgetBuilder(MasonBuilder):
         return schema
 
     def add_control_user_budgets(self,user_name):
-        self.add_control(
-            "budtrack:budget-by",
-            href=api.url_for(BudgetCollection, user=user_name),
-            method="GET",
-            title="List of all budgets of user"
-        )
+        self.add_control_template("budtrack:budget-by", CONTROL_TEMPLATES["user-budgets"],
+            resource_url(BudgetCollection, user=user_name))
     
     def add_control_add_budget(self,user_name):
-        self.add_control(
-            "budtrack:add-budget",
-            href=api.url_for(BudgetCollection, user=user_name),
-            method="POST",
-            encoding="json",
-            title="Add this budget",
-            schema=self.budget_schema()
-        )
+        self.add_control_template("budtrack:add-budget", CONTROL_TEMPLATES["add-budget"],
+            resource_url(BudgetCollection, user=user_name))
     
 
     def add_control_delete_budget(self, user_name, budget_name):
-        self.add_control(
-            "budtrack:delete",
-            href=api.url_for(BudgetItem, user=user_name, budget=budget_name),
-            method="DELETE",
-            title="Delete this Budget"
-        )
+        self.add_control_template("budtrack:delete", CONTROL_TEMPLATES["delete-budget"],
+            resource_url(BudgetItem, user=user_name, budget=budget_name))
     
 
     def add_control_edit_budget(self, user_name, budget_name):
-        self.add_control(
-            "edit",
-            href=api.url_for(BudgetItem, user=user_name, budget=budget_name),
-            method="PUT",
-            encoding="json",
-            title="Edit this Budget",
-            schema=self.budget_schema()
-        )
+        self.add_control_template("edit", CONTROL_TEMPLATES["edit-budget"],
+            resource_url(BudgetItem, user=user_name, budget=budget_name))
     
     def add_control_add_budget_expense(self, user_name, budget_name):
-        self.add_control(
-            "budtrack:add-expense",
-            href=api.url_for(BudgetItem, user=user_name, budget=budget_name),
-            method="POST",
-            encoding="json",
-            title="Add this expense",
-            schema=ExpenseBuilder.expense_schema()
-        )
+        self.add_control_template("budtrack:add-expense", CONTROL_TEMPLATES["add-budget-expense"],
+            resource_url(BudgetItem, user=user_name, budget=budget_name))
+
+    def add_control_add_budget_expenses(self, user_name, budget_name):
+        self.add_control_template("budtrack:add-expenses", CONTROL_TEMPLATES["add-budget-expenses"],
+            resource_url(ExpenseBatch, user=user_name, budget=budget_name))
 
 class ExpenseBuilder(MasonBuilder):
    
@@ -884,7 +2904,8 @@ class ExpenseBuilder(MasonBuilder):
         props = schema["properties"] = {}
         props["expense_name"] = {
             "description": "Expense title",
-            "type": "string"
+            "type": "string",
+            "not": {"enum": list(RESERVED_EXPENSE_NAMES)}
         }
         props["expense_description"] = {
             "description": "Expense description",
@@ -902,27 +2923,327 @@ class ExpenseBuilder(MasonBuilder):
 
         return schema
     
+    def add_control_filter_expenses(self, user_name, budget_name):
+        self.add_control_template("budtrack:filter-expenses", CONTROL_TEMPLATES["filter-expenses"],
+            resource_url(ExpenseCollection, user=user_name, budget=budget_name) + EXPENSE_FILTERS_TEMPLATE)
+
     def add_control_delete_expense(self, user_name, budget_name, expense):
-        self.add_control(
-            "budtrack:delete",
-            href=api.url_for(ExpenseItem, user=user_name, budget=budget_name, expense=expense),
-            method="DELETE",
-            title="Delete this expense"
-        )
+        self.add_control_template("budtrack:delete", CONTROL_TEMPLATES["delete-expense"],
+            resource_url(ExpenseItem, user=user_name, budget=budget_name, expense=expense))
     
 
     def add_control_edit_expense(self, user_name, budget_name, expense):
-        self.add_control(
-            "edit",
-            href=api.url_for(ExpenseItem, user=user_name, budget=budget_name, expense=expense),
-            method="PUT",
-            encoding="json",
-            title="Edit this Budget",
-            schema=self.expense_schema()
-        )
+        self.add_control_template("edit", CONTROL_TEMPLATES["edit-expense"],
+            resource_url(ExpenseItem, user=user_name, budget=budget_name, expense=expense))
+
+class SchemaRegistry(object):
+    """
+    Keeps the JSON schemas of the resources together with their compiled
+    Draft 7 validators. Schemas are checked and compiled once when they are
+    registered instead of on every request that needs to validate a document.
+    """
+
+    def __init__(self):
+        self._schemas = {}
+        self._validators = {}
+
+    def register(self, name, schema):
+        """
+        Checks the schema itself and compiles a validator for it.
+
+        : param str name: name used to look the schema up later
+        : param dict schema: the JSON schema
+        """
+
+        Draft7Validator.check_schema(schema)
+        self._schemas[name] = schema
+        self._validators[name] = Draft7Validator(schema)
+
+    def schema(self, name):
+        return self._schemas[name]
+
+    def validate(self, name, document):
+        """
+        Validates a document against a registered schema. Raises the same
+        ValidationError that jsonschema.validate would for an invalid document.
+
+        : param str name: name of the registered schema
+        : param document: the deserialized JSON document
+        """
+
+        with timed("validate"):
+            error = best_match(self._validators[name].iter_errors(document))
+        if error is not None:
+            raise error
+
+schemas = SchemaRegistry()
+schemas.register("user", UserBuilder.user_schema())
+schemas.register("budget", BudgetBuilder.budget_schema())
+schemas.register("expense", ExpenseBuilder.expense_schema())
+
+#Properties of the controls that are the same in every response, built once
+#per process. The builders copy them and only add the href
+CONTROL_TEMPLATES = {
+    "all-users": {
+        "method": "GET",
+        "title": "List of all users"
+    },
+    "collection-all-users": {
+        "method": "GET",
+        "title": "List of all users"
+    },
+    "delete-user": {
+        "method": "DELETE",
+        "title": "Delete this User"
+    },
+    "add-user": {
+        "method": "POST",
+        "encoding": "json",
+        "title": "Add this user",
+        "schema": schemas.schema("user")
+    },
+    "edit-user": {
+        "method": "PUT",
+        "encoding": "json",
+        "title": "Edit this user",
+        "schema": schemas.schema("user")
+    },
+    "spending-report": {
+        "method": "GET",
+        "isHrefTemplate": True,
+        "title": "Spending of the user across all budgets",
+        "schema": {
+            "type": "object",
+            "properties": {
+                "from": {
+                    "description": "First expense date",
+                    "type": "string",
+                    "pattern": "^[0-9]{4}-[01][0-9]-[0-3][0-9]$"
+                },
+                "to": {
+                    "description": "Last expense date",
+                    "type": "string",
+                    "pattern": "^[0-9]{4}-[01][0-9]-[0-3][0-9]$"
+                },
+                "bucket": {
+                    "description": "Period to sum the spending by",
+                    "type": "string",
+                    "enum": list(BUCKET_PERIODS)
+                }
+            }
+        }
+    },
+    "user-budgets": {
+        "method": "GET",
+        "title": "List of all budgets of user"
+    },
+    "add-budget": {
+        "method": "POST",
+        "encoding": "json",
+        "title": "Add this budget",
+        "schema": schemas.schema("budget")
+    },
+    "delete-budget": {
+        "method": "DELETE",
+        "title": "Delete this Budget"
+    },
+    "edit-budget": {
+        "method": "PUT",
+        "encoding": "json",
+        "title": "Edit this Budget",
+        "schema": schemas.schema("budget")
+    },
+    "add-budget-expense": {
+        "method": "POST",
+        "encoding": "json",
+        "title": "Add this expense",
+        "schema": schemas.schema("expense")
+    },
+    "add-budget-expenses": {
+        "method": "POST",
+        "encoding": "json",
+        "title": "Add these expenses",
+        "schema": {
+            "type": "array",
+            "items": schemas.schema("expense")
+        }
+    },
+    "filter-expenses": {
+        "method": "GET",
+        "isHrefTemplate": True,
+        "title": "Filter the expenses of the budget",
+        "schema": {
+            "type": "object",
+            "properties": {
+                "from": {
+                    "description": "First expense date",
+                    "type": "string",
+                    "pattern": "^[0-9]{4}-[01][0-9]-[0-3][0-9]$"
+                },
+                "to": {
+                    "description": "Last expense date",
+                    "type": "string",
+                    "pattern": "^[0-9]{4}-[01][0-9]-[0-3][0-9]$"
+                },
+                "min_amount": {
+                    "description": "Smallest expense amount",
+                    "type": "number"
+                },
+                "max_amount": {
+                    "description": "Largest expense amount",
+                    "type": "number"
+                },
+                "sort": {
+                    "description": "Sort order, '-' in front for descending",
+                    "type": "string",
+                    "enum": [prefix + name for name in EXPENSE_SORTS for prefix in ("", "-")]
+                },
+                "limit": {
+                    "description": "Number of expenses per page",
+                    "type": "integer",
+                    "minimum": 1,
+                    "maximum": MAX_PAGE_SIZE
+                }
+            }
+        }
+    },
+    "delete-expense": {
+        "method": "DELETE",
+        "title": "Delete this expense"
+    },
+    "edit-expense": {
+        "method": "PUT",
+        "encoding": "json",
+        "title": "Edit this Budget",
+        "schema": schemas.schema("expense")
+    },
+}
 
 api.add_resource(UserCollection, "/api/users/")
 api.add_resource(UserItem, "/api/users/<user>/")
 api.add_resource(BudgetCollection, "/api/users/<user>/budgets")
 api.add_resource(BudgetItem, "/api/users/<user>/budgets/<budget>")
-api.add_resource(ExpenseItem, "/api/users/<user>/budgets/<budget>/<expense>")
\ No newline at end of file
+api.add_resource(ExpenseItem, "/api/users/<user>/budgets/<budget>/<expense>")
+api.add_resource(BudgetSummary, "/api/users/<user>/budgets/<budget>/summary")
+api.add_resource(ExpenseBatch, "/api/users/<user>/budgets/<budget>/expenses:batch")
+api.add_resource(ExpenseCollection, "/api/users/<user>/budgets/<budget>/expenses/")
+api.add_resource(SpendingReport, "/api/users/<user>/reports/spending")
+
+#Routes of the resources as str.format templates, e.g. /api/users/{user}/
+ROUTE_TEMPLATES = {
+    resource: re.sub(r"<(?:[^>:]+:)?([^>]+)>", r"{\1}", urls[0])
+    for resource, urls, kwargs in api.resources
+}
+
+@lru_cache(maxsize=4096)
+def quote_segment(value):
+    #Quoted the same way the URL converters of werkzeug quote values
+    return url_quote(str(value))
+
+def resource_url(resource, **values):
+    """
+    Builds the URL of a resource from the template of its route. Gives the
+    same URL as api.url_for without going through the URL map, which is most
+    of the work of building a large collection.
+
+    : param resource: the resource class
+    : param values: the URL variables of the resource
+    """
+
+    return request.script_root + ROUTE_TEMPLATES[resource].format(**{
+        name: quote_segment(value) for name, value in values.items()
+    })
+
+def config_from_env(environ):
+    """
+    Reads settings from BUDTRACK_<setting> environment variables for the
+    settings in DEFAULT_CONFIG. Values are parsed as JSON when they can be,
+    so numbers, booleans and objects keep their types, and are used as plain
+    strings otherwise.
+
+    : param dict environ: the environment variables
+    """
+
+    config = {}
+    for key in DEFAULT_CONFIG:
+        value = environ.get("BUDTRACK_" + key)
+        if value is None:
+            continue
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+    return config
+
+def engine_options(config):
+    """
+    Builds the create_engine arguments from the DB_* settings. File based
+    SQLite databases get a QueuePool when SQLITE_POOL is on, so the threads of
+    the server reuse the connections of the pool one at a time instead of
+    every request opening a new one.
+
+    : param dict config: the app config
+    """
+
+    options = {}
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    in_memory = url.database in (None, "", ":memory:")
+    if url.drivername == "sqlite" and config["SQLITE_POOL"] and not in_memory:
+        #A connection is only used by one thread at a time, but not always
+        #by the thread that opened it
+        options["poolclass"] = QueuePool
+        options["connect_args"] = {"check_same_thread": False}
+    if url.drivername != "sqlite" or "poolclass" in options:
+        for option, key in (("pool_size", "DB_POOL_SIZE"),
+                ("max_overflow", "DB_MAX_OVERFLOW"),
+                ("pool_timeout", "DB_POOL_TIMEOUT")):
+            if config[key] is not None:
+                options[option] = config[key]
+    if config["DB_POOL_RECYCLE"] is not None:
+        options["pool_recycle"] = config["DB_POOL_RECYCLE"]
+    if config["DB_POOL_PRE_PING"]:
+        options["pool_pre_ping"] = True
+    options.update(config["DB_ENGINE_OPTIONS"] or {})
+    return options
+
+def create_app(test_config=None):
+    """
+    Creates an instance of the app. Every instance has its own config and its
+    own database engine, so several of them can run in one process. Settings
+    come from DEFAULT_CONFIG, the BUDTRACK_SETTINGS file, BUDTRACK_*
+    environment variables and test_config, later ones winning.
+
+    : param dict test_config: settings that override everything else
+    """
+
+    app = Flask(__name__)
+    app.config.from_mapping(DEFAULT_CONFIG)
+    app.config.from_envvar("BUDTRACK_SETTINGS", silent=True)
+    app.config.update(config_from_env(os.environ))
+    if test_config is not None:
+        app.config.update(test_config)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config)
+
+    db.init_app(app)
+    api.init_app(app)
+    if app.config["INSTRUMENTATION"]:
+        app.extensions["metrics"] = RequestMetrics()
+        app.before_request(start_request_timing)
+        app.after_request(finish_request_timing)
+        app.teardown_request(record_request_timing)
+        app.add_url_rule("/metrics", "metrics", metrics)
+    if app.config["MAX_QUERIES_PER_REQUEST"] is not None:
+        app.before_request(reset_query_count)
+    app.before_request(read_response_shape)
+    app.add_url_rule("/api/", "entry_point", entry_point, methods=["GET"])
+    app.add_url_rule("/budtrack/link-relations/", "redirect_to_apiary_link_rels",
+        redirect_to_apiary_link_rels)
+    app.add_url_rule("/profiles/<resource>/", "send_profile_html", send_profile_html)
+    app.extensions["json_serializer"] = make_serializer(app.config)
+    app.extensions["response_cache"] = make_response_cache(app.config)
+    if app.extensions["response_cache"] is not None:
+        app.add_url_rule("/api/cache/", "cache_stats", cache_stats)
+    app.cli.add_command(rebuild_totals_command)
+    app.cli.add_command(audit_queries_command)
+    app.cli.add_command(generate_data_command)
+    return app
@@ -0,0 +1,281 @@
+import argparse
+import asyncio
+import csv
+import json
+import random
+import sys
+import time
+from urllib.parse import quote
+import httpx
+from client import API_URL, ENTRY_POINT, MASON, convert_value
+
+#Requests in flight at the same time
+CONCURRENCY = 20
+#Responses that are retried, and how many times. The wait before a retry
+#doubles every time, starting from BACKOFF seconds
+RETRY_STATUSES = (409, 429, 500, 502, 503, 504)
+RETRIES = 3
+BACKOFF = 0.1
+#Records are created in this order, so that the users exist before their
+#budgets and the budgets before their expenses
+RECORD_TYPES = ("user", "budget", "expense")
+
+
+class AsyncBudgetClient(object):
+    """
+    Asyncio client that creates users, budgets and expenses through the
+    budtrack:add-user, budtrack:add-budget and budtrack:add-expense controls.
+    Controls are read once per resource and shared by every request that
+    needs them. At most concurrency requests are in flight, over the same
+    pooled connections.
+    """
+
+    def __init__(self, api_url=API_URL, concurrency=CONCURRENCY, retries=RETRIES,
+            backoff=BACKOFF, retry_statuses=RETRY_STATUSES, transport=None):
+        self.api_url = api_url
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_statuses = retry_statuses
+        self.transport = transport
+        self._controls = {}
+        self._semaphore = None
+        self._http = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._http = httpx.AsyncClient(
+            base_url=self.api_url,
+            headers={"Accept": MASON + ", */*"},
+            limits=httpx.Limits(max_connections=self.concurrency,
+                max_keepalive_connections=self.concurrency),
+            transport=self.transport
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._http.aclose()
+
+    async def request(self, method, href, data=None, params=None):
+        """
+        Sends a request, retrying it with exponential backoff and jitter if
+        it fails with one of retry_statuses or a connection error. Returns
+        the last response, or raises the last connection error.
+
+        : param str method: the HTTP method
+        : param str href: the href of the resource
+        : param data: the document to send, if any
+        : param dict params: query parameters
+        """
+
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._semaphore:
+                    resp = await self._http.request(method, href, params=params,
+                        json=data)
+                if resp.status_code not in self.retry_statuses:
+                    return resp
+            except httpx.TransportError:
+                if attempt == self.retries:
+                    raise
+            if attempt < self.retries:
+                await asyncio.sleep(self.backoff * 2 ** attempt * (0.5 + random.random()))
+        return resp
+
+    async def control(self, href, name):
+        """
+        Returns one control of a resource. The controls of every resource are
+        read once, concurrent callers wait for the same request. A read that
+        fails is forgotten, so the next caller tries again. Raises LookupError
+        if the resource can not be read or has no such control, or the last
+        connection error.
+
+        : param str href: the href of the resource
+        : param str name: name of the control
+        """
+
+        if href not in self._controls:
+            self._controls[href] = asyncio.ensure_future(self._read_controls(href))
+        future = self._controls[href]
+        try:
+            controls = await future
+        except (LookupError, httpx.HTTPError):
+            if self._controls.get(href) is future:
+                del self._controls[href]
+            raise
+        if name not in controls:
+            raise LookupError("{} has no control {}".format(href, name))
+        return controls[name]
+
+    async def _read_controls(self, href):
+        resp = await self.request("GET", href, params={"fields": "", "limit": 1})
+        if resp.status_code != 200:
+            raise LookupError("{} answered {}".format(href, resp.status_code))
+        return resp.json().get("@controls", {})
+
+    async def submit(self, ctrl, record):
+        """
+        Sends the request of a control with a document made from a record.
+        The fields of the document are taken from the record by the schema of
+        the control and converted to the types of the schema, so the values
+        of CSV records can be strings.
+
+        : param dict ctrl: the control
+        : param dict record: the values of the fields
+        """
+
+        data = {}
+        for field, prop in ctrl["schema"]["properties"].items():
+            if record.get(field) not in (None, ""):
+                data[field] = convert_value(record[field], prop["type"])
+        return await self.request(ctrl["method"], ctrl["href"], data)
+
+    async def users_href(self):
+        return (await self.control(ENTRY_POINT, "budtrack:users-all"))["href"]
+
+    async def create_user(self, record):
+        ctrl = await self.control(await self.users_href(), "budtrack:add-user")
+        return await self.submit(ctrl, record)
+
+    async def create_budget(self, record):
+        user_href = await self.users_href() + quote(record["user"], safe="") + "/"
+        budgets_href = (await self.control(user_href, "budtrack:budget-by"))["href"]
+        ctrl = await self.control(budgets_href, "budtrack:add-budget")
+        return await self.submit(ctrl, record)
+
+    async def add_expense(self, record):
+        user_href = await self.users_href() + quote(record["user"], safe="") + "/"
+        budgets_href = (await self.control(user_href, "budtrack:budget-by"))["href"]
+        budget_href = budgets_href + "/" + quote(record["budget"], safe="")
+        ctrl = await self.control(budget_href, "budtrack:add-expense")
+        return await self.submit(ctrl, record)
+
+    async def create(self, record):
+        """
+        Creates the user, budget or expense of a record and returns a tuple
+        (record, status, error), status is None if no response was received.
+
+        : param dict record: the record, its "type" tells what it is
+        """
+
+        operation = {
+            "user": self.create_user,
+            "budget": self.create_budget,
+            "expense": self.add_expense,
+        }[record["type"]]
+        try:
+            resp = await operation(record)
+        except (LookupError, httpx.HTTPError) as e:
+            return record, None, str(e)
+        except (ValueError, TypeError) as e:
+            #A value the schema type can not be made of, e.g. a CSV amount "ten"
+            return record, None, "Invalid value: {}".format(e)
+        if resp.status_code >= 400:
+            try:
+                error = resp.json()["@error"]["@messages"][0]
+            except (ValueError, KeyError, IndexError, TypeError):
+                error = resp.reason_phrase
+            return record, resp.status_code, error
+        return record, resp.status_code, None
+
+    async def run(self, records, progress=None):
+        """
+        Creates every record, the ones of the same type concurrently and the
+        types in RECORD_TYPES order. Returns the results of create in the
+        order of the records.
+
+        : param list records: the records
+        : param Progress progress: reported to after every record, optional
+        """
+
+        results = {}
+        for record_type in RECORD_TYPES:
+            batch = [(index, record) for index, record in enumerate(records)
+                if record["type"] == record_type]
+
+            async def create(index, record):
+                results[index] = await self.create(record)
+                if progress is not None:
+                    progress.update(results[index][2] is None)
+            await asyncio.gather(*(create(index, record) for index, record in batch))
+        return [results[index] for index in sorted(results)]
+
+
+class Progress(object):
+    """
+    Writes how many records are done, how many failed and the rate to a
+    stream, at most every interval seconds.
+    """
+
+    def __init__(self, total, stream=sys.stderr, interval=0.5):
+        self.total = total
+        self.stream = stream
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self._shown = 0
+
+    def update(self, ok):
+        self.done += 1
+        if not ok:
+            self.failed += 1
+        now = time.monotonic()
+        if now - self._shown >= self.interval or self.done == self.total:
+            self._shown = now
+            self.stream.write("\r{}/{} done, {} failed, {:.0f}/s".format(
+                self.done, self.total, self.failed, self.done / max(now - self.started, 1e-9)))
+            if self.done == self.total:
+                self.stream.write("\n")
+            self.stream.flush()
+
+
+def read_records(path):
+    """
+    Reads the records from a JSON file with a list of objects or a CSV file
+    with a header row. Every record has a "type" (user, budget or expense),
+    budgets and expenses have the "user" and expenses the "budget" they
+    belong to, the rest are the fields of the document.
+
+    : param str path: the file, .csv files are read as CSV
+    """
+
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            records = list(csv.DictReader(f))
+        else:
+            records = json.load(f)
+    for number, record in enumerate(records, 1):
+        if record.get("type") not in RECORD_TYPES:
+            raise ValueError("Record {} has no valid type".format(number))
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Create users, budgets and expenses from a CSV or JSON file.")
+    parser.add_argument("file", help="the records, .csv or .json")
+    parser.add_argument("--url", default=API_URL, help="address of the API")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--retries", type=int, default=RETRIES)
+    parser.add_argument("--backoff", type=float, default=BACKOFF)
+    args = parser.parse_args(argv)
+
+    records = read_records(args.file)
+
+    async def run():
+        async with AsyncBudgetClient(args.url, args.concurrency, args.retries,
+                args.backoff) as client:
+            return await client.run(records, Progress(len(records)))
+
+    results = asyncio.run(run())
+    failed = [result for result in results if result[2] is not None]
+    for record, status, error in failed:
+        values = {key: value for key, value in record.items() if value not in (None, "")}
+        print("{}: {} {}".format(json.dumps(values), status, error))
+    print("{} of {} records created".format(len(results) - len(failed), len(results)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,445 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+import requests
+from sqlalchemy import func, select
+from werkzeug.serving import make_server
+from app import DISTRIBUTIONS, Budget, Expense, User, create_app, db, load_generated_data
+
+DRIVERS = ("test_client", "wsgi")
+
+
+def read_dataset():
+    """
+    Reads the names of the budgets of the database of the current app and of
+    the expenses of a sample of them, for building the request URLs.
+    """
+
+    budget_table = Budget.__table__
+    user_table = User.__table__
+    expense_table = Expense.__table__
+    with db.engine.connect() as connection:
+        users = [row[0] for row in connection.execute(
+            select([user_table.c.user_name]).order_by(user_table.c.user_name))]
+        budgets = connection.execute(select([
+            user_table.c.user_name, budget_table.c.budget_name, budget_table.c.id
+        ]).select_from(budget_table.join(user_table))).fetchall()
+        sample = random.Random(0).sample(budgets, min(len(budgets), 1000))
+        expenses = []
+        for user, budget, budget_id in sample:
+            row = connection.execute(select([expense_table.c.expense_name])
+                .where(expense_table.c.budget_id == budget_id).limit(1)).fetchone()
+            if row is not None:
+                expenses.append((user, budget, row[0]))
+        expense_count = connection.execute(select([func.count()]).select_from(expense_table)).scalar()
+    return {
+        "users": users,
+        "budgets": [(user, budget) for user, budget, _ in budgets],
+        "expenses": expenses,
+        "expense_count": expense_count,
+    }
+
+
+class Endpoints(object):
+    """
+    Makes the requests of every benchmarked endpoint against random rows of
+    the dataset. Each endpoint is a method that returns a (method, url, body)
+    tuple. Names of created rows come from one counter, so runs with several
+    drivers do not collide, and the expenses added by add_expense are the
+    ones delete_expense removes.
+    """
+
+    NAMES = (
+        "entry_point", "list_users", "get_user", "list_budgets", "get_budget",
+        "filter_budget", "budget_summary", "list_expenses", "get_expense",
+        "add_user", "add_budget", "add_expense", "edit_expense", "delete_expense",
+    )
+    #Endpoints that change nothing, they are warmed up before being timed
+    READS = NAMES[:9]
+
+    def __init__(self, dataset, seed=0):
+        self.dataset = dataset
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self._added = []
+
+    def _pick(self, rows):
+        with self._lock:
+            return self._rng.choice(rows)
+
+    def _name(self):
+        return "bench-{}".format(next(self._counter))
+
+    def entry_point(self):
+        return "GET", "/api/", None
+
+    def list_users(self):
+        return "GET", "/api/users/", None
+
+    def get_user(self):
+        return "GET", "/api/users/{}/".format(self._pick(self.dataset["users"])), None
+
+    def list_budgets(self):
+        return "GET", "/api/users/{}/budgets".format(self._pick(self.dataset["users"])), None
+
+    def get_budget(self):
+        return "GET", "/api/users/{}/budgets/{}".format(*self._pick(self.dataset["budgets"])), None
+
+    def filter_budget(self):
+        return "GET", "/api/users/{}/budgets/{}?from=2020-03-01&to=2020-05-31&min_amount=50" \
+            "&sort=-expense_amount&limit=20".format(*self._pick(self.dataset["budgets"])), None
+
+    def budget_summary(self):
+        return "GET", "/api/users/{}/budgets/{}/summary".format(
+            *self._pick(self.dataset["budgets"])), None
+
+    def list_expenses(self):
+        return "GET", "/api/users/{}/budgets/{}/expenses/".format(
+            *self._pick(self.dataset["budgets"])), None
+
+    def get_expense(self):
+        return "GET", "/api/users/{}/budgets/{}/{}".format(
+            *self._pick(self.dataset["expenses"])), None
+
+    def add_user(self):
+        name = self._name()
+        return "POST", "/api/users/", {"user_name": name,
+            "user_email": name + "@example.com", "password": "benchmark"}
+
+    def add_budget(self):
+        return "POST", "/api/users/{}/budgets".format(self._pick(self.dataset["users"])), {
+            "budget_name": self._name(), "budget_description": "benchmark",
+            "budget_amount": 1000, "currency_type": "euro",
+            "start_date": "2020-01-01", "end_date": "2020-12-31"}
+
+    def add_expense(self):
+        user, budget = self._pick(self.dataset["budgets"])
+        name = self._name()
+        self._added.append((user, budget, name))
+        return "POST", "/api/users/{}/budgets/{}".format(user, budget), {
+            "expense_name": name, "expense_description": "benchmark",
+            "expense_amount": 10, "expense_date": "2020-06-01"}
+
+    def edit_expense(self):
+        user, budget, expense = self._pick(self.dataset["expenses"])
+        return "PUT", "/api/users/{}/budgets/{}/{}".format(user, budget, expense), {
+            "expense_name": expense, "expense_description": "benchmark",
+            "expense_amount": round(self._rng.uniform(1, 200), 2), "expense_date": "2020-06-01"}
+
+    def delete_expense(self):
+        try:
+            added = self._added.pop()
+        except IndexError:
+            raise LookupError("add_expense has added no expense that is left to delete")
+        return "DELETE", "/api/users/{}/budgets/{}/{}".format(*added), None
+
+
+def percentile(values, fraction):
+    """
+    Returns the nearest rank percentile of sorted values.
+    """
+
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+def rss_kb():
+    #Current resident set size of the process in kB, None where /proc is missing
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+class RssSampler(object):
+    """
+    Samples the RSS of the process every interval seconds in a background
+    thread while it is used as a context manager, to find the peak of a
+    stretch of work. peak is None where the RSS can not be read.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.baseline = None
+        self.peak = None
+        self._done = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        rss = rss_kb()
+        if rss is not None:
+            self.peak = rss if self.peak is None else max(self.peak, rss)
+
+    def _run(self):
+        while not self._done.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self.baseline = self.peak = rss_kb()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._thread.join()
+        self._sample()
+
+    @property
+    def growth(self):
+        return None if self.baseline is None else self.peak - self.baseline
+
+
+def mean(values):
+    return sum(values) / len(values) if values else None
+
+
+def milliseconds(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return number
+
+
+def run_endpoint(send, make_request, count, concurrency):
+    """
+    Sends count requests of an endpoint from concurrency threads. Returns the
+    latencies in seconds of the requests that got a response, the failed
+    requests and the wall time. Requests that can not be made or sent are
+    failed without a latency.
+
+    : param send: function of (method, url, body) that returns the status
+    : param make_request: function that returns the next request
+    : param int count: number of requests
+    : param int concurrency: number of threads sending them
+    """
+
+    requests_left = iter(range(count))
+    latencies = []
+    errors = []
+
+    def worker():
+        while next(requests_left, None) is not None:
+            method = url = None
+            try:
+                method, url, body = make_request()
+                started = time.perf_counter()
+                status = send(method, url, body)
+            except Exception as e:
+                errors.append((method, url, repr(e)))
+                continue
+            latencies.append(time.perf_counter() - started)
+            if status >= 400:
+                errors.append((method, url, status))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, time.perf_counter() - started
+
+
+def test_client_sender(app):
+    client = app.test_client()
+    lock = threading.Lock()
+
+    def send(method, url, body):
+        #The test client is not thread safe, requests are sent one at a time
+        with lock:
+            return client.open(url, method=method, json=body, buffered=True).status_code
+    return send
+
+
+def wsgi_sender(url):
+    local = threading.local()
+
+    def send(method, path, body):
+        #One session, so one kept-alive connection, per thread
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return local.session.request(method, url + path, json=body).status_code
+    return send
+
+
+def benchmark(app, driver, endpoints, names, count, concurrency, warmup, trace):
+    """
+    Benchmarks the endpoints with one driver and returns a result per
+    endpoint.
+    """
+
+    server = None
+    if driver == "wsgi":
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        send = wsgi_sender("http://127.0.0.1:{}".format(server.server_port))
+    else:
+        send = test_client_sender(app)
+        concurrency = 1
+
+    results = []
+    try:
+        for name in names:
+            make_request = getattr(endpoints, name)
+            if name in Endpoints.READS:
+                run_endpoint(send, make_request, warmup, concurrency)
+            if trace:
+                tracemalloc.start()
+            with RssSampler() as rss:
+                latencies, errors, elapsed = run_endpoint(send, make_request, count, concurrency)
+            traced = tracemalloc.get_traced_memory()[1] // 1024 if trace else None
+            if trace:
+                tracemalloc.stop()
+            latencies.sort()
+            #Latencies are null if no request got a response
+            result = {
+                "endpoint": name,
+                "driver": driver,
+                "requests": len(latencies),
+                "errors": len(errors),
+                "p50_ms": milliseconds(percentile(latencies, 0.50)),
+                "p95_ms": milliseconds(percentile(latencies, 0.95)),
+                "p99_ms": milliseconds(percentile(latencies, 0.99)),
+                "mean_ms": milliseconds(mean(latencies)),
+                "throughput_rps": len(latencies) / elapsed,
+                "peak_rss_kb": rss.peak,
+                "peak_rss_growth_kb": rss.growth,
+                "peak_traced_kb": traced,
+            }
+            if errors:
+                result["first_error"] = "{} {} {}".format(*errors[0])
+            results.append(result)
+            print("{:<12} {:<15} {:>8} {:>8} {:>8} {:>9.0f} {:>6}".format(
+                driver, name, *("-" if result[key] is None else "{:.2f}".format(result[key])
+                    for key in ("p50_ms", "p95_ms", "p99_ms")),
+                result["throughput_rps"], result["errors"]), file=sys.stderr)
+    finally:
+        if server is not None:
+            server.shutdown()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+            stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_setting(setting):
+    key, _, value = setting.partition("=")
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure the latency and throughput of the API resources.")
+    parser.add_argument("--database", help="SQLite file to use, generated if it does not "
+        "exist. A temporary one is generated and removed by default")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--budgets-per-user", type=float, default=10,
+        help="mean number of budgets of a user")
+    parser.add_argument("--expenses-per-budget", type=float, default=10,
+        help="mean number of expenses of a budget")
+    parser.add_argument("--budget-distribution", choices=sorted(DISTRIBUTIONS), default="uniform")
+    parser.add_argument("--expense-distribution", choices=sorted(DISTRIBUTIONS), default="pareto")
+    parser.add_argument("--requests", type=positive_int, default=200, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=positive_int, default=4,
+        help="threads sending requests to the WSGI server")
+    parser.add_argument("--warmup", type=int, default=10,
+        help="untimed requests before each read endpoint")
+    parser.add_argument("--driver", choices=DRIVERS, action="append",
+        help="test_client, wsgi or both when repeated, both by default")
+    parser.add_argument("--endpoint", choices=Endpoints.NAMES, action="append",
+        help="endpoint to benchmark, can be repeated, all by default")
+    parser.add_argument("--set", metavar="SETTING=VALUE", action="append", default=[],
+        help="app setting, values are parsed as JSON when they can be")
+    parser.add_argument("--tracemalloc", action="store_true",
+        help="also report the peak of the memory allocated by Python per endpoint, slow")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json", help="JSON file of the results")
+    args = parser.parse_args(argv)
+    if args.endpoint and "delete_expense" in args.endpoint and "add_expense" not in args.endpoint:
+        parser.error("delete_expense deletes the expenses of add_expense, benchmark both")
+
+    started = datetime.now()
+    #The server would log every request
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    database = args.database
+    if database is None:
+        db_fd, database = tempfile.mkstemp(suffix=".db")
+        os.close(db_fd)
+        os.unlink(database)
+    settings = dict(parse_setting(setting) for setting in args.set)
+    app = create_app(dict(settings, SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.abspath(database)))
+
+    try:
+        with app.app_context():
+            if not os.path.exists(database) or os.path.getsize(database) == 0:
+                generating = time.perf_counter()
+                counts = load_generated_data(app, args.users, args.budgets_per_user,
+                    args.expenses_per_budget, args.budget_distribution,
+                    args.expense_distribution, seed=args.seed)
+                print("Generated {} users, {} budgets and {} expenses in {:.1f} s".format(
+                    *counts, time.perf_counter() - generating), file=sys.stderr)
+            dataset = read_dataset()
+            endpoints = Endpoints(dataset, args.seed)
+            print("{:<12} {:<15} {:>8} {:>8} {:>8} {:>9} {:>6}".format(
+                "driver", "endpoint", "p50 ms", "p95 ms", "p99 ms", "req/s", "errors"),
+                file=sys.stderr)
+            results = []
+            for driver in args.driver or DRIVERS:
+                results.extend(benchmark(app, driver, endpoints, args.endpoint or Endpoints.NAMES,
+                    args.requests, args.concurrency, args.warmup, args.tracemalloc))
+                db.session.remove()
+            db.engine.dispose()
+    finally:
+        if args.database is None:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(database + suffix):
+                    os.unlink(database + suffix)
+
+    report = {
+        "started": started.isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "dataset": {"users": len(dataset["users"]), "budgets": len(dataset["budgets"]),
+            "expenses": dataset["expense_count"]},
+        "settings": settings,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    return 1 if any(result["errors"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
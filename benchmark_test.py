@@ -0,0 +1,44 @@
+import json
+import pytest
+import benchmark
+
+
+def test_benchmark(tmpdir):
+    """
+    Runs the benchmark with a few requests against a small generated
+    database and checks the report it saves.
+    """
+    output = tmpdir.join("benchmark.json")
+    status = benchmark.main(["--users", "20", "--budgets-per-user", "1",
+        "--budget-distribution", "uniform", "--expenses-per-budget", "2",
+        "--requests", "3", "--warmup", "1", "--concurrency", "2",
+        "--output", str(output)])
+    assert status == 0
+
+    report = json.loads(output.read())
+    #users without budgets are part of the dataset too
+    assert report["dataset"]["users"] == 20
+    assert len(report["results"]) == len(benchmark.DRIVERS) * len(benchmark.Endpoints.NAMES)
+    for result in report["results"]:
+        assert result["requests"] == 3
+        assert result["errors"] == 0
+        assert result["p50_ms"] <= result["p99_ms"]
+        if result["peak_rss_kb"] is not None:
+            assert result["peak_rss_growth_kb"] >= 0
+
+def test_benchmark_errors():
+    """
+    Tests that requests that can not be made or sent are counted as errors
+    and that an endpoint without responses has no latencies.
+    """
+    endpoints = benchmark.Endpoints({"users": [], "budgets": [], "expenses": []})
+    latencies, errors, elapsed = benchmark.run_endpoint(
+        lambda method, url, body: 200, endpoints.delete_expense, 4, 2)
+    assert latencies == []
+    assert len(errors) == 4
+    assert "LookupError" in errors[0][2]
+    assert benchmark.percentile(latencies, 0.5) is None
+    assert benchmark.mean(latencies) is None
+
+    with pytest.raises(SystemExit):
+        benchmark.main(["--requests", "0"])
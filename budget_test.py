@@ -1,3 +1,4 @@
+import base64
 import json
 import os
 import pytest
@@ -22,15 +23,21 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
 @pytest.fixture
 def client():
     db_fd, db_fname = tempfile.mkstemp()
-    app.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_fname
-    app.app.config["TESTING"] = True
+    flask_app = app.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        #No request needs more, N+1 queries would fail the tests
+        "MAX_QUERIES_PER_REQUEST": 4
+    })
     
-    with app.app.app_context():
+    with flask_app.app_context():
         db.create_all()
         _populate_db()
         
-    yield app.app.test_client()
+    yield flask_app.test_client()
     
+    with flask_app.app_context():
+        db.get_engine().dispose()
     os.close(db_fd)
     os.unlink(db_fname)
 
@@ -270,6 +277,343 @@ def test_BudgetItem_delete(client):
         assert resp.status_code == 404  
         
         
+def test_BudgetItem_etag(client):
+        resp = client.get(BUDGET_ITEM_URL)
+        etag = resp.headers["ETag"]
+        
+        # the same version is not sent again
+        resp = client.get(BUDGET_ITEM_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.data == b""
+        
+        # adding an expense changes the budget
+        resp = client.post(BUDGET_ITEM_URL, json=_get_expense_json())
+        assert resp.status_code == 201
+        resp = client.get(BUDGET_ITEM_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+        
+        # only the current version can be changed
+        valid = _get_budget_json()
+        valid["budget_name"] = "Oulu-11"
+        resp = client.put(BUDGET_ITEM_URL, json=valid, headers={"If-Match": etag})
+        assert resp.status_code == 412
+        etag = client.get(BUDGET_ITEM_URL).headers["ETag"]
+        resp = client.put(BUDGET_ITEM_URL, json=valid, headers={"If-Match": etag})
+        assert resp.status_code == 204
+        resp = client.delete(BUDGET_ITEM_URL, headers={"If-Match": etag})
+        assert resp.status_code == 412
+
+def test_BudgetCollection_etag(client):
+        etag = client.get(BUDGET_COLLECTION_URL).headers["ETag"]
+        resp = client.get(BUDGET_COLLECTION_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        
+        # a new budget changes the collection
+        resp = client.post(BUDGET_COLLECTION_URL, json=_get_budget_json())
+        assert resp.status_code == 201
+        resp = client.get(BUDGET_COLLECTION_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        
+
+def test_BudgetItem_shape(client):
+        full = client.get(BUDGET_ITEM_URL).data
+        for stream in (False, True):
+            client.application.config["JSON_STREAM_ITEMS"] = stream
+            resp = client.get(BUDGET_ITEM_URL + "?controls=minimal&fields=budget_name,expense_amount")
+            assert resp.status_code == 200
+            body = json.loads(resp.data)
+            assert body["budget_name"] == "Oulu-11"
+            assert "budget_amount" not in body
+            assert list(body["@controls"]) == ["self"]
+            assert body["items"][0] == {
+                "expense_amount": 10,
+                "@controls": {"self": {"href": BUDGET_ITEM_URL + "/Food-11"}}
+            }
+            assert len(resp.data) * 5 < len(full)
+        
+        # errors keep their messages
+        resp = client.get(INVALID_URL + "?fields=budget_name&controls=none")
+        assert resp.status_code == 404
+        assert json.loads(resp.data)["@error"]["@messages"]
+
+def test_BudgetItem_filters(client):
+        expenses = []
+        for number, (date, amount) in enumerate([("2020-01-01", 5), ("2020-01-15", 50), ("2020-02-01", 500)]):
+            expense = _get_expense_json(20 + number)
+            expense["expense_date"] = date
+            expense["expense_amount"] = amount
+            expenses.append(expense)
+        resp = client.post(BUDGET_ITEM_URL + "/expenses:batch", json=expenses)
+        assert resp.status_code == 200
+        
+        # the filters are advertised with a templated control of the expenses
+        body = json.loads(client.get(BUDGET_ITEM_URL).data)
+        body = json.loads(client.get(body["@controls"]["budtrack:expenses"]["href"]).data)
+        control = body["@controls"]["budtrack:filter-expenses"]
+        assert control["isHrefTemplate"] is True
+        assert control["href"] == EXPENSE_COLLECTION_URL + "{?from,to,min_amount,max_amount,sort,limit}"
+        assert "sort" in control["schema"]["properties"]
+        
+        def names(query):
+            resp = client.get(BUDGET_ITEM_URL + "?" + query)
+            assert resp.status_code == 200
+            return [item["expense_name"] for item in json.loads(resp.data)["items"]]
+        
+        assert names("from=2020-01-01&to=2020-01-31") == ["Food-20", "Food-21"]
+        assert names("from=2020-01-15&to=2020-02-01") == ["Food-21", "Food-22"]
+        assert names("min_amount=50&max_amount=500&sort=-expense_amount") == ["Food-22", "Food-21"]
+        assert names("sort=expense_amount&limit=2") == ["Food-20", "Food-11"]
+        assert names("sort=-expense_date&limit=1")[0] not in ("Food-20", "Food-21", "Food-22")
+        
+        for query in ("from=2020-13-01", "min_amount=a", "sort=id", "limit=0", "limit=a"):
+            resp = client.get(BUDGET_ITEM_URL + "?" + query)
+            assert resp.status_code == 400
+
+'''
+TEST FOR BUDGET SUMMARY RESOURCE
+'''
+BUDGET_SUMMARY_URL = "/api/users/User-1/budgets/Oulu-11/summary"
+
+def test_BudgetSummary_get(client):
+        resp = client.get(BUDGET_ITEM_URL)
+        body = json.loads(resp.data)
+        _check_control_get_method("budtrack:summary", client, body)
+        
+        # two expenses of 10 were added today
+        resp = client.get(BUDGET_SUMMARY_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        _check_control_get_method("up", client, body)
+        assert body["spent_amount"] == 20
+        assert body["remaining_amount"] == 80
+        assert body["expense_count"] == 2
+        assert len(body["daily"]) == 1
+        assert body["daily"][0]["spent_amount"] == 20
+        
+        # an older expense adds a month of its own
+        resp = client.post(BUDGET_ITEM_URL, json=_get_expense_json())
+        assert resp.status_code == 201
+        resp = client.get(BUDGET_SUMMARY_URL)
+        body = json.loads(resp.data)
+        assert body["spent_amount"] == 30
+        assert body["expense_count"] == 3
+        assert body["monthly"][0] == {"month": "2018-05", "spent_amount": 10, "expense_count": 1}
+        assert len(body["monthly"]) == 2
+        
+        resp = client.get("/api/users/User-1/budgets/Oulu-51/summary")
+        assert resp.status_code == 404
+        
+        # an expense can not be named like the summary, its URL would be taken
+        expense = _get_expense_json()
+        expense["expense_name"] = "summary"
+        resp = client.post(BUDGET_ITEM_URL, json=expense)
+        assert resp.status_code == 400
+        resp = client.put(BUDGET_ITEM_URL + "/Food-11", json=expense)
+        assert resp.status_code == 400
+        resp = client.post(BUDGET_ITEM_URL + "/expenses:batch", json=[expense])
+        assert json.loads(resp.data)["items"][0]["status"] == 400
+
+
+'''
+TEST FOR SPENDING REPORT RESOURCE
+'''
+SPENDING_REPORT_URL = "/api/users/User-1/reports/spending"
+
+def test_SpendingReport_get(client):
+        resp = client.get("/api/users/User-1/")
+        body = json.loads(resp.data)
+        ctrl = body["@controls"]["budtrack:spending-report"]
+        assert ctrl["isHrefTemplate"]
+        assert ctrl["href"] == SPENDING_REPORT_URL + "{?from,to,bucket}"
+        
+        # four expenses of 10 were added today to the two budgets of the user
+        resp = client.get(SPENDING_REPORT_URL)
+        assert resp.status_code == 200
+        assert resp.headers["Vary"] == "Accept"
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        _check_control_get_method("up", client, body)
+        assert body["bucket"] == "month"
+        assert len(body["items"]) == 1
+        assert body["items"][0]["spent_amount"] == 40
+        assert body["items"][0]["expense_count"] == 4
+        assert body["items"][0]["currency_type"] == "euro"
+        
+        # a Thursday and the next Sunday are in the same week, a Monday is not
+        for url, date in (("Oulu-11", "2018-05-03"), ("Oulu-12", "2018-05-06"), ("Oulu-12", "2018-05-07")):
+            expense = _get_expense_json(date[-1])
+            expense["expense_date"] = date
+            resp = client.post("/api/users/User-1/budgets/" + url, json=expense)
+            assert resp.status_code == 201
+        resp = client.get(SPENDING_REPORT_URL + "?from=2018-01-01&to=2018-12-31&bucket=week")
+        body = json.loads(resp.data)
+        assert body["from"] == "2018-01-01"
+        assert body["items"] == [
+            {"week": "2018-04-30", "currency_type": "euro", "spent_amount": 20, "expense_count": 2},
+            {"week": "2018-05-07", "currency_type": "euro", "spent_amount": 10, "expense_count": 1}
+        ]
+        resp = client.get(SPENDING_REPORT_URL + "?to=2018-05-06&bucket=day")
+        body = json.loads(resp.data)
+        assert [item["day"] for item in body["items"]] == ["2018-05-03", "2018-05-06"]
+        
+        # the same rows as NDJSON and CSV
+        resp = client.get(SPENDING_REPORT_URL + "?to=2018-12-31",
+            headers={"Accept": "application/x-ndjson"})
+        assert resp.status_code == 200
+        assert resp.mimetype == "application/x-ndjson"
+        assert resp.headers["Vary"] == "Accept"
+        lines = [json.loads(line) for line in resp.data.decode().splitlines()]
+        assert lines == [{"month": "2018-05", "currency_type": "euro", "spent_amount": 30, "expense_count": 3}]
+        resp = client.get(SPENDING_REPORT_URL + "?to=2018-12-31", headers={"Accept": "text/csv"})
+        assert resp.mimetype == "text/csv"
+        assert resp.headers["Vary"] == "Accept"
+        assert resp.data.decode().splitlines() == [
+            "month,currency_type,spent_amount,expense_count",
+            "2018-05,euro,30.0,3"
+        ]
+        
+        resp = client.get(SPENDING_REPORT_URL + "?bucket=year")
+        assert resp.status_code == 400
+        resp = client.get(SPENDING_REPORT_URL + "?from=yesterday")
+        assert resp.status_code == 400
+        resp = client.get("/api/users/User-9/reports/spending")
+        assert resp.status_code == 404
+
+
+'''
+TEST FOR EXPENSE BATCH RESOURCE
+'''
+EXPENSE_BATCH_URL = "/api/users/User-1/budgets/Oulu-11/expenses:batch"
+INVALID_BATCH_URL = "/api/users/User-1/budgets/Oulu-51/expenses:batch"
+
+def test_ExpenseBatch_post(client):
+        invalid = _get_expense_json(6)
+        invalid.pop("expense_date")
+        batch = [_get_expense_json(4), _get_expense_json(5), _get_expense_json(11),
+            invalid, _get_expense_json(4)]
+        
+        # test with wrong content type
+        resp = client.post(EXPENSE_BATCH_URL, data=json.dumps(batch))
+        assert resp.status_code == 415
+        
+        # test with a single object instead of an array
+        resp = client.post(EXPENSE_BATCH_URL, json=_get_expense_json())
+        assert resp.status_code == 400
+        
+        resp = client.post(INVALID_BATCH_URL, json=batch)
+        assert resp.status_code == 404
+        
+        # every expense gets its own status
+        resp = client.post(EXPENSE_BATCH_URL, json=batch)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["status"] for item in body["items"]] == [201, 201, 409, 400, 409]
+        _check_control_get_method("self", client, body["items"][0])
+        
+        # same with NDJSON, the first two exist now
+        lines = "\n".join(json.dumps(item) for item in batch[:2] + [_get_expense_json(7)])
+        resp = client.post(EXPENSE_BATCH_URL, data=lines + "\n{bad\n",
+            content_type="application/x-ndjson")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["status"] for item in body["items"]] == [409, 409, 201, 400]
+        
+        resp = client.get(BUDGET_ITEM_URL)
+        assert len(json.loads(resp.data)["items"]) == 5
+        
+        # the running totals include the bulk inserted expenses
+        resp = client.get(BUDGET_SUMMARY_URL)
+        body = json.loads(resp.data)
+        assert body["expense_count"] == 5
+        assert body["spent_amount"] == 50
+        
+
+'''
+TEST FOR EXPENSE COLLECTION RESOURCE
+'''
+EXPENSE_COLLECTION_URL = "/api/users/User-1/budgets/Oulu-11/expenses/"
+
+def test_ExpenseCollection_get(client):
+        expenses = []
+        for number in range(25):
+            expense = _get_expense_json(100 + number)
+            expense["expense_date"] = "2020-01-{:02}".format(25 - number)
+            expenses.append(expense)
+        resp = client.post(EXPENSE_BATCH_URL, json=expenses)
+        assert resp.status_code == 200
+        
+        # the budget only embeds a preview and links to the expenses
+        body = json.loads(client.get(BUDGET_ITEM_URL).data)
+        assert len(body["items"]) == 10
+        assert body["@controls"]["budtrack:expenses"]["href"] == EXPENSE_COLLECTION_URL
+        
+        # following the next links gives every expense once in date order
+        for sort, first in (("expense_date", "Food-124"), ("-expense_date", "Food-12")):
+            url = EXPENSE_COLLECTION_URL + "?limit=10&sort=" + sort
+            names = []
+            pages = 0
+            while url:
+                resp = client.get(url)
+                assert resp.status_code == 200
+                body = json.loads(resp.data)
+                _check_namespace(client, body)
+                assert body["@controls"]["up"]["href"] == BUDGET_ITEM_URL
+                names.extend(item["expense_name"] for item in body["items"])
+                url = body["@controls"].get("next", {}).get("href")
+                pages += 1
+            assert pages == 3
+            assert len(names) == len(set(names)) == 27
+            assert names[0] == first
+        
+        # filters and cursors work together
+        resp = client.get(EXPENSE_COLLECTION_URL + "?limit=2&from=2020-01-10&to=2020-01-20")
+        body = json.loads(resp.data)
+        assert [item["expense_name"] for item in body["items"]] == ["Food-115", "Food-114"]
+        body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+        assert [item["expense_name"] for item in body["items"]] == ["Food-113", "Food-112"]
+        
+        # cursors are only valid for their own sort order
+        cursor = body["@controls"]["next"]["href"].split("after=")[1].split("&")[0]
+        resp = client.get(EXPENSE_COLLECTION_URL + "?sort=expense_name&after=" + cursor)
+        assert resp.status_code == 400
+        resp = client.get(EXPENSE_COLLECTION_URL + "?after=abc")
+        assert resp.status_code == 400
+        
+        # hand made cursors with values of the wrong type are refused too
+        for sort, value, expense_id in (("expense_amount", [1, 2], 1), ("expense_amount", True, 1),
+                ("expense_name", {}, 1), ("expense_name", 5, 1), ("expense_date", 5, 1),
+                ("expense_name", "Food-11", True)):
+            cursor = base64.urlsafe_b64encode(json.dumps([sort, value, expense_id]).encode())
+            resp = client.get(EXPENSE_COLLECTION_URL + "?sort={}&after={}".format(
+                sort, cursor.decode().rstrip("=")))
+            assert resp.status_code == 400
+        cursor = base64.urlsafe_b64encode(json.dumps(["expense_amount", 10, 1]).encode())
+        resp = client.get(EXPENSE_COLLECTION_URL + "?sort=expense_amount&after=" + cursor.decode())
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"]
+        
+        # the collection has the version of the budget
+        etag = client.get(EXPENSE_COLLECTION_URL, buffered=True).headers["ETag"]
+        resp = client.get(EXPENSE_COLLECTION_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        resp = client.get("/api/users/User-1/budgets/Oulu-51/expenses/")
+        assert resp.status_code == 404
+        
+        # the names of the collection and the summary are not expense names
+        for name in ("expenses", "summary"):
+            expense = _get_expense_json()
+            expense["expense_name"] = name
+            resp = client.post(BUDGET_ITEM_URL, json=expense)
+            assert resp.status_code == 400
+            resp = client.put(EXPENSE_ITEM_URL, json=expense)
+            assert resp.status_code == 400
+            resp = client.post(EXPENSE_BATCH_URL, json=[expense])
+            assert json.loads(resp.data)["items"][0]["status"] == 400
+        resp = client.get("/api/users/User-1/budgets/Oulu-11/expenses")
+        assert resp.status_code == 308
+
 '''
 TEST FOR EXPENSE ITEM RESOURCE
 '''
@@ -288,6 +632,25 @@ def test_ExpensetItem_get(client):
         assert resp.status_code == 404
 
 
+def test_ExpenseItem_etag(client):
+        etag = client.get(EXPENSE_ITEM_URL).headers["ETag"]
+        resp = client.get(EXPENSE_ITEM_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        resp = client.delete(EXPENSE_ITEM_URL, headers={"If-Match": '"0"'})
+        assert resp.status_code == 412
+        resp = client.delete(EXPENSE_ITEM_URL, headers={"If-Match": etag})
+        assert resp.status_code == 204
+
+def test_ExpenseItem_not_found(client):
+        # each missing level of the path gets its own 404 message
+        for url, missing in (("/api/users/User-9/budgets/Oulu-11/Food-11", "user"),
+                ("/api/users/User-1/budgets/Oulu-51/Food-11", "Budget"),
+                (EXPENSE_INVALID_URL, "Expense")):
+            resp = client.get(url)
+            assert resp.status_code == 404
+            body = json.loads(resp.data)
+            assert body["@error"]["@messages"][0].startswith("No {} was found".format(missing))
+
 def test_UserItem_put(client):
         valid = _get_expense_json()
         
@@ -327,4 +690,90 @@ def test_BudgetItem_delete(client):
 
         
             
-    
\ No newline at end of file
+    
+'''
+TEST FOR THE RESPONSE CACHE
+'''
+def test_response_cache(client):
+        cache = app.ResponseCache(max_entries=2, ttl=60)
+        client.application.extensions["response_cache"] = cache
+        # streamed listings are never cached
+        client.application.config["JSON_STREAM_ITEMS"] = False
+        
+        # the second request is served from the cache
+        resp = client.get(BUDGET_ITEM_URL)
+        assert resp.headers["X-Cache"] == "MISS"
+        etag = resp.headers["ETag"]
+        resp = client.get(BUDGET_ITEM_URL)
+        assert resp.headers["X-Cache"] == "HIT"
+        assert resp.headers["ETag"] == etag
+        assert len(json.loads(resp.data)["items"]) == 2
+        resp = client.get(BUDGET_ITEM_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        
+        # adding an expense drops the budget and its summary
+        client.get(BUDGET_SUMMARY_URL)
+        resp = client.post(BUDGET_ITEM_URL, json=_get_expense_json())
+        assert resp.status_code == 201
+        resp = client.get(BUDGET_ITEM_URL)
+        assert resp.headers["X-Cache"] == "MISS"
+        assert len(json.loads(resp.data)["items"]) == 3
+        resp = client.get(BUDGET_SUMMARY_URL)
+        assert resp.headers["X-Cache"] == "MISS"
+        assert json.loads(resp.data)["expense_count"] == 3
+        
+        # changing an expense drops it
+        client.get(EXPENSE_ITEM_URL)
+        valid = _get_expense_json()
+        valid["expense_name"] = "Food-11"
+        resp = client.put(EXPENSE_ITEM_URL, json=valid)
+        assert resp.status_code == 204
+        resp = client.get(EXPENSE_ITEM_URL)
+        assert resp.headers["X-Cache"] == "MISS"
+        assert json.loads(resp.data)["expense_description"] == valid["expense_description"]
+        
+        # errors are not cached and the least recently used entry is evicted
+        assert client.get(INVALID_URL).headers["X-Cache"] == "MISS"
+        assert client.get(INVALID_URL).headers["X-Cache"] == "MISS"
+        client.get(BUDGET_COLLECTION_URL)
+        stats = cache.stats()
+        assert stats["entries"] == 2
+        assert stats["hits"] == 2
+        assert stats["evictions"] == 1
+        assert stats["invalidations"] == 4
+        
+        # a response read before a write invalidated it is not stored
+        generation = cache.generation()
+        cache.invalidate(EXPENSE_ITEM_URL)
+        assert not cache.set(EXPENSE_ITEM_URL + "?", "old", generation)
+        assert cache.set(BUDGET_ITEM_URL + "?", "other", generation)
+        assert cache.set(EXPENSE_ITEM_URL + "?", "new", cache.generation())
+        
+        # a write that commits while a GET reads the database
+        def racing_get(*args, **kwargs):
+            resp = client.put(EXPENSE_ITEM_URL, json=valid)
+            assert resp.status_code == 204
+            return get(*args, **kwargs)
+        get = app.ExpenseItem.get.__wrapped__
+        cache.invalidate(EXPENSE_ITEM_URL)
+        original = app.ExpenseItem.get
+        app.ExpenseItem.get = app.cached_response(racing_get)
+        try:
+            assert client.get(EXPENSE_ITEM_URL).headers["X-Cache"] == "MISS"
+        finally:
+            app.ExpenseItem.get = original
+        assert client.get(EXPENSE_ITEM_URL).headers["X-Cache"] == "MISS"
+
+def test_stream_items(client):
+        # streamed listings have the same content as encoded ones
+        for url in (BUDGET_COLLECTION_URL, BUDGET_ITEM_URL):
+            client.application.config["JSON_STREAM_ITEMS"] = False
+            resp = client.get(url)
+            body = json.loads(resp.data)
+            client.application.config["JSON_STREAM_ITEMS"] = True
+            resp = client.get(url)
+            assert resp.status_code == 200
+            assert resp.is_streamed
+            assert "ETag" in resp.headers
+            assert json.loads(resp.data) == body
+            assert list(json.loads(resp.data))[0] == "items"
@@ -1,8 +1,358 @@
+import argparse
 import json
 import requests
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from requests.adapters import HTTPAdapter
 
 API_URL = "http://127.0.0.1:5000"
+ENTRY_POINT = "/api/"
+MASON = "application/vnd.mason+json"
+#Operations run at the same time by BudgetClient.batch
+MAX_WORKERS = 8
+#Operations of the batch mode and the fields of an operation that are passed
+#to the BudgetClient method of the same name as its arguments
+OPERATIONS = {
+    "users": (),
+    "create_user": ("data", ),
+    "edit_user": ("user", "data"),
+    "delete_user": ("user", ),
+    "user_budgets": ("user", ),
+    "create_budget": ("user", "data"),
+    "add_expense": ("user", "budget", "data"),
+}
+
+
+class APIError(Exception):
+    """
+    Raised when a resource the client needs can not be read, e.g. a user
+    that does not exist.
+    """
+
+    def __init__(self, resp):
+        self.response = resp
+        try:
+            message = resp.json()["@error"]["@messages"][0]
+        except (ValueError, KeyError, IndexError, TypeError):
+            message = resp.reason
+        super(APIError, self).__init__("{} {}: {}".format(
+            resp.status_code, resp.request.url, message))
+
+
+class BudgetClient(object):
+    """
+    Client of the API that keeps one session, so connections are pooled and
+    reused between operations, and caches the controls of every resource it
+    has read. After the first operation on a resource the next ones only
+    need the request that submits the control. Safe to use from several
+    threads, batch runs many operations concurrently.
+    """
+
+    def __init__(self, api_url=API_URL, max_workers=MAX_WORKERS):
+        self.api_url = api_url
+        self.max_workers = max_workers
+        self.session = requests.Session()
+        self.session.headers.update({"Accept": MASON + ", */*"})
+        #Keep a connection for every worker thread
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._controls = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        self.session.close()
+
+    def get(self, href, **params):
+        """
+        Reads a resource and returns its body. Raises APIError if it can not
+        be read.
+
+        : param str href: the href of the resource
+        : param params: query parameters
+        """
+
+        resp = self.session.get(self.api_url + href, params=params)
+        if resp.status_code != 200:
+            raise APIError(resp)
+        return resp.json()
+
+    def controls(self, href):
+        """
+        Returns the controls of a resource. They are read once, without the
+        fields and items of the resource, and cached by href.
+
+        : param str href: the href of the resource
+        """
+
+        with self._lock:
+            controls = self._controls.get(href)
+        if controls is None:
+            controls = self.get(href, fields="", limit=1).get("@controls", {})
+            with self._lock:
+                self._controls[href] = controls
+        return controls
+
+    def control(self, href, name):
+        """
+        Returns one control of a resource, with its schema if it has one.
+        Raises KeyError if the resource does not have it.
+
+        : param str href: the href of the resource
+        : param str name: name of the control, e.g. "budtrack:add-user"
+        """
+
+        return self.controls(href)[name]
+
+    def forget(self, href):
+        """
+        Drops the cached controls of a resource and of everything below it,
+        for when it has been renamed or deleted.
+
+        : param str href: the href of the resource
+        """
+
+        with self._lock:
+            for cached in [cached for cached in self._controls if cached.startswith(href)]:
+                del self._controls[cached]
+
+    def submit(self, ctrl, data=None):
+        """
+        Sends the request of a control and returns the response.
+
+        : param dict ctrl: the control
+        : param data: the document to send, if the control takes one
+        """
+
+        return self.session.request(
+            ctrl.get("method", "GET"),
+            self.api_url + ctrl["href"],
+            data=json.dumps(data) if data is not None else None,
+            headers={"Content-type": "application/json"}
+        )
+
+    def users_href(self):
+        return self.control(ENTRY_POINT, "budtrack:users-all")["href"]
+
+    def user_href(self, user):
+        return self.users_href() + quote(user, safe="") + "/"
+
+    def budgets_href(self, user):
+        return self.control(self.user_href(user), "budtrack:budget-by")["href"]
+
+    def budget_href(self, user, budget):
+        return self.budgets_href(user) + "/" + quote(budget, safe="")
+
+    def users(self):
+        """
+        Returns every user, following the pages of the user collection.
+        """
+
+        users = []
+        href = self.users_href()
+        while href is not None:
+            body = self.get(href)
+            users.extend(body["items"])
+            href = body["@controls"].get("next", {}).get("href")
+        return users
+
+    def create_user(self, data):
+        ctrl = self.control(self.users_href(), "budtrack:add-user")
+        return self.submit(ctrl, data)
+
+    def edit_user(self, user, data):
+        href = self.user_href(user)
+        resp = self.submit(self.control(href, "edit"), data)
+        if resp.status_code < 400:
+            self.forget(href)
+        return resp
+
+    def delete_user(self, user):
+        href = self.user_href(user)
+        resp = self.submit(self.control(href, "budtrack:delete"))
+        if resp.status_code < 400:
+            self.forget(href)
+        return resp
+
+    def user_budgets(self, user):
+        return self.get(self.budgets_href(user))["items"]
+
+    def create_budget(self, user, data):
+        ctrl = self.control(self.budgets_href(user), "budtrack:add-budget")
+        return self.submit(ctrl, data)
+
+    def add_expense(self, user, budget, data):
+        ctrl = self.control(self.budget_href(user, budget), "budtrack:add-expense")
+        return self.submit(ctrl, data)
+
+    def batch(self, operations, timed=False):
+        """
+        Runs many operations concurrently on a pool of max_workers threads.
+        Operations are (name, args) tuples of a method and its arguments,
+        e.g. ("create_user", (data, )). Returns their results in the same
+        order, an operation that fails gives its exception as its result.
+        If timed is set, the results are (result, seconds) tuples instead.
+
+        : param iterable operations: the operations to run
+        : param bool timed: whether to time the operations
+        """
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers)
+
+        def run(operation):
+            name, args = operation
+            started = time.perf_counter()
+            try:
+                result = getattr(self, name)(*args)
+            except (APIError, KeyError, requests.RequestException) as e:
+                result = e
+            if timed:
+                return result, time.perf_counter() - started
+            return result
+        return list(self._executor.map(run, operations))
+
+
+def read_operations(path):
+    """
+    Reads the operations of the batch mode from a JSONL file, one JSON
+    object per line, e.g.
+    {"op": "create_budget", "user": "User-1", "data": {...}}
+    Empty lines are skipped. Raises ValueError for an unknown operation or a
+    missing field, and for a line that is not a JSON object. Returns
+    (line number, name, args) tuples.
+
+    : param str path: the file
+    """
+
+    operations = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                operation = json.loads(line)
+            except ValueError as e:
+                raise ValueError("Line {}: invalid JSON, {}".format(number, e))
+            if not isinstance(operation, dict):
+                raise ValueError("Line {}: operations must be JSON objects".format(number))
+            name = operation.get("op")
+            if name not in OPERATIONS:
+                raise ValueError("Line {}: unknown operation {!r}".format(number, name))
+            try:
+                args = tuple(operation[field] for field in OPERATIONS[name])
+            except KeyError as e:
+                raise ValueError("Line {}: {} needs {}".format(number, name, e))
+            operations.append((number, name, args))
+    return operations
+
+
+def operation_users(name, args):
+    """
+    Returns the names of the users an operation reads or changes, or None if
+    it reads all of them.
+    """
+
+    if name == "users":
+        return None
+    users = set()
+    if "user" in OPERATIONS[name]:
+        users.add(args[OPERATIONS[name].index("user")])
+    if "data" in OPERATIONS[name] and "user_name" in args[-1]:
+        users.add(args[-1]["user_name"])
+    return users
+
+
+def pipeline(operations):
+    """
+    Splits operations into stages that can each run concurrently. Operations
+    on different users are independent, so every operation goes to the stage
+    after the last one that touches any of its users, and an operation that
+    reads all users waits for everything before it. The order of the
+    operations of every user is kept.
+
+    : param list operations: (line number, name, args) tuples
+    """
+
+    stages = []
+    last = {}
+    floor = 0
+    for operation in operations:
+        users = operation_users(operation[1], operation[2])
+        if users is None:
+            stage = len(stages)
+            floor = stage + 1
+        else:
+            stage = max([floor] + [last[user] + 1 for user in users if user in last])
+            for user in users:
+                last[user] = stage
+        if stage == len(stages):
+            stages.append([])
+        stages[stage].append(operation)
+    return stages
+
+
+def describe_result(result):
+    """
+    Returns (ok, text) for the result of an operation: a response, a list of
+    items or an exception.
+    """
+
+    if isinstance(result, Exception):
+        return False, "{}: {}".format(type(result).__name__, result)
+    if isinstance(result, list):
+        return True, "{} items".format(len(result))
+    if result.status_code >= 400:
+        try:
+            message = result.json()["@error"]["@messages"][0]
+        except (ValueError, KeyError, IndexError, TypeError):
+            message = result.reason
+        return False, "{} {}".format(result.status_code, message)
+    return True, str(result.status_code)
+
+
+def run_batch(path, api_url=API_URL, max_workers=MAX_WORKERS, out=sys.stdout):
+    """
+    Runs the operations of a JSONL file over one client, each stage of
+    pipeline concurrently, and prints the result and time of every operation
+    and a summary. Returns the number of failed operations.
+
+    : param str path: the operations file
+    : param str api_url: address of the API
+    : param int max_workers: operations run at the same time
+    """
+
+    operations = read_operations(path)
+    failed = 0
+    started = time.perf_counter()
+    with BudgetClient(api_url, max_workers) as batch_client:
+        for stage in pipeline(operations):
+            results = batch_client.batch([(name, args) for _, name, args in stage], timed=True)
+            for (number, name, _), (result, seconds) in zip(stage, results):
+                ok, text = describe_result(result)
+                failed += not ok
+                print("{:>5} {:<14} {:>8.1f} ms  {}".format(
+                    number, name, seconds * 1000, text), file=out)
+    print("{} operations, {} failed, {:.2f} s".format(
+        len(operations), failed, time.perf_counter() - started), file=out)
+    return failed
+
+
+#Client of the prompts, made when they start so that importing this module
+#does not open a session
+client = None
 
 def prompt_client_options():
     print("--------------------------")
@@ -18,111 +368,85 @@ def prompt_client_options():
 
 
 def get_users():
-    with requests.Session() as s:
-        s.headers.update({"Accept": "application/vnd.mason+json, */*"})
-        resp = s.get(API_URL + "/api/users")
-        if resp.status_code != 200:
-            print("Unable to access API.")
+    try:
+        users = client.users()
+    except APIError:
+        print("Unable to access API.")
+    else:
+        if len(users) == 0:
+            print("No user is present")
         else:
-            body = resp.json()
-            if len(body["items"]) == 0:
-                print("No user is present")
-            else:
-                for usr in body["items"]:
-                    print ("Name: " + usr["user_name"])
-                    print ("Email: " + usr["user_email"])
-                    print("-----------")
+            for usr in users:
+                print ("Name: " + usr["user_name"])
+                print ("Email: " + usr["user_email"])
+                print("-----------")
 
 def create_user():
-    with requests.Session() as s:
-        s.headers.update({"Accept": "application/vnd.mason+json, */*"})
-        resp = s.get(API_URL + "/api/users")
-        if resp.status_code != 200:
-            print("Unable to access API.")
-        else:
-            body = resp.json()
-            ctrl = body["@controls"]["budtrack:add-user"]
-            schema = ctrl["schema"]
-            data = {}
-            for field in schema["required"]:
-                data[field] = convert_value(input(schema["properties"][field]["description"]+": "),schema["properties"][field]["type"]) 
-            
-            submit_data(s,ctrl,data)
-            
+    try:
+        ctrl = client.control(client.users_href(), "budtrack:add-user")
+    except APIError:
+        print("Unable to access API.")
+    else:
+        submit_data(client.session, ctrl, prompt_schema(ctrl["schema"]))
+
 
 def edit_user_info():
     usr_nm= prompt_usersearch_option()
-    with requests.Session() as s:
-        s.headers.update({"Accept": "application/vnd.mason+json, */*"})
-        resp = s.get(API_URL + "/api/users/" + usr_nm)
-        if resp.status_code != 200:
-            print("No user found!")
-        else:
-            body = resp.json()
-            ctrl = body["@controls"]["edit"]
-            schema = ctrl["schema"]
-            data = {}
-            for field in schema["required"]:
-                data[field] = convert_value(input(schema["properties"][field]["description"]+": "),schema["properties"][field]["type"]) 
-            
-            submit_data(s,ctrl,data)
+    try:
+        ctrl = client.control(client.user_href(usr_nm), "edit")
+    except APIError:
+        print("No user found!")
+    else:
+        resp = submit_data(client.session, ctrl, prompt_schema(ctrl["schema"]))
+        if resp.status_code < 400:
+            client.forget(client.user_href(usr_nm))
 
 def delete_user():
     usr_nm= prompt_usersearch_option()
-    with requests.Session() as s:
-        s.headers.update({"Accept": "application/vnd.mason+json, */*"})
-        resp = s.get(API_URL + "/api/users/" + usr_nm)
-        if resp.status_code != 200:
-            print("No user found!")
-        else:
-            body = resp.json()
-            ctrl = body["@controls"]["budtrack:delete"]
-            data = {}
-            submit_data(s,ctrl,data)
+    try:
+        client.delete_user(usr_nm)
+    except APIError:
+        print("No user found!")
 
 
 def get_user_budgets():
     usr_nm= prompt_usersearch_option()
-    with requests.Session() as s:
-        s.headers.update({"Accept": "application/vnd.mason+json, */*"})
-        resp = s.get(API_URL + "/api/users/" + usr_nm + "/budgets")
-        if resp.status_code != 200:
-            print("No user found!")
+    try:
+        budgets = client.user_budgets(usr_nm)
+    except APIError:
+        print("No user found!")
+    else:
+        if len(budgets) == 0:
+            print("No budget is present")
         else:
-            body = resp.json()
-            if len(body["items"]) == 0:
-                print("No budget is present")
-            else:
-                for bud in body["items"]:
-                    print ("Name: " + bud["budget_name"])
-                    print ("Description: " + bud["budget_description"])
-                    print ("Currency: " + bud["currency_type"])
-                    print ("Amount: " + str(bud["budget_amount"]))
-                    print ("Start date: " + bud["start_date"])
-                    print ("End date: " + bud["end_date"])
-                    print("-----------")
+            for bud in budgets:
+                print ("Name: " + bud["budget_name"])
+                print ("Description: " + bud["budget_description"])
+                print ("Currency: " + bud["currency_type"])
+                print ("Amount: " + str(bud["budget_amount"]))
+                print ("Start date: " + bud["start_date"])
+                print ("End date: " + bud["end_date"])
+                print("-----------")
 
 def create_user_budget():
     usr_nm= prompt_usersearch_option()
-    with requests.Session() as s:
-        s.headers.update({"Accept": "application/vnd.mason+json, */*"})
-        resp = s.get(API_URL + "/api/users/" + usr_nm+ "/budgets")
-        if resp.status_code != 200:
-            print("No user found!")
-        else:
-            print("NOTE: Enter date in format yyyy-mm-dd")
-            body = resp.json()
-            ctrl = body["@controls"]["budtrack:add-budget"]
-            schema = ctrl["schema"]
-            data = {}
-            for field in schema["required"]:
-                data[field] = convert_value(input(schema["properties"][field]["description"]+": "),schema["properties"][field]["type"]) 
-            
-            submit_data(s,ctrl,data)
+    try:
+        ctrl = client.control(client.budgets_href(usr_nm), "budtrack:add-budget")
+    except APIError:
+        print("No user found!")
+    else:
+        print("NOTE: Enter date in format yyyy-mm-dd")
+        submit_data(client.session, ctrl, prompt_schema(ctrl["schema"]))
 
 def prompt_usersearch_option():
     return input("Enter the user name: ")
 
+def prompt_schema(schema):
+    data = {}
+    for field in schema["required"]:
+        data[field] = convert_value(input(schema["properties"][field]["description"]+": "),schema["properties"][field]["type"])
+    return data
+
 def submit_data(s, ctrl, data):
     resp = s.request(
         ctrl["method"],
@@ -150,12 +474,19 @@ options = {1 : get_users,
 
 
 if __name__ == "__main__":
-    try:
-        root_path = sys.argv[1]
-    except IndexError:
-        root_path = "."
+    parser = argparse.ArgumentParser(description="Console client of the budget tracker.")
+    parser.add_argument("--batch", metavar="FILE",
+        help="run the operations of a JSONL file instead of prompting")
+    parser.add_argument("--url", default=API_URL, help="address of the API in batch mode")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS,
+        help="operations run at the same time in batch mode")
+    args = parser.parse_args()
+
+    if args.batch:
+        sys.exit(1 if run_batch(args.batch, args.url, args.workers) else 0)
 
+    client = BudgetClient()
     #Step 1 prompt users with options
     opr = prompt_client_options()
     #Step 2 call the desired function
-    options[opr]()
\ No newline at end of file
+    options[opr]()
@@ -0,0 +1,342 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import httpx
+import pytest
+from flask import request
+from werkzeug.serving import make_server
+import app
+import client
+from async_client import AsyncBudgetClient, read_records
+from client import OPERATIONS, APIError, BudgetClient, pipeline, read_operations
+
+USERS_URL = "http://api.test/api/users/"
+
+
+@pytest.fixture
+def api():
+    """
+    Serves the API from a temporary database on a local port. Yields the
+    address of the API and the list of the requests it has answered.
+    """
+    db_fd, db_fname = tempfile.mkstemp()
+    api_app = app.create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname})
+    served = []
+
+    @api_app.after_request
+    def log_request(resp):
+        served.append((request.method, request.path))
+        return resp
+
+    with api_app.app_context():
+        app.db.create_all()
+    server = make_server("127.0.0.1", 0, api_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    yield "http://127.0.0.1:{}".format(server.server_port), served
+
+    server.shutdown()
+    with api_app.app_context():
+        app.db.session.remove()
+        app.db.engine.dispose()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+def _async_client(handler, **kwargs):
+    """
+    Makes an AsyncBudgetClient that sends its requests to a handler instead
+    of the network, without waiting between retries.
+    """
+    kwargs.setdefault("backoff", 0)
+    return AsyncBudgetClient("http://api.test", transport=httpx.MockTransport(handler), **kwargs)
+
+def _run(client, coroutine):
+    async def run():
+        async with client:
+            return await coroutine(client)
+    return asyncio.run(run())
+
+def test_async_retries():
+    """
+    Tests that retried statuses and connection errors are retried as many
+    times as asked and that the last response or error is given back.
+    """
+    calls = []
+
+    def flaky(request):
+        calls.append(request.url.path)
+        return httpx.Response(503 if len(calls) < 3 else 201)
+
+    resp = _run(_async_client(flaky, retries=3), lambda c: c.request("POST", "/api/users/"))
+    assert resp.status_code == 201
+    assert len(calls) == 3
+
+    #the last response is given back when the retries run out
+    calls.clear()
+    resp = _run(_async_client(flaky, retries=1), lambda c: c.request("POST", "/api/users/"))
+    assert resp.status_code == 503
+    assert len(calls) == 2
+
+    #other errors are not retried
+    def invalid(request):
+        calls.append(1)
+        return httpx.Response(400)
+
+    calls.clear()
+    resp = _run(_async_client(invalid), lambda c: c.request("POST", "/api/users/"))
+    assert resp.status_code == 400
+    assert len(calls) == 1
+
+    def down(request):
+        calls.append(1)
+        raise httpx.ConnectError("refused", request=request)
+
+    calls.clear()
+    with pytest.raises(httpx.ConnectError):
+        _run(_async_client(down, retries=2), lambda c: c.request("GET", "/api/"))
+    assert len(calls) == 3
+
+def test_async_controls():
+    """
+    Tests that concurrent callers share one read of the controls of a
+    resource and that a failed read is not kept.
+    """
+    calls = []
+    status = {"code": 500}
+
+    def users(request):
+        calls.append(str(request.url))
+        if status["code"] != 200:
+            return httpx.Response(status["code"])
+        return httpx.Response(200, json={"@controls": {
+            "budtrack:add-user": {"href": "/api/users/", "method": "POST"}}})
+
+    async def read(client):
+        with pytest.raises(LookupError):
+            await client.control(USERS_URL, "budtrack:add-user")
+        status["code"] = 200
+        controls = await asyncio.gather(*(client.control(USERS_URL, "budtrack:add-user")
+            for _ in range(5)))
+        with pytest.raises(LookupError):
+            await client.control(USERS_URL, "budtrack:delete")
+        return controls
+
+    controls = _run(_async_client(users, retries=0), read)
+    assert all(ctrl["method"] == "POST" for ctrl in controls)
+    #one failed read and one shared by every later caller
+    assert len(calls) == 2
+
+def test_async_create():
+    """
+    Tests that records are created through the controls and that failures
+    are reported with the message of the API.
+    """
+    created = []
+
+    def api(request):
+        path = request.url.path
+        if request.method == "GET" and path == "/api/":
+            return httpx.Response(200, json={"@controls": {
+                "budtrack:users-all": {"href": "/api/users/"}}})
+        if request.method == "GET" and path == "/api/users/":
+            return httpx.Response(200, json={"@controls": {"budtrack:add-user": {
+                "href": "/api/users/", "method": "POST", "schema": {"properties": {
+                    "user_name": {"type": "string"}, "password": {"type": "string"}}}}}})
+        document = json.loads(request.content)
+        if document["user_name"] in created:
+            return httpx.Response(409, json={"@error": {"@messages": ["exists"]}})
+        created.append(document["user_name"])
+        return httpx.Response(201)
+
+    records = [{"type": "user", "user_name": "a", "password": "x"},
+        {"type": "user", "user_name": "a", "password": "x", "extra": "ignored"}]
+    results = _run(_async_client(api), lambda c: c.run(records))
+    assert sorted((status, error) for record, status, error in results) == \
+        [(201, None), (409, "exists")]
+    assert created == ["a"]
+
+def test_async_create_invalid_value():
+    """
+    Tests that a record with a value that can not be converted fails alone
+    and the others are still created.
+    """
+    created = []
+
+    def api(request):
+        path = request.url.path
+        if path == "/api/":
+            return httpx.Response(200, json={"@controls": {
+                "budtrack:users-all": {"href": "/api/users/"}}})
+        if path == "/api/users/a/":
+            return httpx.Response(200, json={"@controls": {
+                "budtrack:budget-by": {"href": "/api/users/a/budgets"}}})
+        if request.method == "GET" and path == "/api/users/a/budgets/b":
+            return httpx.Response(200, json={"@controls": {"budtrack:add-expense": {
+                "href": "/api/users/a/budgets/b", "method": "POST", "schema": {"properties": {
+                    "expense_name": {"type": "string"}, "expense_amount": {"type": "number"}}}}}})
+        document = json.loads(request.content)
+        created.append((document["expense_name"], document["expense_amount"]))
+        return httpx.Response(201)
+
+    records = [{"type": "expense", "user": "a", "budget": "b", "expense_name": name,
+        "expense_amount": amount} for name, amount in (("x", "1.5"), ("y", "ten"), ("z", "3"))]
+    results = _run(_async_client(api), lambda c: c.run(records))
+    assert [(status, error is None) for record, status, error in results] == \
+        [(201, True), (None, False), (201, True)]
+    assert "ten" in results[1][2]
+    assert sorted(created) == [("x", 1.5), ("z", 3.0)]
+
+def test_read_records(tmpdir):
+    """
+    Tests that records are read from CSV and JSON files and that records
+    without a valid type are rejected.
+    """
+    path = tmpdir.join("records.csv")
+    path.write("type,user_name,user\nuser,a,\nbudget,,a\n")
+    records = read_records(str(path))
+    assert [record["type"] for record in records] == ["user", "budget"]
+    assert records[1]["user"] == "a"
+
+    path = tmpdir.join("records.json")
+    path.write(json.dumps([{"type": "expense", "user": "a", "budget": "b"}]))
+    assert read_records(str(path))[0]["budget"] == "b"
+
+    path.write(json.dumps([{"type": "user"}, {"type": "account"}]))
+    with pytest.raises(ValueError) as e:
+        read_records(str(path))
+    assert "Record 2" in str(e.value)
+    path.write(json.dumps([{"user_name": "a"}]))
+    with pytest.raises(ValueError):
+        read_records(str(path))
+
+def _operations(*lines):
+    return [(number, op["op"], tuple(op.get(field) for field in OPERATIONS[op["op"]]))
+        for number, op in enumerate(lines, 1)]
+
+def test_read_operations(tmpdir):
+    """
+    Tests that operations are read from a JSONL file with their line numbers
+    and that invalid lines are rejected with their number.
+    """
+    path = tmpdir.join("operations.jsonl")
+    path.write('{"op": "users"}\n\n{"op": "add_expense", "user": "a", "budget": "b", "data": {}}\n')
+    assert read_operations(str(path)) == [(1, "users", ()), (3, "add_expense", ("a", "b", {}))]
+
+    for line, message in (
+            ('{"op": "rename_user"}', "Line 2: unknown operation 'rename_user'"),
+            ('{"user": "a"}', "Line 2: unknown operation None"),
+            ('{"op": "create_budget", "user": "a"}', "Line 2: create_budget needs 'data'"),
+            ('{"op": "users"', "Line 2: invalid JSON"),
+            ('["users"]', "Line 2: operations must be JSON objects")):
+        path.write('{"op": "users"}\n' + line + "\n")
+        with pytest.raises(ValueError) as e:
+            read_operations(str(path))
+        assert str(e.value).startswith(message)
+
+def test_pipeline():
+    """
+    Tests that operations on different users share stages, that the order
+    of the operations of every user is kept, renames included, and that
+    listing all users waits for everything before it.
+    """
+    operations = _operations(
+        {"op": "create_user", "data": {"user_name": "a"}},
+        {"op": "create_user", "data": {"user_name": "b"}},
+        {"op": "create_budget", "user": "a", "data": {}},
+        {"op": "add_expense", "user": "a", "budget": "x", "data": {}},
+        {"op": "user_budgets", "user": "b"},
+        {"op": "edit_user", "user": "b", "data": {"user_name": "c"}},
+        {"op": "create_user", "data": {"user_name": "c"}},
+        {"op": "users"},
+        {"op": "delete_user", "user": "d"},
+        {"op": "delete_user", "user": "a"},
+        {"op": "users"},
+        {"op": "users"},
+    )
+    stages = [[operation[0] for operation in stage] for stage in pipeline(operations)]
+    assert stages == [
+        [1, 2],
+        [3, 5],
+        [4, 6],
+        #the rename to c has to happen before c is created
+        [7],
+        [8],
+        [9, 10],
+        [11],
+        [12],
+    ]
+    assert pipeline([]) == []
+
+def _user(name):
+    return {"user_name": name, "user_email": name + "@example.com", "password": "secret"}
+
+def _budget(name):
+    return {"budget_name": name, "budget_description": "my budget", "currency_type": "euro",
+        "budget_amount": 100, "start_date": "2020-01-01", "end_date": "2020-01-31"}
+
+def test_no_client_on_import():
+    """
+    Tests that importing the client module does not make the client of the
+    prompts.
+    """
+    assert client.client is None
+
+def test_budget_client_controls(api):
+    """
+    Tests that the controls of a resource are read once and that renaming or
+    deleting a user drops the cached controls of it and its budgets.
+    """
+    url, served = api
+    with BudgetClient(url) as budget_client:
+        for name in ("a", "b", "c"):
+            assert budget_client.create_user(_user(name)).status_code == 201
+        assert served.count(("GET", "/api/")) == 1
+        assert served.count(("GET", "/api/users/")) == 1
+
+        assert budget_client.create_budget("a", _budget("x")).status_code == 201
+        assert budget_client.create_budget("a", _budget("y")).status_code == 201
+        assert served.count(("GET", "/api/users/a/budgets")) == 1
+        assert budget_client.user_href("a") in budget_client._controls
+
+        #the old name is forgotten after a rename and the new one works
+        assert budget_client.edit_user("a", _user("d")).status_code == 204
+        assert not any(href.startswith("/api/users/a/") for href in budget_client._controls)
+        with pytest.raises(APIError):
+            budget_client.create_budget("a", _budget("z"))
+        assert [budget["budget_name"] for budget in budget_client.user_budgets("d")] == ["x", "y"]
+
+        assert budget_client.delete_user("b").status_code == 204
+        assert budget_client.user_href("b") not in budget_client._controls
+        with pytest.raises(APIError):
+            budget_client.user_budgets("b")
+        assert sorted(user["user_name"] for user in budget_client.users()) == ["c", "d"]
+
+def test_budget_client_batch(api):
+    """
+    Tests that batch gives the results in the order of the operations, with
+    the exceptions of the ones that failed, and times them if asked.
+    """
+    url, served = api
+    with BudgetClient(url, max_workers=4) as budget_client:
+        names = ["user-{}".format(number) for number in range(0, 24, 2)]
+        results = budget_client.batch([("create_user", (_user(name), )) for name in names])
+        assert [resp.status_code for resp in results] == [201] * 12
+
+        #the odd users are new, the even ones exist already
+        names = ["user-{}".format(number) for number in range(24)]
+        results = budget_client.batch([("create_user", (_user(name), )) for name in names])
+        assert [resp.status_code for resp in results] == [409, 201] * 12
+
+        results = budget_client.batch([
+            ("create_budget", ("user-0", _budget("x"))),
+            ("create_budget", ("nobody", _budget("x"))),
+            ("create_user", (_user("user-0"), )),
+            ("user_budgets", ("user-0", )),
+        ], timed=True)
+        assert results[0][0].status_code == 201
+        assert isinstance(results[1][0], APIError)
+        assert results[2][0].status_code == 409
+        assert all(seconds >= 0 for result, seconds in results)
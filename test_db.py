@@ -1,12 +1,16 @@
+import json
 import os
 import pytest
 import tempfile
 import datetime
 import app
+from flask import current_app
 from app import User, Budget, Expense
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, InvalidRequestError
+from sqlalchemy.orm import selectinload
+from sqlalchemy.pool import QueuePool
 
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
@@ -17,15 +21,18 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
 @pytest.fixture
 def db_handle():
     db_fd, db_fname = tempfile.mkstemp()
-    app.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_fname
-    app.app.config["TESTING"] = True
+    flask_app = app.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True
+    })
     
-    with app.app.app_context():
+    with flask_app.app_context():
         app.db.create_all()
         
-    yield app.db
+        yield app.db
     
-    app.db.session.remove()
+        app.db.session.remove()
+        app.db.get_engine().dispose()
     os.close(db_fd)
     os.unlink(db_fname)
 
@@ -79,8 +86,9 @@ def test_create_instances(db_handle):
     assert Budget.query.count() == 1
     assert Expense.query.count() == 1
 
-    db_user = User.query.first()
-    db_bugdet = Budget.query.first()
+    # The collections are only loaded when a query asks for them
+    db_user = User.query.options(selectinload(User.budgets)).first()
+    db_bugdet = Budget.query.options(selectinload(Budget.expenses)).first()
     db_expense = Expense.query.first()
     
     # Check all relationships (both sides)
@@ -89,6 +97,9 @@ def test_create_instances(db_handle):
     
     assert db_bugdet in db_user.budgets
     assert db_expense in db_bugdet.expenses
+    db_handle.session.expire_all()
+    with pytest.raises(InvalidRequestError):
+        User.query.first().budgets
 
 
 def test_user_ondelete(db_handle):
@@ -176,4 +187,329 @@ def test_user_budget_unique(db_handle):
     db_handle.session.add(budget_1)
     db_handle.session.add(budget_2)    
     with pytest.raises(IntegrityError):
-        db_handle.session.commit()
\ No newline at end of file
+        db_handle.session.commit()
+
+def test_budget_totals(db_handle):
+    """
+    Tests that the running totals of a budget follow its expenses when they
+    are added, changed and deleted, and that rebuild-totals finds and repairs
+    totals that have drifted.
+    """
+    budget = _get_budget()
+    expense = _get_expense()
+    expense.budget = budget
+    db_handle.session.add(expense)
+    db_handle.session.commit()
+
+    db_budget = Budget.query.first()
+    assert db_budget.spent_amount == 1
+    assert db_budget.expense_count == 1
+    assert db_budget.last_expense_date == expense.expense_date
+
+    #Change the amount and add another expense
+    db_expense = Expense.query.first()
+    db_expense.expense_amount = 3
+    new_expense = _get_expense()
+    new_expense.expense_name = "new expense"
+    new_expense.expense_amount = 4
+    new_expense.budget = db_budget
+    db_handle.session.add(new_expense)
+    db_handle.session.commit()
+    assert db_budget.spent_amount == 7
+    assert db_budget.expense_count == 2
+    assert db_budget.last_expense_date == new_expense.expense_date
+
+    #Delete the newest one
+    db_handle.session.delete(new_expense)
+    db_handle.session.commit()
+    assert db_budget.spent_amount == 3
+    assert db_budget.expense_count == 1
+    assert db_budget.last_expense_date == db_expense.expense_date
+
+    #Break the totals and let the command find and repair them
+    runner = current_app.test_cli_runner()
+    db_budget.spent_amount = 100
+    db_handle.session.commit()
+    result = runner.invoke(args=["rebuild-totals", "--verify"])
+    assert result.exit_code == 1
+    assert "1 of 1 budgets have drifted" in result.output
+    result = runner.invoke(args=["rebuild-totals"])
+    assert result.exit_code == 0
+    result = runner.invoke(args=["rebuild-totals", "--verify"])
+    assert result.exit_code == 0
+    assert Budget.query.first().spent_amount == 3
+
+
+def test_audit_queries(db_handle):
+    """
+    Tests that none of the SQL statements the resources issue scan a whole
+    table, according to the audit-queries command.
+    """
+    runner = current_app.test_cli_runner()
+    result = runner.invoke(args=["audit-queries"])
+    assert result.exit_code == 0, result.output
+    assert result.output.startswith("0 of ")
+
+
+def test_generate_data(db_handle):
+    """
+    Tests that generate-data loads the requested numbers of rows with correct
+    budget totals, and that a second load is added after the first one.
+    """
+    runner = current_app.test_cli_runner()
+    args = ["generate-data", "--users", "5", "--budgets-per-user", "2",
+        "--expenses-per-budget", "3", "--budget-distribution", "fixed",
+        "--expense-distribution", "fixed"]
+    result = runner.invoke(args=args)
+    assert result.exit_code == 0, result.output
+    assert result.output.startswith("Added 5 users, 10 budgets and 30 expenses")
+    result = runner.invoke(args=args + ["--seed", "1"])
+    assert result.exit_code == 0, result.output
+    assert User.query.count() == 10
+    assert Budget.query.count() == 20
+    assert Expense.query.count() == 60
+    budget = Budget.query.filter_by(budget_name="budget-2").first()
+    assert budget.expense_count == 3
+    assert budget.start_date <= budget.last_expense_date <= budget.end_date
+    result = runner.invoke(args=["rebuild-totals", "--verify"])
+    assert result.exit_code == 0, result.output
+
+    #The bulk profile is only for loading
+    assert app.get_pragmas({"SQLITE_PRAGMA_PROFILE": "bulk"})["synchronous"] == "OFF"
+
+
+def test_query_limit(db_handle):
+    """
+    Tests that printing model objects issues no SQL, even when they have
+    expired, and that MAX_QUERIES_PER_REQUEST fails requests that issue more
+    statements.
+    """
+    expense = _get_expense()
+    expense.budget = _get_budget()
+    expense.budget.user = _get_user()
+    db_handle.session.add(expense)
+    db_handle.session.commit()
+
+    statements = []
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    engine = db_handle.get_engine()
+    event.listen(engine, "before_cursor_execute", record_statement)
+    db_expense = Expense.query.first()
+    assert repr(db_expense) == "Expense 1 <1> in budget <1>"
+    db_budget = Budget.query.first()
+    assert repr(db_budget) == "Budget 1 <1> in user <1>"
+    #The loaded budget comes from the identity map
+    assert db_expense.budget is db_budget
+    assert repr(db_expense) == "Expense 1 <1> in Budget 1"
+    db_handle.session.expire_all()
+    assert repr(db_expense) == "? <?> in budget <?>"
+    event.remove(engine, "before_cursor_execute", record_statement)
+    assert len(statements) == 2
+
+    #sessions are per thread, start a new one for the other app
+    db_handle.session.remove()
+    limited_app = app.create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "TESTING": True,
+        "MAX_QUERIES_PER_REQUEST": 1})
+    with limited_app.app_context():
+        db_handle.create_all()
+        db_handle.session.add(_get_user())
+        db_handle.session.commit()
+        client = limited_app.test_client()
+        assert client.get("/api/users/User%201/").status_code == 200
+        assert client.get("/api/users/User%201/").status_code == 200
+        with pytest.raises(app.QueryLimitExceeded):
+            client.get("/api/users/User%201/budgets")
+        db_handle.session.remove()
+
+
+def test_sqlite_pragmas(db_handle):
+    """
+    Tests that new connections get the pragmas of the default profile and
+    that pragmas of a profile can be overridden from the config.
+    """
+    assert db_handle.session.execute("PRAGMA journal_mode").scalar() == "wal"
+    assert db_handle.session.execute("PRAGMA synchronous").scalar() == 1
+    assert db_handle.session.execute("PRAGMA busy_timeout").scalar() == 5000
+    assert db_handle.session.execute("PRAGMA foreign_keys").scalar() == 1
+
+    pragmas = app.get_pragmas({"SQLITE_PRAGMA_PROFILE": "compat",
+        "SQLITE_PRAGMAS": {"busy_timeout": 100}})
+    assert pragmas == {"foreign_keys": "ON", "busy_timeout": 100}
+    with pytest.raises(ValueError):
+        app.get_pragmas({"SQLITE_PRAGMA_PROFILE": "fast"})
+    with pytest.raises(ValueError):
+        app.get_pragmas({"SQLITE_PRAGMAS": {"cache_size": "1; DROP TABLE user"}})
+
+
+def test_create_app_config(db_handle):
+    """
+    Tests that settings are read from the environment, that the engine
+    options follow them and that two instances of the app have their own
+    engines.
+    """
+    config = app.config_from_env({
+        "BUDTRACK_DB_POOL_SIZE": "20",
+        "BUDTRACK_DB_POOL_PRE_PING": "true",
+        "BUDTRACK_SQLALCHEMY_DATABASE_URI": "sqlite:///other.db",
+        "OTHER_SETTING": "1"
+    })
+    assert config == {
+        "DB_POOL_SIZE": 20,
+        "DB_POOL_PRE_PING": True,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///other.db"
+    }
+
+    options = app.engine_options(dict(app.DEFAULT_CONFIG, **config))
+    assert options["poolclass"] is QueuePool
+    assert options["connect_args"] == {"check_same_thread": False}
+    assert options["pool_size"] == 20
+    assert options["pool_pre_ping"] is True
+    options = app.engine_options(dict(app.DEFAULT_CONFIG,
+        SQLALCHEMY_DATABASE_URI="postgresql://localhost/budtrack", DB_POOL_RECYCLE=300))
+    assert "poolclass" not in options
+    assert options["pool_recycle"] == 300
+
+    db_handle.session.add(_get_user())
+    db_handle.session.commit()
+    engine = db_handle.get_engine()
+    #sessions are per thread, start a new one for the other app
+    db_handle.session.remove()
+    other_app = app.create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+    with other_app.app_context():
+        db_handle.create_all()
+        assert db_handle.get_engine() is not engine
+        assert User.query.count() == 0
+        db_handle.session.remove()
+    assert User.query.count() == 1
+
+def test_instrumentation(db_handle):
+    """
+    Tests that an instrumented app sends Server-Timing headers with the SQL
+    statements of a request and counts the requests in /metrics, and that
+    apps are not instrumented by default.
+    """
+    assert "Server-Timing" not in current_app.test_client().get("/api/").headers
+    assert current_app.test_client().get("/metrics").status_code == 404
+
+    #sessions are per thread, start a new one for the other app
+    db_handle.session.remove()
+    timed_app = app.create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "INSTRUMENTATION": True})
+    timed_app.add_url_rule("/fail", "fail", lambda: 1 / 0)
+    with timed_app.app_context():
+        db_handle.create_all()
+        db_handle.session.add(_get_user())
+        db_handle.session.commit()
+        client = timed_app.test_client()
+
+        resp = client.get("/api/users/User%201/")
+        assert resp.status_code == 200
+        timing = resp.headers["Server-Timing"]
+        assert timing.startswith("app;dur=")
+        assert 'desc="1 queries"' in timing
+        assert "serialize;dur=" in timing
+        resp = client.post("/api/users/", json={"user_name": "User 2"})
+        assert resp.status_code == 400
+        #the failed INSERT of a conflict is timed too
+        resp = client.post("/api/users/", json={"user_name": "User 1",
+            "user_email": "user1@example.com", "password": "secret"})
+        assert resp.status_code == 409
+        assert 'desc="1 queries"' in resp.headers["Server-Timing"]
+        #requests that raise are counted as 500s
+        assert client.get("/fail").status_code == 500
+
+        resp = client.get("/metrics")
+        assert resp.mimetype == "text/plain"
+        text = resp.data.decode()
+        assert 'budtrack_requests_total{endpoint="useritem",method="GET",status="200"} 1' in text
+        assert 'budtrack_requests_total{endpoint="usercollection",method="POST",status="400"} 1' in text
+        assert 'budtrack_requests_total{endpoint="fail",method="GET",status="500"} 1' in text
+        assert 'budtrack_request_duration_seconds_bucket{endpoint="useritem",le="+Inf"} 1' in text
+        assert 'budtrack_sql_statements_total{endpoint="useritem"} 1' in text
+        assert 'budtrack_validate_seconds_total{endpoint="usercollection"}' in text
+        db_handle.session.remove()
+
+def test_control_templates(db_handle):
+    """
+    Tests that URLs made from the route templates are the same as the ones
+    made by the URL map and that controls made from templates are the same
+    as controls made with add_control.
+    """
+    values = {"user": "User 1", "budget": "bü:dget%", "expense": "a?b#c"}
+    with current_app.test_request_context(base_url="http://localhost/root/"):
+        for resource, urls, kwargs in app.api.resources:
+            names = app.ROUTE_TEMPLATES[resource].count("{")
+            args = dict(list(values.items())[:names])
+            assert app.resource_url(resource, **args) == app.api.url_for(resource, **args)
+
+        body = app.BudgetBuilder()
+        body.add_control_edit_budget("User 1", "budget")
+        assert body["@controls"]["edit"] == {
+            "method": "PUT",
+            "encoding": "json",
+            "title": "Edit this Budget",
+            "schema": app.BudgetBuilder.budget_schema(),
+            "href": app.api.url_for(app.BudgetItem, user="User 1", budget="budget")
+        }
+        assert list(body["@controls"]["edit"])[-1] == "href"
+
+def test_json_serializers(db_handle):
+    """
+    Tests that the serializers encode the same documents, that the json one
+    gives the output of json.dumps and is the default whether orjson is
+    installed or not, and that unknown ones are refused.
+    """
+    body = app.BudgetBuilder(budget_name="bü", budget_amount=1.5)
+    body.add_control("self", "/api/")
+    assert app.JSONSerializer().dumps(body) == json.dumps(body).encode("utf-8")
+    assert type(app.make_serializer({})) is app.JSONSerializer
+    assert type(current_app.extensions["json_serializer"]) is app.JSONSerializer
+    auto = app.make_serializer({"JSON_SERIALIZER": "auto"})
+    if app.orjson is not None:
+        assert isinstance(auto, app.OrjsonSerializer)
+    else:
+        assert type(auto) is app.JSONSerializer
+    assert isinstance(app.make_serializer({"JSON_SERIALIZER": "app.JSONSerializer"}),
+        app.JSONSerializer)
+    with pytest.raises(ImportError):
+        app.make_serializer({"JSON_SERIALIZER": "nope"})
+
+    for name in ("json", "orjson"):
+        if name == "orjson" and app.orjson is None:
+            continue
+        serializer = app.make_serializer({"JSON_SERIALIZER": name})
+        assert json.loads(serializer.dumps(body)) == body
+        current_app.extensions["json_serializer"] = serializer
+        items = [app.ExpenseBuilder(expense_name=str(i)) for i in range(3)]
+        streamed = b"".join(app.stream_collection(body, iter(items)))
+        assert streamed == serializer.dumps(dict(items=items, **body))
+
+def test_read_path(db_handle):
+    """
+    Tests that read_path reads the columns of every level into one row
+    without loading ORM objects and that it gives the same 404s as
+    resolve_path.
+    """
+    expense = _get_expense()
+    budget = _get_budget()
+    budget.user = _get_user()
+    expense.budget = budget
+    db_handle.session.add(expense)
+    db_handle.session.commit()
+    db_handle.session.expunge_all()
+
+    with current_app.test_request_context():
+        row, error = app.read_path("User 1", "Budget 1", "Expense 1")
+        assert error is None
+        assert row.user_email == "user1@"
+        assert row.budget_amount == 10
+        assert row.spent_amount == 1
+        assert row.expense_name == "Expense 1"
+        assert row.user_version and row.budget_version and row.expense_version
+        assert len(db_handle.session.identity_map) == 0
+
+        for path in (("User 2", ), ("User 1", "Budget 2"), ("User 1", "Budget 1", "Expense 2")):
+            row, error = app.read_path(*path)
+            assert row is None
+            assert error.status_code == 404
+            assert error.data == app.resolve_path(*path)[-1].data
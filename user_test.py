@@ -22,15 +22,21 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
 @pytest.fixture
 def client():
     db_fd, db_fname = tempfile.mkstemp()
-    app.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_fname
-    app.app.config["TESTING"] = True
+    flask_app = app.create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        #No request needs more, N+1 queries would fail the tests
+        "MAX_QUERIES_PER_REQUEST": 4
+    })
     
-    with app.app.app_context():
+    with flask_app.app_context():
         db.create_all()
         _populate_db()
         
-    yield app.app.test_client()
+    yield flask_app.test_client()
     
+    with flask_app.app_context():
+        db.get_engine().dispose()
     os.close(db_fd)
     os.unlink(db_fname)
 
@@ -146,6 +152,57 @@ def test_UserCollection_get(client):
             _check_control_get_method("self", client, item)
             _check_control_get_method("profile", client, item)
 
+def test_UserCollection_pages(client):
+        #first page has a next control but no prev
+        resp = client.get(USER_COLLECTION_URL + "?limit=2")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["user_name"] for item in body["items"]] == ["User-1", "User-2"]
+        assert "prev" not in body["@controls"]
+        
+        #follow next to the last page
+        resp = client.get(body["@controls"]["next"]["href"])
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["user_name"] for item in body["items"]] == ["User-3"]
+        assert "next" not in body["@controls"]
+        
+        #and prev back to the first one
+        resp = client.get(body["@controls"]["prev"]["href"])
+        body = json.loads(resp.data)
+        assert [item["user_name"] for item in body["items"]] == ["User-1", "User-2"]
+        
+        #invalid paging arguments
+        resp = client.get(USER_COLLECTION_URL + "?limit=abc")
+        assert resp.status_code == 400
+        resp = client.get(USER_COLLECTION_URL + "?limit=0")
+        assert resp.status_code == 400
+        resp = client.get(USER_COLLECTION_URL + "?after=1&before=3")
+        assert resp.status_code == 400
+
+def test_UserCollection_shape(client):
+        #only the asked fields and no controls, also on the next page
+        resp = client.get(USER_COLLECTION_URL + "?limit=2&fields=user_name&controls=minimal")
+        body = json.loads(resp.data)
+        assert body["items"] == [
+            {"user_name": "User-1", "@controls": {"self": {"href": USER_COLLECTION_URL + "User-1/"}}},
+            {"user_name": "User-2", "@controls": {"self": {"href": USER_COLLECTION_URL + "User-2/"}}}
+        ]
+        assert list(body["@controls"]) == ["self", "next"]
+        assert "@namespaces" not in body
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert body["items"][0]["user_name"] == "User-3"
+        assert "user_email" not in body["items"][0]
+        
+        #controls can be left out completely
+        resp = client.get(USER_COLLECTION_URL + "?controls=none")
+        body = json.loads(resp.data)
+        assert list(body) == ["items"]
+        assert all("@controls" not in item for item in body["items"])
+        resp = client.get(USER_COLLECTION_URL + "?controls=some")
+        assert resp.status_code == 400
+
 def test_UserCollection_post(client):
         valid = _get_user_json()
         
@@ -214,6 +271,21 @@ def test_UserItem_put(client):
         resp = client.put(USER_ITEM_URL, json=valid)
         assert resp.status_code == 400
         
+def test_UserItem_etag(client):
+        etag = client.get(USER_ITEM_URL).headers["ETag"]
+        resp = client.get(USER_ITEM_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        
+        # a stale version can not be changed
+        valid = _get_user_json()
+        valid["user_name"] = "User-1"
+        resp = client.put(USER_ITEM_URL, json=valid, headers={"If-Match": etag})
+        assert resp.status_code == 204
+        resp = client.put(USER_ITEM_URL, json=valid, headers={"If-Match": etag})
+        assert resp.status_code == 412
+        resp = client.get(USER_ITEM_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        
 def test_UserItem_delete(client):
         resp = client.delete(USER_ITEM_URL)
         assert resp.status_code == 204